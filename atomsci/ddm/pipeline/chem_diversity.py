@@ -85,7 +85,8 @@ def calc_dist_smiles(
 
 
 def calc_dist_diskdataset(
-    feat_type, dist_met, dataset1, dataset2=None, calc_type='nearest', num_nearest=1, **metric_kwargs):
+    feat_type, dist_met, dataset1, dataset2=None, calc_type='nearest', num_nearest=1, sample_size=None,
+    **metric_kwargs):
     """Returns a vector of distances, either between all compounds in a single dataset or between two datasets, given
     as DeepChem Dataset objects.
 
@@ -102,10 +103,21 @@ def calc_dist_diskdataset(
         calc_type: Type of calculation to use to process distance matrix. Options: nearest, farthest, average, or all.
         num_nearest: Additional parameter for calc_types nearest, nth_nearest and avg_n_nearest.
 
+        sample_size: Optional, for calc_type 'all' within a single dataset. If the number of compound pairs exceeds
+        sample_size, only the distances between a random subset of compounds with about sample_size pairs are
+        computed, so the full distance vector is never materialized.
+
     Returns:
         dists: vector or array of distances
 
     """
+    if dataset2 is None and calc_type == 'all' and sample_size is not None:
+        nfeat = dataset1.X.shape[0]
+        if nfeat * (nfeat - 1) // 2 > sample_size:
+            nsample = int(np.ceil((1 + np.sqrt(1 + 8 * sample_size)) / 2))
+            sample_idx = np.sort(np.random.choice(nfeat, size=nsample, replace=False))
+            return calc_dist_feat_array(feat_type, dist_met, dataset1.X[sample_idx], None, calc_type, num_nearest,
+                                        **metric_kwargs)
     if dataset2 is not None:
         return calc_dist_feat_array(feat_type, dist_met, dataset1.X, dataset2.X, calc_type, num_nearest, **metric_kwargs)
     else:
@@ -1,22 +1,65 @@
 """Distance metrics for compounds: Tanimoto and maximum common substructure (MCS)"""
 
+import atexit
 import itertools
 import multiprocessing
 
 from rdkit import DataStructs
 from rdkit.Chem.rdFMCS import FindMCS  # pylint: disable=no-name-in-module
-from scipy.spatial.distance import squareform  # pylint: disable=unused-import
+from scipy.spatial.distance import squareform
 import numpy as np
+try:
+    import numba
+    numba_supported = True
+except ImportError:
+    numba_supported = False
+
+cuda_supported = False
+if numba_supported:
+    try:
+        from numba import cuda
+        cuda_supported = cuda.is_available()
+    except Exception:
+        cuda_supported = False
+
 N_PROCS = multiprocessing.cpu_count()
 
+# Minimum number of fingerprints for which it pays to copy them to the GPU
+GPU_MIN_FPS = 5000
 
-def parallel_dist_single(inp_lst, worker_fn):
-    """Method for multiprocessor distance matrix computation."""
-    pool = multiprocessing.Pool(processes=N_PROCS)
+# Constants for the SWAR popcount of 64-bit words
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+_BYTE_POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+# Worker pool shared by all the parallel computations in this process; see get_pool()
+_pool = None
+
+def get_pool():
+    """Return a multiprocessing pool with N_PROCS workers, creating it on first use. The same pool is reused
+    by every later call, so that a run computing several distance matrices (or fingerprints, etc.) only pays
+    the cost of starting the worker processes once. The pool is shut down when the interpreter exits."""
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(processes=N_PROCS)
+        atexit.register(_close_pool)
+    return _pool
+
+def _close_pool():
+    """Shut down the shared worker pool, if one was created."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+def parallel_dist_single(inp_lst, worker_fn, condensed=False):
+    """Method for multiprocessor distance matrix computation. If condensed is True, return the
+    flattened upper triangle of the distance matrix instead of the square form."""
     inputs = [[k] + inp_lst for k, _ in enumerate(inp_lst[0])]
-    ret = pool.starmap(worker_fn, inputs)
-    pool.close()
-    pool.join()
+    ret = get_pool().starmap(worker_fn, inputs)
 
     dists_all = []
     sum_incomp = 0
@@ -26,16 +69,15 @@ def parallel_dist_single(inp_lst, worker_fn):
 
     # Flattened distance matrix (upper triangle only)
     dists = np.array(list(itertools.chain.from_iterable(dists_all)))
+    if condensed:
+        return dists, sum_incomp
     return squareform(dists), sum_incomp
 
 def parallel_dist_multi(inp_lst, worker_fn):
     """Method for multiprocessor distance matrix computation."""
-    pool = multiprocessing.Pool(processes=N_PROCS)
     #TODO: Want to switch order of fps1 and 2?
     inputs = [[inp_lst[0][k]] + inp_lst[1:] for k, _ in enumerate(inp_lst[0])]
-    ret = pool.starmap(worker_fn, inputs)
-    pool.close()
-    pool.join()
+    ret = get_pool().starmap(worker_fn, inputs)
 
     dists_all = []
     sum_incomp = 0
@@ -58,10 +100,133 @@ def tanimoto_single(fp, fps):
     dists = [1. - s for s in sims]
     return np.array(dists), 0
 
-def tanimoto(fps1, fps2=None):
-    """Compute Tanimoto distance between given ECFP fingerprints."""
+def pack_fingerprints(fps):
+    """Pack a list of RDKit ExplicitBitVect fingerprints, or a 2D 0/1 fingerprint array, into a contiguous
+    uint64 array with one row per fingerprint."""
+    if isinstance(fps, np.ndarray):
+        packed = np.packbits(fps.astype(bool), axis=1)
+    else:
+        # pylint: disable=no-member
+        packed = np.frombuffer(b''.join(DataStructs.BitVectToBinaryText(fp) for fp in fps),
+                               dtype=np.uint8).reshape(len(fps), -1)
+    # Pad each row to a whole number of 64-bit words
+    pad = (-packed.shape[1]) % 8
+    if pad:
+        packed = np.pad(packed, ((0, 0), (0, pad)), 'constant')
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+def bit_counts(arr):
+    """Number of set bits in each row of a packed fingerprint array."""
+    return _BYTE_POPCOUNT[arr.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+def _tanimoto_packed_numpy(arr, counts, block_size=256):
+    """Condensed Tanimoto distances between the rows of a packed fingerprint array, computed blockwise
+    with a byte popcount lookup table. counts holds the number of set bits in each row, so that only the
+    intersections need to be counted: |A u B| = |A| + |B| - |A n B|."""
+    nfp = arr.shape[0]
+    bytes_arr = arr.view(np.uint8)
+    dists = np.empty(nfp * (nfp - 1) // 2, dtype=np.float64)
+    start = 0
+    for i in range(nfp - 1):
+        for j0 in range(i + 1, nfp, block_size):
+            j1 = min(j0 + block_size, nfp)
+            inter = _BYTE_POPCOUNT[bytes_arr[i] & bytes_arr[j0:j1]].sum(axis=1, dtype=np.int64)
+            union = counts[i] + counts[j0:j1] - inter
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dists[start:start + j1 - j0] = np.where(union > 0, 1. - inter / union, 1.)
+            start += j1 - j0
+    return dists
+
+if numba_supported:
+    @numba.njit(cache=True)
+    def _popcount64(x):
+        """Count the set bits in a 64-bit word."""
+        x = x - ((x >> np.uint64(1)) & _M1)
+        x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+        x = (x + (x >> np.uint64(4))) & _M4
+        return (x * _H01) >> np.uint64(56)
+
+    @numba.njit(parallel=True, cache=True)
+    def _tanimoto_packed_numba(arr, counts):
+        """Condensed Tanimoto distances between the rows of a packed fingerprint array, given the number of
+        set bits in each row."""
+        nfp, nwords = arr.shape
+        dists = np.empty(nfp * (nfp - 1) // 2, dtype=np.float64)
+        for i in numba.prange(nfp - 1):
+            # Offset of row i in the condensed distance vector
+            start = i * nfp - (i * (i + 1)) // 2
+            for j in range(i + 1, nfp):
+                inter = 0
+                for w in range(nwords):
+                    inter += _popcount64(arr[i, w] & arr[j, w])
+                union = counts[i] + counts[j] - inter
+                if union > 0:
+                    dists[start + j - i - 1] = 1. - inter / union
+                else:
+                    dists[start + j - i - 1] = 1.
+        return dists
+
+if cuda_supported:
+    @cuda.jit
+    def _tanimoto_cuda_kernel(arr, counts, row_start, row_end, offset, dists):
+        """One thread per (i,j) pair with row_start <= i < row_end and j > i; writes the distance into the
+        slice of the condensed distance vector beginning at offset."""
+        i, j = cuda.grid(2)
+        i += row_start
+        nfp = arr.shape[0]
+        if i < row_end and j > i and j < nfp:
+            inter = 0
+            for w in range(arr.shape[1]):
+                inter += cuda.popc(arr[i, w] & arr[j, w])
+            union = counts[i] + counts[j] - inter
+            k = i * nfp - (i * (i + 1)) // 2 + j - i - 1 - offset
+            if union > 0:
+                dists[k] = 1. - inter / union
+            else:
+                dists[k] = 1.
+
+def _tanimoto_packed_cuda(arr, counts, max_block_dists=2**27, threads=(16, 16)):
+    """Condensed Tanimoto distances between the rows of a packed fingerprint array, computed on the GPU.
+    Rows are processed in blocks so that the device output buffer holds at most max_block_dists distances."""
+    nfp = arr.shape[0]
+    dists = np.empty(nfp * (nfp - 1) // 2, dtype=np.float64)
+    d_arr = cuda.to_device(arr)
+    d_counts = cuda.to_device(counts)
+    row_offsets = np.arange(nfp + 1) * nfp - (np.arange(nfp + 1) * np.arange(1, nfp + 2)) // 2
+    row_start = 0
+    while row_start < nfp - 1:
+        row_end = row_start + 1
+        while row_end < nfp - 1 and row_offsets[row_end + 1] - row_offsets[row_start] <= max_block_dists:
+            row_end += 1
+        offset = row_offsets[row_start]
+        d_dists = cuda.device_array(row_offsets[row_end] - offset, dtype=np.float64)
+        blocks = ((row_end - row_start + threads[0] - 1) // threads[0], (nfp + threads[1] - 1) // threads[1])
+        _tanimoto_cuda_kernel[blocks, threads](d_arr, d_counts, row_start, row_end, offset, d_dists)
+        d_dists.copy_to_host(dists[offset:row_offsets[row_end]])
+        row_start = row_end
+    return dists
+
+def tanimoto_packed(fps, use_gpu=None):
+    """Compute the condensed Tanimoto distance matrix for the given fingerprints, after packing them into
+    64-bit words so that each pair comparison is a handful of popcounts. By default the GPU is used when
+    one is available and there are at least GPU_MIN_FPS fingerprints."""
+    arr = pack_fingerprints(fps)
+    counts = bit_counts(arr)
+    if use_gpu is None:
+        use_gpu = arr.shape[0] >= GPU_MIN_FPS
+    if use_gpu and cuda_supported:
+        return _tanimoto_packed_cuda(arr, counts)
+    if numba_supported:
+        return _tanimoto_packed_numba(arr, counts)
+    return _tanimoto_packed_numpy(arr, counts)
+
+def tanimoto(fps1, fps2=None, condensed=False):
+    """Compute Tanimoto distance between given ECFP fingerprints. If fps2 is None and condensed
+    is True, return the condensed (upper triangle) form of the distance matrix."""
     if fps2 is None:
-        dists, _ = parallel_dist_single([fps1], tanimoto_worker)
+        dists = tanimoto_packed(fps1)
+        if not condensed:
+            dists = squareform(dists)
     else:
         dists, _ = parallel_dist_multi([fps1, fps2], tanimoto_single)
     return dists
@@ -96,11 +261,12 @@ def mcs_single(mol, mols, n_atms):
             n_incomp += 1
     return np.array(dists_k), n_incomp
 
-def mcs(mols1, mols2=None):
-    """Compute average variant of MCS distance between molecules."""
+def mcs(mols1, mols2=None, condensed=False):
+    """Compute average variant of MCS distance between molecules. If mols2 is None and condensed
+    is True, return the condensed (upper triangle) form of the distance matrix."""
     n_atms1 = [float(m.GetNumAtoms()) for m in mols1]
     if mols2 is None:
-        dists, sum_incomplete = parallel_dist_single([mols1, n_atms1], mcs_worker)
+        dists, sum_incomplete = parallel_dist_single([mols1, n_atms1], mcs_worker, condensed)
     else:
         dists, sum_incomplete = parallel_dist_multi([mols1, mols2, n_atms1], mcs_single)
     if sum_incomplete:
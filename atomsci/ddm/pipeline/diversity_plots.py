@@ -9,14 +9,15 @@ import numpy as np
 import seaborn as sns
 import umap
 from scipy.stats.kde import gaussian_kde
-from scipy.cluster.hierarchy import linkage
+from scipy.cluster.hierarchy import linkage, leaves_list
+from scipy.spatial.distance import squareform
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 import logging
 import argparse
 from rdkit import Chem
-from rdkit.Chem import AllChem, Draw
+from rdkit.Chem import Draw, rdFingerprintGenerator
 
 from atomsci.ddm.utils import struct_utils
 from atomsci.ddm.pipeline import dist_metrics as dm
@@ -34,6 +35,97 @@ matplotlib.rc('axes', labelsize=12)
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 
 ndist_max = 1000000
+# Maximum number of distances used to fit the kernel density estimate
+nkde_max = 50000
+# Maximum number of rows/columns drawn in a distance heatmap; larger matrices are block averaged down to this size
+heatmap_max_size = 1500
+
+# Morgan fingerprint generators, created once per process and reused across molecules
+_morgan_generators = {}
+
+#------------------------------------------------------------------------------------------------------------------
+def _morgan_fp_worker(mol, ecfp_radius, nbits):
+    """
+    Compute the ECFP bit vector for one molecule, reusing this process's generator for the given radius and size.
+    """
+    gen = _morgan_generators.get((ecfp_radius, nbits))
+    if gen is None:
+        gen = rdFingerprintGenerator.GetMorganGenerator(radius=ecfp_radius, fpSize=nbits)
+        _morgan_generators[(ecfp_radius, nbits)] = gen
+    return gen.GetFingerprint(mol)
+
+#------------------------------------------------------------------------------------------------------------------
+def _calc_base_smiles(smiles_strs, chunksize=64):
+    """
+    Strip salts and canonicalize the given SMILES strings in parallel. Strings that couldn't be parsed map to
+    empty strings.
+    """
+    return list(dm.get_pool().imap(struct_utils.base_smiles_from_smiles, smiles_strs, chunksize=chunksize))
+
+#------------------------------------------------------------------------------------------------------------------
+def calc_base_mols(smiles_strs):
+    """
+    Strip salts and canonicalize the given SMILES strings, returning a list of RDKit Mol objects
+    (None for strings that couldn't be parsed).
+    """
+    base_smiles = _calc_base_smiles(list(smiles_strs))
+    return [Chem.MolFromSmiles(smiles) if smiles else None for smiles in base_smiles]
+
+#------------------------------------------------------------------------------------------------------------------
+def calc_ecfp_fingerprints(base_mols, ecfp_radius, nbits=1024, chunksize=64):
+    """
+    Compute ECFP bit vectors in parallel for the non-null molecules in base_mols, using RDKit's Morgan
+    fingerprint generator.
+    """
+    mols = [mol for mol in base_mols if mol is not None]
+    args = [(mol, ecfp_radius, nbits) for mol in mols]
+    return dm.get_pool().starmap(_morgan_fp_worker, args, chunksize=chunksize)
+
+#------------------------------------------------------------------------------------------------------------------
+def fingerprint_array(fps):
+    """
+    Convert a list of ECFP bit vectors to a 2D boolean array, one row per fingerprint, for use as UMAP input
+    with the jaccard metric. The conversion is done once so that the array can be reused across UMAP fits and
+    transforms. Bits are in packed word order, which doesn't matter for set-based metrics like jaccard.
+    """
+    return np.unpackbits(dm.pack_fingerprints(fps).view(np.uint8), axis=1).astype(bool)
+
+#------------------------------------------------------------------------------------------------------------------
+def block_mean(mat, block_size):
+    """
+    Downsample a 2D array by averaging over block_size x block_size blocks. Blocks at the right and bottom edges
+    may be smaller and are averaged over the elements they contain.
+    """
+    row_starts = np.arange(0, mat.shape[0], block_size)
+    col_starts = np.arange(0, mat.shape[1], block_size)
+    sums = np.add.reduceat(np.add.reduceat(mat, row_starts, axis=0), col_starts, axis=1)
+    counts = np.outer(np.diff(np.append(row_starts, mat.shape[0])), np.diff(np.append(col_starts, mat.shape[1])))
+    return sums / counts
+
+#------------------------------------------------------------------------------------------------------------------
+def plot_dist_heatmap(dist_mat, dist_linkage, pdf_path=None):
+    """
+    Draw a heatmap of a square distance matrix with rows and columns ordered by the leaves of the given
+    hierarchical clustering linkage. Unlike sns.clustermap, this doesn't build a DataFrame copy of the matrix
+    or draw dendrograms. Matrices larger than heatmap_max_size are block averaged before drawing, since the
+    figure can't show more cells than that anyway. If pdf_path is given, the figure is saved to a PDF file
+    at that path.
+    """
+    leaves = leaves_list(dist_linkage)
+    reordered = dist_mat[np.ix_(leaves, leaves)]
+    block_size = int(np.ceil(reordered.shape[0] / heatmap_max_size))
+    if block_size > 1:
+        reordered = block_mean(reordered, block_size)
+    fig, ax = plt.subplots(figsize=(12,12))
+    img = ax.imshow(reordered, cmap='plasma')
+    ax.set_xticks([])
+    ax.set_yticks([])
+    fig.colorbar(img, ax=ax, shrink=0.8)
+    if pdf_path is not None:
+        pdf = PdfPages(pdf_path)
+        pdf.savefig(fig)
+        pdf.close()
+    return fig
 
 #------------------------------------------------------------------------------------------------------------------
 def plot_dataset_dist_distr(dataset, feat_type, dist_metric, task_name, **metric_kwargs):
@@ -47,16 +139,18 @@ def plot_dataset_dist_distr(dataset, feat_type, dist_metric, task_name, **metric
         log.warning("Dataset has %d compounds, too big to calculate distance matrix" % num_cmpds)
         return
     log.warning("Starting distance matrix calculation for %d compounds" % num_cmpds)
-    dists = cd.calc_dist_diskdataset(feat_type, dist_metric, dataset, calc_type='all', **metric_kwargs)
+    # Only compute distances for a random sample of about ndist_max compound pairs
+    dists = cd.calc_dist_diskdataset(feat_type, dist_metric, dataset, calc_type='all', sample_size=ndist_max,
+                                     **metric_kwargs)
     log.warning("Finished calculation of %d distances" % len(dists))
-    if len(dists) > ndist_max:
+    if len(dists) > nkde_max:
         # Sample a subset of the distances so KDE doesn't take so long
-        dist_sample = np.random.choice(dists, size=ndist_max)
+        dist_sample = np.random.choice(dists, size=nkde_max, replace=False)
     else:
         dist_sample = dists
 
     dist_pdf = gaussian_kde(dist_sample)
-    x_plt = np.linspace(min(dist_sample), max(dist_sample), 500)
+    x_plt = np.linspace(dists.min(), dists.max(), 500)
     y_plt = dist_pdf(x_plt)
     fig, ax = plt.subplots(figsize=(8.0,8.0))
     ax.plot(x_plt, y_plt, color='forestgreen')
@@ -66,12 +160,71 @@ def plot_dataset_dist_distr(dataset, feat_type, dist_metric, task_name, **metric
                   task_name, dist_metric, feat_type))
     return dists
 
+#------------------------------------------------------------------------------------------------------------------
+def _square_dist_matrix(cond_dist):
+    """
+    Convert a condensed distance matrix to the square form used for UMAP projections and heatmaps. UMAP works
+    in single precision, so the matrix is built as float32 to save memory and a copy.
+    """
+    return squareform(cond_dist.astype(np.float32))
+
+#------------------------------------------------------------------------------------------------------------------
+def tanimoto_umap_heatmap(fps, compound_ids, out_dir, file_prefix, title_prefix, main_xy_min=None):
+    """
+    Compute the Tanimoto distance matrix for a set of ECFP fingerprints, then draw a UMAP projection and a
+    cluster heatmap based on it. If out_dir is given, the plots are saved there as PDF files. If main_xy_min is
+    given, an additional projection plot is drawn zoomed in on the points with both coordinates above it, to
+    leave out outliers. Returns the data frame of projected coordinates.
+    """
+    # Get Tanimoto distance matrix
+    print("Computing Tanimoto distance matrix...")
+    tani_cond = dm.tanimoto(fps, condensed=True)
+    print("Done")
+    # Draw a UMAP projection based on Tanimoto distance
+    tani_dist = _square_dist_matrix(tani_cond)
+    mapper = umap.UMAP(n_neighbors=10, n_components=2, metric='precomputed', random_state=17)
+    reps = mapper.fit_transform(tani_dist)
+    rep_df = pd.DataFrame({'x' : reps[:,0], 'y' : reps[:,1], 'compound_id' : compound_ids})
+    if out_dir is not None:
+        pdf_path = '%s/%s_tani_umap_proj.pdf' % (out_dir, file_prefix)
+        pdf = PdfPages(pdf_path)
+    fig, ax = plt.subplots(figsize=(12,12))
+    sns.scatterplot(x='x', y='y', data=rep_df, ax=ax)
+    ax.set_title("%s, 2D projection based on Tanimoto distance" % title_prefix)
+    if out_dir is not None:
+        pdf.savefig(fig)
+    if main_xy_min is not None:
+        main_rep_df = rep_df[(rep_df.x > main_xy_min) & (rep_df.y > main_xy_min)]
+        fig, ax = plt.subplots(figsize=(12,12))
+        sns.scatterplot(x='x', y='y', data=main_rep_df, ax=ax)
+        ax.set_title("%s, main portion, 2D projection based on Tanimoto distance" % title_prefix)
+        if out_dir is not None:
+            pdf.savefig(fig)
+    if out_dir is not None:
+        pdf.close()
+
+    # Draw a cluster heatmap based on Tanimoto distance
+    tani_linkage = linkage(tani_cond, method='complete')
+    pdf_path = None
+    if out_dir is not None:
+        pdf_path = '%s/%s_tanimoto_clustermap.pdf' % (out_dir, file_prefix)
+    plot_dist_heatmap(tani_dist, tani_linkage, pdf_path)
+    return rep_df
+
+#------------------------------------------------------------------------------------------------------------------
+def _draw_mol_file(mol, img_file):
+    """
+    Draw a 500x500 pixel structure image for one molecule into a PNG file.
+    """
+    Draw.MolToFile(mol, img_file, size=(500,500), fitImage=False)
+
 #------------------------------------------------------------------------------------------------------------------
 def diversity_plots(dset_key, datastore=True, bucket='gsk_ml', title_prefix=None, ecfp_radius=4, out_dir=None, 
-                    id_col='compound_id', smiles_col='rdkit_smiles', max_for_mcs=300):
+                    id_col='compound_id', smiles_col='rdkit_smiles', max_for_mcs=300, separate_pair_images=False):
     """
     Plot visualizations of diversity for an arbitrary table of compounds. At minimum, the file should contain
-    columns for a compound ID and a SMILES string.
+    columns for a compound ID and a SMILES string. The 10 closest pairs by MCS distance are drawn in a single
+    grid image, or in a separate PNG file per compound if separate_pair_images is True.
     """
     # Load table of compound names, IDs and SMILES strings
     if datastore:
@@ -87,7 +240,7 @@ def diversity_plots(dset_key, datastore=True, bucket='gsk_ml', title_prefix=None
     print(ncmpds)
     # Strip salts, canonicalize SMILES strings and create RDKit Mol objects
     print("Canonicalizing molecules...")
-    base_mols = [struct_utils.base_mol_from_smiles(smiles) for smiles in smiles_strs]
+    base_mols = calc_base_mols(smiles_strs)
     for i, mol in enumerate(base_mols):
         if mol is None:
             print('Unable to get base molecule for compound %d = %s' % (i, compound_ids[i]))
@@ -96,55 +249,54 @@ def diversity_plots(dset_key, datastore=True, bucket='gsk_ml', title_prefix=None
 
     # Generate ECFP fingerprints
     print("Computing fingerprints...")
-    fps = [AllChem.GetMorganFingerprintAsBitVect(mol, ecfp_radius, 1024) for mol in base_mols if mol is not None]
+    fps = calc_ecfp_fingerprints(base_mols, ecfp_radius)
     print("Done")
 
     if ncmpds <= max_for_mcs:
         # Get MCS distance matrix and draw a heatmap
         print("Computing MCS distance matrix...")
-        mcs_dist = dm.mcs(base_mols)
+        # Keep the distances in condensed form; the square matrix is only built when needed for plotting
+        dist = dm.mcs(base_mols, condensed=True)
         print("Done")
-        cmpd1 = []
-        cmpd2 = []
-        dist = []
-        ind1 = []
-        ind2 = []
-        for i in range(ncmpds-1):
-            for j in range(i+1, ncmpds):
-                cmpd1.append(compound_ids[i])
-                cmpd2.append(compound_ids[j])
-                dist.append(mcs_dist[i,j])
-                ind1.append(i)
-                ind2.append(j)
-        dist_df = pd.DataFrame({'compound_1' : cmpd1, 'compound_2' : cmpd2, 'dist' : dist,
+        # The condensed distances are ordered like the upper triangle of the square matrix
+        ind1, ind2 = np.triu_indices(ncmpds, k=1)
+        dist_df = pd.DataFrame({'compound_1' : compound_ids[ind1], 'compound_2' : compound_ids[ind2], 'dist' : dist,
                                 'i' : ind1, 'j' : ind2})
-        dist_df = dist_df.sort_values(by='dist')
-        print(dist_df.head(10))
+        # Select the 10 closest pairs without sorting the whole table
+        ntop = min(10, len(dist))
+        if ntop > 0:
+            top_idx = np.argpartition(dist, ntop-1)[:ntop]
+            top_idx = top_idx[np.argsort(dist[top_idx], kind='stable')]
+        else:
+            # A single compound has no pairs, so the table of closest pairs is empty
+            top_idx = np.array([], dtype=int)
+        top_df = dist_df.iloc[top_idx]
+        print(top_df)
         if out_dir is not None:
-            dist_df.to_csv('%s/%s_mcs_dist_table.csv' % (out_dir, file_prefix), index=False)
-            for k in range(10):
-                mol_i = base_mols[dist_df.i.values[k]]
-                mol_j = base_mols[dist_df.j.values[k]]
-                img_file_i = '%s/%d_%s.png' % (out_dir, k, compound_ids[dist_df.i.values[k]])
-                img_file_j = '%s/%d_%s.png' % (out_dir, k, compound_ids[dist_df.j.values[k]])
-                Draw.MolToFile(mol_i, img_file_i, size=(500,500), fitImage=False)
-                Draw.MolToFile(mol_j, img_file_j, size=(500,500), fitImage=False)
+            dist_df.iloc[np.argsort(dist, kind='stable')].to_csv('%s/%s_mcs_dist_table.csv' % (out_dir, file_prefix),
+                                                                 index=False)
+            pair_inds = np.column_stack((top_df.i.values, top_df.j.values)).ravel()
+            if separate_pair_images:
+                # Render the structure images in parallel, named by pair rank and compound ID
+                img_files = ['%s/%d_%s.png' % (out_dir, k // 2, compound_ids[i]) for k, i in enumerate(pair_inds)]
+                dm.get_pool().starmap(_draw_mol_file, zip([base_mols[i] for i in pair_inds], img_files))
+            else:
+                # Draw the 10 closest pairs side by side in a single image
+                img = Draw.MolsToGridImage([base_mols[i] for i in pair_inds], molsPerRow=2, subImgSize=(500,500),
+                                           legends=[str(compound_ids[i]) for i in pair_inds])
+                img.save('%s/%s_top10_pairs.png' % (out_dir, file_prefix))
     
-        mcs_linkage = linkage(mcs_dist, method='complete')
-        mcs_df = pd.DataFrame(mcs_dist, columns=compound_ids, index=compound_ids)
+        mcs_linkage = linkage(dist, method='complete')
+        mcs_dist = _square_dist_matrix(dist)
+        pdf_path = None
         if out_dir is not None:
             pdf_path = '%s/%s_mcs_clustermap.pdf' % (out_dir, file_prefix)
-            pdf = PdfPages(pdf_path)
-        g = sns.clustermap(mcs_df, row_linkage=mcs_linkage, col_linkage=mcs_linkage, figsize=(12,12), cmap='plasma')
-        if out_dir is not None:
-            pdf.savefig(g.fig)
-            pdf.close()
+        plot_dist_heatmap(mcs_dist, mcs_linkage, pdf_path)
     
         # Draw a UMAP projection based on MCS distance
         mapper = umap.UMAP(n_neighbors=10, n_components=2, metric='precomputed', random_state=17)
         reps = mapper.fit_transform(mcs_dist)
-        rep_df = pd.DataFrame.from_records(reps, columns=['x', 'y'])
-        rep_df['compound_id'] = compound_ids
+        rep_df = pd.DataFrame({'x' : reps[:,0], 'y' : reps[:,1], 'compound_id' : compound_ids})
         if out_dir is not None:
             pdf_path = '%s/%s_mcs_umap_proj.pdf' % (out_dir, file_prefix)
             pdf = PdfPages(pdf_path)
@@ -155,36 +307,9 @@ def diversity_plots(dset_key, datastore=True, bucket='gsk_ml', title_prefix=None
             pdf.savefig(fig)
             pdf.close()
             rep_df.to_csv('%s/%s_mcs_umap_proj.csv' % (out_dir, file_prefix), index=False)
+        del mcs_dist
 
-    # Get Tanimoto distance matrix
-    print("Computing Tanimoto distance matrix...")
-    tani_dist = dm.tanimoto(fps)
-    print("Done")
-    # Draw a UMAP projection based on Tanimoto distance
-    mapper = umap.UMAP(n_neighbors=10, n_components=2, metric='precomputed', random_state=17)
-    reps = mapper.fit_transform(tani_dist)
-    rep_df = pd.DataFrame.from_records(reps, columns=['x', 'y'])
-    rep_df['compound_id'] = compound_ids
-    if out_dir is not None:
-        pdf_path = '%s/%s_tani_umap_proj.pdf' % (out_dir, file_prefix)
-        pdf = PdfPages(pdf_path)
-    fig, ax = plt.subplots(figsize=(12,12))
-    sns.scatterplot(x='x', y='y', data=rep_df, ax=ax)
-    ax.set_title("%s, 2D projection based on Tanimoto distance" % title_prefix)
-    if out_dir is not None:
-        pdf.savefig(fig)
-        pdf.close()
-
-    # Draw a cluster heatmap based on Tanimoto distance
-    tani_linkage = linkage(tani_dist, method='complete')
-    tani_df = pd.DataFrame(tani_dist, columns=compound_ids, index=compound_ids)
-    if out_dir is not None:
-        pdf_path = '%s/%s_tanimoto_clustermap.pdf' % (out_dir, file_prefix)
-        pdf = PdfPages(pdf_path)
-    g = sns.clustermap(tani_df, row_linkage=tani_linkage, col_linkage=tani_linkage, figsize=(12,12), cmap='plasma')
-    if out_dir is not None:
-        pdf.savefig(g.fig)
-        pdf.close()
+    tanimoto_umap_heatmap(fps, compound_ids, out_dir, file_prefix, title_prefix)
 
 
 
@@ -235,7 +360,7 @@ def obach_diversity_plots(ecfp_radius=6):
 
     # Strip salts, canonicalize SMILES strings and create RDKit Mol objects
     print("Canonicalizing molecules...")
-    base_mols = [struct_utils.base_mol_from_smiles(smiles) for smiles in smiles_strs]
+    base_mols = calc_base_mols(smiles_strs)
     for i, mol in enumerate(base_mols):
         if mol is None:
             print('Unable to get base molecule for compound %d = %s' % (i, compound_ids[i]))
@@ -244,44 +369,10 @@ def obach_diversity_plots(ecfp_radius=6):
 
     # Generate ECFP fingerprints
     print("Computing fingerprints...")
-    fps = [AllChem.GetMorganFingerprintAsBitVect(mol, ecfp_radius, 1024) for mol in base_mols if mol is not None]
-    print("Done")
-
-    # Get Tanimoto distance matrix
-    print("Computing Tanimoto distance matrix...")
-    tani_dist = dm.tanimoto(fps)
+    fps = calc_ecfp_fingerprints(base_mols, ecfp_radius)
     print("Done")
-    # Draw a UMAP projection based on Tanimoto distance
-    mapper = umap.UMAP(n_neighbors=10, n_components=2, metric='precomputed', random_state=17)
-    reps = mapper.fit_transform(tani_dist)
-    rep_df = pd.DataFrame.from_records(reps, columns=['x', 'y'])
-    rep_df['compound_id'] = compound_ids
-    if out_dir is not None:
-        pdf_path = '%s/%s_tani_umap_proj.pdf' % (out_dir, file_prefix)
-        pdf = PdfPages(pdf_path)
-    fig, ax = plt.subplots(figsize=(12,12))
-    sns.scatterplot(x='x', y='y', data=rep_df, ax=ax)
-    ax.set_title("%s, 2D projection based on Tanimoto distance" % title_prefix)
-
-    main_rep_df = rep_df[(rep_df.x > -20) & (rep_df.y > -20)]
-    fig, ax = plt.subplots(figsize=(12,12))
-    sns.scatterplot(x='x', y='y', data=main_rep_df, ax=ax)
-    ax.set_title("%s, main portion, 2D projection based on Tanimoto distance" % title_prefix)
-    if out_dir is not None:
-        pdf.savefig(fig)
 
-    pdf.close()
-
-    # Draw a cluster heatmap based on Tanimoto distance
-    tani_linkage = linkage(tani_dist, method='complete')
-    tani_df = pd.DataFrame(tani_dist, columns=compound_ids, index=compound_ids)
-    if out_dir is not None:
-        pdf_path = '%s/%s_tanimoto_clustermap.pdf' % (out_dir, file_prefix)
-        pdf = PdfPages(pdf_path)
-    g = sns.clustermap(tani_df, row_linkage=tani_linkage, col_linkage=tani_linkage, figsize=(12,12), cmap='plasma')
-    if out_dir is not None:
-        pdf.savefig(g.fig)
-        pdf.close()
+    tanimoto_umap_heatmap(fps, compound_ids, out_dir, file_prefix, title_prefix, main_xy_min=-20)
 
 
 
@@ -319,42 +410,36 @@ def compare_solubility_datasets(ecfp_radius=6):
     del_smiles_strs = del_cmpd_df[smiles_col].values
 
     # Strip salts, canonicalize SMILES strings and create RDKit Mol objects
-    base_mols = [struct_utils.base_mol_from_smiles(smiles) for smiles in del_smiles_strs]
+    base_mols = calc_base_mols(del_smiles_strs)
     for i, mol in enumerate(base_mols):
         if mol is None:
             print('Unable to get base molecule for compound %d = %s' % (i, del_compound_ids[i]))
     base_smiles = [Chem.MolToSmiles(mol) for mol in base_mols]
-    del_fps = [AllChem.GetMorganFingerprintAsBitVect(mol, ecfp_radius, 1024) for mol in base_mols if mol is not None]
+    del_fps = fingerprint_array(calc_ecfp_fingerprints(base_mols, ecfp_radius))
 
 
     gsk_cmpd_file = '%s/ATOM_GSK_Solubility_Aqueous.csv' % data_dir
     gsk_cmpd_df = pd.read_csv(gsk_cmpd_file, index_col=False)
-    gsk_smiles_strs = gsk_cmpd_df[smiles_col].values
     gsk_id_col = 'compound_id'
     # Check for common structures between datasets
-    dup_smiles = list(set(gsk_smiles_strs) & set(del_smiles_strs))
-    print("GSK and Delaney compound sets have %d SMILES strings in common" % len(dup_smiles))
-    if len(dup_smiles) > 0:
-        gsk_cmpd_df = gsk_cmpd_df[~gsk_cmpd_df.rdkit_smiles.isin(dup_smiles)]
+    is_dup = gsk_cmpd_df.rdkit_smiles.isin(del_smiles_strs)
+    print("GSK and Delaney compound sets have %d SMILES strings in common" % is_dup.sum())
+    gsk_cmpd_df = gsk_cmpd_df[~is_dup]
     gsk_smiles_strs = gsk_cmpd_df[smiles_col].values
     gsk_compound_ids = gsk_cmpd_df[gsk_id_col].values
-    base_mols = [struct_utils.base_mol_from_smiles(smiles) for smiles in gsk_smiles_strs]
+    base_mols = calc_base_mols(gsk_smiles_strs)
     for i, mol in enumerate(base_mols):
         if mol is None:
             print('Unable to get base molecule for compound %d = %s' % (i, del_compound_ids[i]))
     base_smiles = [Chem.MolToSmiles(mol) for mol in base_mols]
-    gsk_fps = [AllChem.GetMorganFingerprintAsBitVect(mol, ecfp_radius, 1024) for mol in base_mols if mol is not None]
+    gsk_fps = fingerprint_array(calc_ecfp_fingerprints(base_mols, ecfp_radius))
 
     # Train a UMAP projector with Delaney set, then use it to project both data sets
     del_mapper = umap.UMAP(n_neighbors=10, n_components=2, metric='jaccard', random_state=17)
     del_reps = del_mapper.fit_transform(del_fps)
     gsk_reps = del_mapper.transform(gsk_fps)
-    del_rep_df = pd.DataFrame.from_records(del_reps, columns=['x', 'y'])
-    del_rep_df['compound_id'] = del_compound_ids
-    del_rep_df['dataset'] = 'Delaney'
-    gsk_rep_df = pd.DataFrame.from_records(gsk_reps, columns=['x', 'y'])
-    gsk_rep_df['compound_id'] = gsk_compound_ids
-    gsk_rep_df['dataset'] = 'GSK Aq Sol'
+    del_rep_df = pd.DataFrame({'x' : del_reps[:,0], 'y' : del_reps[:,1], 'compound_id' : del_compound_ids, 'dataset' : 'Delaney'})
+    gsk_rep_df = pd.DataFrame({'x' : gsk_reps[:,0], 'y' : gsk_reps[:,1], 'compound_id' : gsk_compound_ids, 'dataset' : 'GSK Aq Sol'})
     rep_df = pd.concat((del_rep_df, gsk_rep_df), ignore_index=True)
     dataset_pal = {'Delaney' : 'forestgreen', 'GSK Aq Sol' : 'orange'}
     pdf_path = '%s/delaney_gsk_aq_sol_umap_proj.pdf' % out_dir
@@ -369,12 +454,8 @@ def compare_solubility_datasets(ecfp_radius=6):
     gsk_mapper = umap.UMAP(n_neighbors=10, n_components=2, metric='jaccard', random_state=17)
     gsk_reps = gsk_mapper.fit_transform(gsk_fps)
     del_reps = gsk_mapper.transform(del_fps)
-    del_rep_df = pd.DataFrame.from_records(del_reps, columns=['x', 'y'])
-    del_rep_df['compound_id'] = del_compound_ids
-    del_rep_df['dataset'] = 'Delaney'
-    gsk_rep_df = pd.DataFrame.from_records(gsk_reps, columns=['x', 'y'])
-    gsk_rep_df['compound_id'] = gsk_compound_ids
-    gsk_rep_df['dataset'] = 'GSK Aq Sol'
+    del_rep_df = pd.DataFrame({'x' : del_reps[:,0], 'y' : del_reps[:,1], 'compound_id' : del_compound_ids, 'dataset' : 'Delaney'})
+    gsk_rep_df = pd.DataFrame({'x' : gsk_reps[:,0], 'y' : gsk_reps[:,1], 'compound_id' : gsk_compound_ids, 'dataset' : 'GSK Aq Sol'})
     rep_df = pd.concat((gsk_rep_df, del_rep_df), ignore_index=True)
     dataset_pal = {'Delaney' : 'forestgreen', 'GSK Aq Sol' : 'orange'}
     pdf_path = '%s/gsk_aq_sol_delaney_umap_proj.pdf' % out_dir
@@ -405,43 +486,37 @@ def compare_obach_gsk_aq_sol(ecfp_radius=6):
     obach_smiles_strs = obach_cmpd_df[smiles_col].values
 
     # Strip salts, canonicalize SMILES strings and create RDKit Mol objects
-    base_mols = [struct_utils.base_mol_from_smiles(smiles) for smiles in obach_smiles_strs]
+    base_mols = calc_base_mols(obach_smiles_strs)
     for i, mol in enumerate(base_mols):
         if mol is None:
             print('Unable to get base molecule for compound %d = %s' % (i, obach_compound_ids[i]))
     base_smiles = [Chem.MolToSmiles(mol) for mol in base_mols]
-    obach_fps = [AllChem.GetMorganFingerprintAsBitVect(mol, ecfp_radius, 1024) for mol in base_mols if mol is not None]
+    obach_fps = fingerprint_array(calc_ecfp_fingerprints(base_mols, ecfp_radius))
 
     # Load the GSK dataset
     gsk_data_dir = '/ds/data/gsk_data/GSK_datasets/solubility'
     gsk_cmpd_file = '%s/ATOM_GSK_Solubility_Aqueous.csv' % gsk_data_dir
     gsk_cmpd_df = pd.read_csv(gsk_cmpd_file, index_col=False)
-    gsk_smiles_strs = gsk_cmpd_df[smiles_col].values
     gsk_id_col = 'compound_id'
     # Check for common structures between datasets
-    dup_smiles = list(set(gsk_smiles_strs) & set(obach_smiles_strs))
-    print("GSK and Obach compound sets have %d SMILES strings in common" % len(dup_smiles))
-    if len(dup_smiles) > 0:
-        gsk_cmpd_df = gsk_cmpd_df[~gsk_cmpd_df.rdkit_smiles.isin(dup_smiles)]
+    is_dup = gsk_cmpd_df.rdkit_smiles.isin(obach_smiles_strs)
+    print("GSK and Obach compound sets have %d SMILES strings in common" % is_dup.sum())
+    gsk_cmpd_df = gsk_cmpd_df[~is_dup]
     gsk_smiles_strs = gsk_cmpd_df[smiles_col].values
     gsk_compound_ids = gsk_cmpd_df[gsk_id_col].values
-    base_mols = [struct_utils.base_mol_from_smiles(smiles) for smiles in gsk_smiles_strs]
+    base_mols = calc_base_mols(gsk_smiles_strs)
     for i, mol in enumerate(base_mols):
         if mol is None:
             print('Unable to get base molecule for compound %d = %s' % (i, obach_compound_ids[i]))
     base_smiles = [Chem.MolToSmiles(mol) for mol in base_mols]
-    gsk_fps = [AllChem.GetMorganFingerprintAsBitVect(mol, ecfp_radius, 1024) for mol in base_mols if mol is not None]
+    gsk_fps = fingerprint_array(calc_ecfp_fingerprints(base_mols, ecfp_radius))
 
     # Train a UMAP projector with Obach set, then use it to project both data sets
     obach_mapper = umap.UMAP(n_neighbors=10, n_components=2, metric='jaccard', random_state=17)
     obach_reps = obach_mapper.fit_transform(obach_fps)
     gsk_reps = obach_mapper.transform(gsk_fps)
-    obach_rep_df = pd.DataFrame.from_records(obach_reps, columns=['x', 'y'])
-    obach_rep_df['compound_id'] = obach_compound_ids
-    obach_rep_df['dataset'] = 'Obach'
-    gsk_rep_df = pd.DataFrame.from_records(gsk_reps, columns=['x', 'y'])
-    gsk_rep_df['compound_id'] = gsk_compound_ids
-    gsk_rep_df['dataset'] = 'GSK Aq Sol'
+    obach_rep_df = pd.DataFrame({'x' : obach_reps[:,0], 'y' : obach_reps[:,1], 'compound_id' : obach_compound_ids, 'dataset' : 'Obach'})
+    gsk_rep_df = pd.DataFrame({'x' : gsk_reps[:,0], 'y' : gsk_reps[:,1], 'compound_id' : gsk_compound_ids, 'dataset' : 'GSK Aq Sol'})
     rep_df = pd.concat((obach_rep_df, gsk_rep_df), ignore_index=True)
     #main_rep_df = rep_df[(rep_df.x > -20) & (rep_df.y > -20)]
     dataset_pal = {'Obach' : 'blue', 'GSK Aq Sol' : 'orange'}
@@ -577,17 +652,13 @@ def liability_dset_diversity(bucket='gsk_ml', feat_type='descriptors', dist_metr
             log.warning("Too many compounds to compute distance matrix: %d" % num_cmpds)
             return
         # plot_dataset_dist_distr(model_dataset.dataset, feat_type, dist_metric, params.response_cols, **metric_kwargs)
-        dists = cd.calc_dist_diskdataset('descriptors', dist_metric, model_dataset.dataset, calc_type='all')
-        import scipy
-        dists = scipy.spatial.distance.squareform(dists)
+        dist_cond = cd.calc_dist_diskdataset('descriptors', dist_metric, model_dataset.dataset, calc_type='all')
         res_dir = '/ds/projdata/gsk_data/model_analysis/'
         plt_dir = '%s/Plots' % res_dir
         file_prefix = dset_key.split('/')[-1].rstrip('.csv')
-        mcs_linkage = linkage(dists, method='complete')
+        # linkage takes the condensed distances directly; only expand to square form for the heatmap
+        mcs_linkage = linkage(dist_cond, method='complete')
+        dists = squareform(dist_cond)
         pdf_path = '%s/%s_mcs_clustermap.pdf' % (plt_dir, file_prefix)
-        pdf = PdfPages(pdf_path)
-        g = sns.clustermap(dists, row_linkage=mcs_linkage, col_linkage=mcs_linkage, figsize=(12, 12), cmap='plasma')
-        if plt_dir is not None:
-            pdf.savefig(g.fig)
-            pdf.close()
+        plot_dist_heatmap(dists, mcs_linkage, pdf_path)
         return dists
@@ -6,16 +6,22 @@ Contains class ModelWrapper and its subclasses, which are wrappers for DeepChem
 
 import logging
 import os
+import queue
+from collections import OrderedDict
 import shutil
+import threading
 import joblib
-import pdb
 
 import deepchem as dc
 import numpy as np
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+from packaging.version import parse as parse_version
 from deepchem.models.tensorgraph import fcnet
+from deepchem.utils.save import load_from_disk
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.ensemble import RandomForestRegressor
+from sklearn.base import clone
 
 try:
     import xgboost as xgb
@@ -23,9 +29,25 @@ try:
 except ImportError:
     xgboost_supported = False
 
-import pickle
+try:
+    import numba
+    numba_supported = True
+except ImportError:
+    numba_supported = False
+
+try:
+    from sklearnex.ensemble import RandomForestClassifier as IntelRandomForestClassifier
+    from sklearnex.ensemble import RandomForestRegressor as IntelRandomForestRegressor
+    sklearnex_supported = True
+except ImportError:
+    sklearnex_supported = False
+
 import yaml
-import glob
+# Use the libyaml-based loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
 from datetime import datetime
 
 from atomsci.ddm.utils import datastore_functions as dsf
@@ -50,31 +72,241 @@ def create_model_wrapper(params, featurizer, ds_client=None):
     Raises:
         ValueError: Only params.model_type = 'NN', 'RF' or 'xgboost' is supported.
     """
-    if params.model_type == 'NN':
-        return DCNNModelWrapper(params, featurizer, ds_client)
-    elif params.model_type == 'RF':
-        return DCRFModelWrapper(params, featurizer, ds_client)
-    elif params.model_type == 'xgboost':
-        if not xgboost_supported:
-            raise Exception("Unable to import xgboost. \
-                             xgboost package needs to be installed to use xgboost model. \
-                             Installatin: \
-                             from pip: pip3 install xgboost.\
-                             livermore compute (lc): /usr/mic/bio/anaconda3/bin/pip install xgboost --user \
-                             twintron-blue (TTB): /opt/conda/bin/pip install xgboost --user/ \ "
-                            )
-        elif float(xgb.__version__) < 0.9:
-            raise Exception(f"xgboost required to be >= 0.9 for GPU support. \
-                             current version = {float(xgb.__version__)} \
-                             installatin: \
-                             from pip: pip3 install --upgrade xgboost \
-                             livermore compute (lc): /usr/mic/bio/anaconda3/bin/pip install --upgrade xgboost --user \
-                             twintron-blue (TTB): /opt/conda/bin/pip install --upgrade xgboost --user/ "
-                            )
+    wrapper_class = _model_wrapper_classes.get(params.model_type)
+    if wrapper_class is None:
+        raise ValueError("Unknown model_type %s" % params.model_type)
+    return wrapper_class(params, featurizer, ds_client)
+
+# ****************************************************************************************
+def _prefetch(generator, buffer_size=8):
+    """Runs generator in a background thread, keeping up to buffer_size of its items ready so that
+    producing the next item overlaps with whatever the caller does with the current one. Exceptions
+    raised by the generator are re-raised in the calling thread.
+    """
+    items = queue.Queue(maxsize=buffer_size)
+    end_marker = object()
+
+    def produce():
+        try:
+            for item in generator:
+                items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+        items.put((end_marker, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is end_marker:
+            break
+        yield item
+
+# ****************************************************************************************
+def _has_default_transform(transformer):
+    """Returns True if transformer uses the DeepChem Transformer.transform method (or one of the subclass
+    overrides that just delegate to it), so that applying it to a dataset amounts to calling its
+    transform_array method on each shard.
+    """
+    return type(transformer).transform in (dc.trans.Transformer.transform,
+                                           dc.trans.NormalizationTransformer.transform,
+                                           trans.UMAPTransformer.transform)
+
+# ****************************************************************************************
+# Directories already created by this process, so that repeated wrapper construction doesn't repeat the mkdir calls
+_created_dirs = set()
+
+def _ensure_dirs_once(*dirs):
+    """Creates each of the given directories, along with any missing parents, unless this process has already
+    done so. A directory created earlier costs a single stat call, which also catches directories that have
+    been removed since (e.g., by test cleanup code).
+    """
+    for dirname in dirs:
+        if dirname not in _created_dirs or not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+            _created_dirs.add(dirname)
+
+# ****************************************************************************************
+def _replace_dir(src_dir, dest_dir):
+    """Moves the completely populated directory src_dir to dest_dir, replacing any existing dest_dir. The swap
+    is done by renaming directories, so that dest_dir never holds a partial mix of old and new files.
+    """
+    if not os.path.exists(dest_dir):
+        os.replace(src_dir, dest_dir)
+        return
+    old_dir = '%s.old' % dest_dir
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    os.replace(dest_dir, old_dir)
+    os.replace(src_dir, dest_dir)
+    shutil.rmtree(old_dir)
+
+# ****************************************************************************************
+def _clone_dir(src_dir, dest_dir):
+    """Replaces dest_dir with a copy of the flat directory src_dir. Files are hard-linked rather than copied
+    where the filesystem allows it; this is safe for saved model directories, since they are only ever
+    replaced as a whole by _replace_dir, never modified in place.
+    """
+    tmp_dir = '%s.tmp' % dest_dir
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            dest_file = os.path.join(tmp_dir, entry.name)
+            try:
+                os.link(entry.path, dest_file)
+            except OSError:
+                _copy_file(entry.path, dest_file)
+    _replace_dir(tmp_dir, dest_dir)
+
+# ****************************************************************************************
+def _copy_file(src_file, dest_file):
+    """Copies the contents of src_file to dest_file, without the file metadata that shutil.copy2 also copies.
+    Where available, os.sendfile is used so that the data is copied within the kernel instead of through
+    Python buffers; otherwise falls back to shutil.copyfile.
+    """
+    if hasattr(os, 'sendfile'):
+        with open(src_file, 'rb') as fin, open(dest_file, 'wb') as fout:
+            size = os.fstat(fin.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(fout.fileno(), fin.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                # Some filesystems don't support sendfile between regular files
+                offset = 0
+        if offset == size:
+            return
+    shutil.copyfile(src_file, dest_file)
+
+# ****************************************************************************************
+def _load_feature_matrix(dataset, dtype=None):
+    """Returns the feature matrix of dataset for prediction by the sklearn and xgboost models, which only
+    read it. For a DiskDataset, uncompressed .npy shards are memory-mapped rather than read into memory;
+    other shards are read one at a time directly into a preallocated array, so that we never hold both the
+    list of shards and their concatenation, as dataset.X does. If dtype is given, the matrix is converted to
+    it (while it is assembled from the shards, where possible).
+    """
+    if not isinstance(dataset, dc.data.DiskDataset) or len(dataset.metadata_df) == 0:
+        return np.asarray(dataset.X, dtype=dtype)
+    shard_files = [os.path.join(dataset.data_dir, xfile) for xfile in dataset.metadata_df['X']]
+    if len(shard_files) == 1 and shard_files[0].endswith('.npy'):
+        return np.asarray(np.load(shard_files[0], mmap_mode='r'), dtype=dtype)
+    X = None
+    start = 0
+    for shard_file in shard_files:
+        if shard_file.endswith('.npy'):
+            X_shard = np.load(shard_file, mmap_mode='r')
         else:
-            return DCxgboostModelWrapper(params, featurizer, ds_client)
+            X_shard = np.asarray(load_from_disk(shard_file))
+        if X is None:
+            X = np.empty((len(dataset),) + X_shard.shape[1:], dtype=(dtype or X_shard.dtype))
+        X[start:start+X_shard.shape[0]] = X_shard
+        start += X_shard.shape[0]
+    assert start == X.shape[0]
+    return X
+
+# ****************************************************************************************
+def _per_tree_std(trees, X, transformers, n_jobs, block_size=64):
+    """Returns the standard deviation (with ddof=0) over the given trees of their untransformed predictions
+    for the compounds in X, with shape (ncmpds, ntasks).
+
+    The trees are predicted block_size at a time, and each block's mean and sum of squared deviations are
+    merged into running totals (Chan et al.'s pairwise update), so that we never hold the predictions of
+    every tree at once. Within a block, the trees are predicted concurrently in n_jobs threads (tree
+    prediction releases the GIL) and untransformed together as a single (ntrees*ncmpds, ntasks) array.
+    """
+    # Each tree needs a C-ordered float32 array, so make sure X is one before passing it to all of them
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    ncmpds = X.shape[0]
+    count = 0
+    mean = m2 = None
+    with joblib.Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+        for start in range(0, len(trees), block_size):
+            block_trees = trees[start:start+block_size]
+            block_pred = np.stack(parallel(joblib.delayed(tree.predict)(X) for tree in block_trees))
+            nblock = block_pred.shape[0]
+            block_pred = block_pred.reshape((nblock*ncmpds, -1))
+            if transformers:
+                block_pred = dc.trans.undo_transforms(block_pred, transformers)
+            block_pred = block_pred.reshape((nblock, ncmpds, -1)).astype(np.float64, copy=False)
+            block_mean = block_pred.mean(axis=0)
+            block_m2 = ((block_pred - block_mean)**2).sum(axis=0)
+            if count == 0:
+                mean, m2 = block_mean, block_m2
+            else:
+                delta = block_mean - mean
+                total = count + nblock
+                mean += delta * (nblock / total)
+                m2 += block_m2 + delta**2 * (count * nblock / total)
+            count += nblock
+    return np.sqrt(m2 / count)
+
+# ****************************************************************************************
+def _binomial_std(prob, n):
+    """Returns sqrt(prob * (1-prob) / n), the normal approximation to the standard error of a proportion
+    estimated from n samples. The result is computed in a single output buffer, without the temporary arrays
+    that evaluating the expression directly would allocate; with numba, in a single parallel pass over prob.
+    """
+    if numba_supported:
+        prob = np.ascontiguousarray(prob)
+        std = np.empty_like(prob)
+        _binomial_std_numba(prob.reshape(-1), float(n), std.reshape(-1))
+        return std
+    std = np.subtract(1., prob)
+    np.multiply(std, prob, out=std)
+    np.divide(std, n, out=std)
+    return np.sqrt(std, out=std)
+
+if numba_supported:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _binomial_std_numba(prob, n, out):
+        """Numba version of _binomial_std, for 1D prob and out."""
+        for i in numba.prange(prob.shape[0]):
+            out[i] = np.sqrt(prob[i] * (1. - prob[i]) / n)
+
+# ****************************************************************************************
+def _in_memory_dataset(dataset, X_dtype=None):
+    """Returns a NumpyDataset holding the contents of dataset, if it is a DiskDataset, so that a dataset
+    that is predicted repeatedly (e.g., once per training epoch) is only read from disk once. If X_dtype is
+    given, the features are converted to it.
+    """
+    if X_dtype is None:
+        if not isinstance(dataset, dc.data.DiskDataset):
+            return dataset
+        X = dataset.X
     else:
-        raise ValueError("Unknown model_type %s" % params.model_type)
+        X = _load_feature_matrix(dataset, X_dtype)
+    return dc.data.NumpyDataset(X, dataset.y, dataset.w, dataset.ids)
+
+# ****************************************************************************************
+class _XGBModelFactory(object):
+    """Stands in for the estimator class in DeepChem's XGBoostModel.model_class. After its parameter search,
+    XGBoostModel.fit() replaces the estimator with model_class(**best_param), which would reset every argument
+    outside the search grid (tree_method, n_jobs, objective, etc.) to the xgboost default. This creates the new
+    estimator with the arguments of the original one, updated with the search results.
+    """
+    def __init__(self, xgb_model):
+        self.xgb_class = type(xgb_model)
+        self.xgb_params = xgb_model.get_params()
+
+    def __call__(self, **params):
+        xgb_params = dict(self.xgb_params)
+        xgb_params.update(params)
+        return self.xgb_class(**xgb_params)
+
+# ****************************************************************************************
+# Maximum number of datasets whose predictions are cached by each ModelWrapper
+_PRED_CACHE_SIZE = 4
+
+# Names of the attributes holding the PerfData for each dataset subset
+_subset_perf_data_attrs = dict(train='train_perf_data', valid='valid_perf_data', test='test_perf_data')
 
 # ****************************************************************************************
 
@@ -120,9 +352,12 @@ class ModelWrapper(object):
         self.log = logging.getLogger('ATOM')
         self.output_dir = self.params.output_dir
         self.model_dir = os.path.join(self.output_dir, 'model')
-        os.makedirs(self.model_dir, exist_ok=True)
+        _ensure_dirs_once(self.model_dir)
         self.transformers = []
         self.transformers_x = []
+        self._n_features = None
+        # Recent results of _generate_predictions_in_chunks(reuse=True), keyed by id(dataset)
+        self._pred_cache = OrderedDict()
 
         # ****************************************************************************************
 
@@ -212,7 +447,9 @@ class ModelWrapper(object):
                     self.log.warning("Error when trying to save transformers to datastore:\n%s" % str(e))
             else:
                 self.params.transformer_key = os.path.join(self.output_dir, 'transformers.pkl')
-                pickle.dump((self.transformers, self.transformers_x), open(self.params.transformer_key, 'wb'))
+                # joblib stores the transformers' NumPy arrays as raw buffers rather than pickling them,
+                # and compression keeps large feature transformers small on disk.
+                joblib.dump((self.transformers, self.transformers_x), self.params.transformer_key, compress=3)
                 self.log.info("Wrote transformers to %s" % self.params.transformer_key)
                 self.params.transformer_bucket = self.params.bucket
 
@@ -229,27 +466,40 @@ class ModelWrapper(object):
             transformed_dataset: The trasformed DeepChem DiskDataset
 
         """
-        transformed_dataset = dataset
         if len(self.transformers) > 0:
             self.log.info("Transforming response data")
-            for transformer in self.transformers:
-                transformed_dataset = transformer.transform(transformed_dataset)
         if len(self.transformers_x) > 0:
             self.log.info("Transforming feature data")
-            for transformer in self.transformers_x:
-                transformed_dataset = transformer.transform(transformed_dataset)
+        transformers = self.transformers + self.transformers_x
+        if len(transformers) == 0:
+            return dataset
+
+        if all(_has_default_transform(transformer) for transformer in transformers):
+            # Apply all the transformations to each shard in turn, so that the dataset is read and
+            # written only once rather than once per transformer.
+            def fused_transform_array(X, y, w):
+                for transformer in transformers:
+                    X, y, w = transformer.transform_array(X, y, w)
+                return X, y, w
+            return dataset.transform(fused_transform_array)
 
+        transformed_dataset = dataset
+        for transformer in transformers:
+            transformed_dataset = transformer.transform(transformed_dataset)
         return transformed_dataset
         # ****************************************************************************************
 
     def get_num_features(self):
         """Returns the number of dimensions of the feature space, taking both featurization method
-        and transformers into account.
+        and transformers into account. The value is computed on the first call and cached, since it
+        doesn't change over the lifetime of the wrapper.
         """
-        if self.params.feature_transform_type == 'umap':
-            return self.params.umap_dim
-        else:
-            return self.featurization.get_feature_count()
+        if self._n_features is None:
+            if self.params.feature_transform_type == 'umap':
+                self._n_features = self.params.umap_dim
+            else:
+                self._n_features = self.featurization.get_feature_count()
+        return self._n_features
 
         # ****************************************************************************************
 
@@ -270,6 +520,19 @@ class ModelWrapper(object):
         """
         return perf_data.get_prediction_results()
 
+    # ****************************************************************************************
+    def _subset_perf_data(self, subset):
+        """Returns the PerfData attribute (or, for NN models, the per-epoch list of PerfData objects) for the
+        training, validation or test subset.
+
+        Raises:
+            ValueError: If subset not in ['train','valid','test']
+        """
+        try:
+            return getattr(self, _subset_perf_data_attrs[subset])
+        except KeyError:
+            raise ValueError("Unknown dataset subset '%s'" % subset)
+
         # ****************************************************************************************
     def get_test_perf_data(self, model_dir, model_dataset):
         """Returns the predicted values and metrics for the current test dataset against
@@ -293,10 +556,65 @@ class ModelWrapper(object):
         # doesn't untransform them again.
         perf_data = perf.create_perf_data(self.params.prediction_type, model_dataset, self.transformers, 'test', transformed=False)
         test_dset = model_dataset.test_dset
-        test_preds, test_stds = self.generate_predictions(test_dset)
+        test_preds, test_stds = self._generate_predictions_in_chunks(test_dset)
         _ = perf_data.accumulate_preds(test_preds, test_dset.ids, test_stds)
         return perf_data
 
+        # ****************************************************************************************
+    def _generate_predictions_in_chunks(self, dataset, reuse=False):
+        """Generates predictions for dataset by calling generate_predictions on successive chunks of
+        params.inference_batch_size compounds, and assembles the results into arrays covering the whole
+        dataset. This keeps the memory used while predicting (feature matrices, per-tree predictions for
+        RF uncertainties, etc.) proportional to the chunk size rather than the dataset size.
+
+        Args:
+            dataset (Dataset): The dataset to generate predictions for
+            reuse (bool): If True, return the cached results from an earlier call with reuse=True for the same
+                dataset object, if there was one since the model was last trained or reloaded; otherwise cache
+                the new results.
+
+        Returns:
+            (pred, std): numpy arrays containing predictions and standard deviation estimates (or None), in
+            the same compound order as dataset.ids
+        """
+        if reuse:
+            cached = self._pred_cache.get(id(dataset))
+            # The cache holds a reference to the dataset, so its id can't have been reused by another object
+            if cached is not None and cached[0] is dataset:
+                self._pred_cache.move_to_end(id(dataset))
+                return cached[1]
+            result = self._generate_predictions_in_chunks(dataset)
+            self._pred_cache[id(dataset)] = (dataset, result)
+            while len(self._pred_cache) > _PRED_CACHE_SIZE:
+                self._pred_cache.popitem(last=False)
+            return result
+        chunk_size = self.params.inference_batch_size
+        ncmpds = len(dataset)
+        if not chunk_size or ncmpds <= chunk_size:
+            return self.generate_predictions(dataset)
+        pred, std = None, None
+        start = 0
+        for X, y, w, ids in dataset.iterbatches(batch_size=chunk_size, deterministic=True, pad_batches=False):
+            chunk_pred, chunk_std = self.generate_predictions(dc.data.NumpyDataset(X, y, w, ids))
+            if pred is None:
+                pred = np.empty((ncmpds,) + chunk_pred.shape[1:], dtype=chunk_pred.dtype)
+                if chunk_std is not None:
+                    std = np.empty((ncmpds,) + chunk_std.shape[1:], dtype=chunk_std.dtype)
+            end = start + chunk_pred.shape[0]
+            pred[start:end] = chunk_pred
+            if std is not None:
+                std[start:end] = chunk_std
+            start = end
+        assert start == ncmpds
+        return pred, std
+
+    # ****************************************************************************************
+    def _clear_pred_cache(self):
+        """Discards the cached predictions, which are no longer valid once the model has been retrained or
+        reloaded.
+        """
+        self._pred_cache.clear()
+
         # ****************************************************************************************
     def get_test_pred_results(self, model_dir, model_dataset):
         """Returns predicted values and metrics for the current test dataset against the version
@@ -331,7 +649,9 @@ class ModelWrapper(object):
         # generate_predictions are already untransformed, so that perf_data.get_prediction_results()
         # doesn't untransform them again.
         perf_data = perf.create_perf_data(self.params.prediction_type, model_dataset, self.transformers, 'full', transformed=False)
-        full_preds, full_stds = self.generate_predictions(model_dataset.dataset)
+        # The full dataset's performance is often requested repeatedly for the same model (e.g., once for each
+        # plot in perf_plots), so its predictions are cached
+        full_preds, full_stds = self._generate_predictions_in_chunks(model_dataset.dataset, reuse=True)
         _ = perf_data.accumulate_preds(full_preds, model_dataset.dataset.ids, full_stds)
         return perf_data
 
@@ -389,21 +709,26 @@ class DCNNModelWrapper(ModelWrapper):
             model_dir (str): The subdirectory under output_dir that contains the model. Created in setup_model_dirs.
             best_model_dir (str): The subdirectory under output_dir that contains the best model. Created in setup_model_dirs
             baseline_model_dir (str): The subdirectory under output_dir that contains the baseline epoch model.
-            g: The tensorflow graph object
-            sess: The tensor flow graph session
+            tf_config: The tensorflow ConfigProto used for the model's session
             model: The dc.models.GraphConvModel, fcnet.MultitaskRegressor, or fcnet.MultitaskClassifier object, as specified by the params attribute
 
         Created in train:
             data (ModelDataset): contains the dataset, set in pipeline
             best_epoch (int): Initialized as None, keeps track of the epoch with the best validation score
-            train_perf_data (np.array of PerfData): Initialized as an empty array, 
-                contains the predictions and performance of the training dataset
-            valid_perf_data (np.array of PerfData): Initialized as an empty array,
-                contains the predictions and performance of the validation dataset
-            train_epoch_perfs (np.array of dicts): Initialized as an empty array,
-                contains a list of dictionaries of predicted values and metrics on the training dataset
-            valid_epoch_perfs (np.array of dicts): Initialized as an empty array,
-                contains a list of dictionaries of predicted values and metrics on the validation dataset
+            train_perf_data (list of PerfData): One PerfData object per epoch, containing the predictions and
+                performance of the training dataset
+            valid_perf_data (list of PerfData): One PerfData object per epoch, containing the predictions and
+                performance of the validation dataset
+            test_perf_data (list of PerfData): One PerfData object per epoch, containing the predictions and
+                performance of the test dataset
+            train_epoch_perfs, valid_epoch_perfs, test_epoch_perfs (np.array of float): Performance metric
+                values for each epoch on the training, validation and test datasets. Training and test set values
+                are NaN for epochs where those sets weren't evaluated.
+            train_epoch_perf_stds, valid_epoch_perf_stds, test_epoch_perf_stds (np.array of float): Standard
+                deviations of the metric values across folds for each epoch
+            train_epoch_losses (np.array of float): Training loss for each epoch, averaged over folds
+            model_choice_scores (np.array of float): Validation set model choice score for each epoch, used to
+                pick best_epoch with a single argmax
 
     """
 
@@ -421,16 +746,14 @@ class DCNNModelWrapper(ModelWrapper):
             output_dir (str): The parent path of the model directory
             transformers (list): Initialized as an empty list, stores the transformers on the response col
             transformers_x (list): Initialized as an empty list, stores the transformers on the featurizers
-            g: The tensorflow graph object
-            sess: The tensor flow graph session
+            tf_config: The tensorflow ConfigProto used for the model's session
             model: The dc.models.GraphConvModel, fcnet.MultitaskRegressor, or fcnet.MultitaskClassifier object, as specified by the params attribute
 
 
         """
         super().__init__(params, featurizer, ds_client)
-        self.g = tf.Graph()
-        self.sess = tf.Session(graph=self.g)
-        n_features = self.get_num_features()
+        # The DeepChem models create their own graph and session; we just supply the session configuration.
+        self.tf_config = self._create_tf_config()
 
         if self.params.featurizer == 'graphconv':
 
@@ -445,25 +768,6 @@ class DCNNModelWrapper(ModelWrapper):
                 else:
                     self.params.dropouts = [0.0] * len(self.params.layer_sizes)
 
-            # TODO: Need to check that GraphConvModel params are actually being used
-            self.model = dc.models.GraphConvModel(
-                self.params.num_model_tasks,
-                batch_size=self.params.batch_size,
-                learning_rate=self.params.learning_rate,
-                learning_rate_decay_time=1000,
-                optimizer_type=self.params.optimizer_type,
-                beta1=0.9,
-                beta2=0.999,
-                model_dir=self.model_dir,
-                mode=self.params.prediction_type,
-                tensorboard=False,
-                uncertainty=self.params.uncertainty,
-                graph_conv_layers=self.params.layer_sizes[:-1],
-                dense_layer_size=self.params.layer_sizes[-1],
-                dropout=self.params.dropouts,
-                penalty=self.params.weight_decay_penalty,
-                penalty_type=self.params.weight_decay_penalty_type)
-
         else:
             # Set defaults for layer sizes and dropouts, if not specified by caller. Note that
             # default layer sizes depend on the featurizer used.
@@ -486,76 +790,16 @@ class DCNNModelWrapper(ModelWrapper):
             if self.params.bias_init_consts is None:
                 self.params.bias_init_consts = [1.0] * len(self.params.layer_sizes)
 
-            if self.params.prediction_type == 'regression':
-
-                # TODO: Need to check that MultitaskRegressor params are actually being used
-                self.model = fcnet.MultitaskRegressor(
-                    self.params.num_model_tasks,
-                    n_features,
-                    layer_sizes=self.params.layer_sizes,
-                    dropouts=self.params.dropouts,
-                    weight_init_stddevs=self.params.weight_init_stddevs,
-                    bias_init_consts=self.params.bias_init_consts,
-                    learning_rate=self.params.learning_rate,
-                    weight_decay_penalty=self.params.weight_decay_penalty,
-                    weight_decay_penalty_type=self.params.weight_decay_penalty_type,
-                    optimizer=self.params.optimizer_type,
-                    batch_size=self.params.batch_size,
-                    seed=123,
-                    verbosity='low',
-                    model_dir=self.model_dir,
-                    learning_rate_decay_time=1000,
-                    beta1=0.9,
-                    beta2=0.999,
-                    mode=self.params.prediction_type,
-                    tensorboard=False,
-                    uncertainty=self.params.uncertainty)
-
-                # print("JEA debug",self.params.num_model_tasks,n_features,self.params.layer_sizes,self.params.weight_init_stddevs,self.params.bias_init_consts,self.params.dropouts,self.params.weight_decay_penalty,self.params.weight_decay_penalty_type,self.params.batch_size,self.params.learning_rate)
-                # self.model = fcnet.MultitaskRegressor(
-                #     self.params.num_model_tasks,
-                #     n_features,
-                #     layer_sizes=self.params.layer_sizes,
-                #     weight_init_stddevs=self.params.weight_init_stddevs,
-                #     bias_init_consts=self.params.bias_init_consts,
-                #     dropouts=self.params.dropouts,
-                #     weight_decay_penalty=self.params.weight_decay_penalty,
-                #     weight_decay_penalty_type=self.params.weight_decay_penalty_type,
-                #     batch_size=self.params.batch_size,
-                #     learning_rate=self.params.learning_rate,
-                #     seed=123)
-
-            else:
-                # TODO: Need to check that MultitaskClassifier params are actually being used
-                self.model = fcnet.MultitaskClassifier(
-                    self.params.num_model_tasks,
-                    n_features,
-                    layer_sizes=self.params.layer_sizes,
-                    dropouts=self.params.dropouts,
-                    weight_init_stddevs=self.params.weight_init_stddevs,
-                    bias_init_consts=self.params.bias_init_consts,
-                    learning_rate=self.params.learning_rate,
-                    weight_decay_penalty=self.params.weight_decay_penalty,
-                    weight_decay_penalty_type=self.params.weight_decay_penalty_type,
-                    optimizer=self.params.optimizer_type,
-                    batch_size=self.params.batch_size,
-                    seed=123,
-                    verbosity='low',
-                    model_dir=self.model_dir,
-                    learning_rate_decay_time=1000,
-                    beta1=.9,
-                    beta2=.999,
-                    mode=self.params.prediction_type,
-                    tensorboard=False,
-                    n_classes=self.params.class_number)
+        self.model = self._build_model()
 
     # ****************************************************************************************
-    def recreate_model(self):
-        """Replaces the current self.model object with a new DeepChem Model object of the correct type for the
-        requested featurizer and prediction type """
+    def _build_model(self):
+        """Creates and returns a DeepChem Model object of the correct type for the requested featurizer and
+        prediction type, using the layer sizes and other model parameters in self.params."""
 
         if self.params.featurizer == 'graphconv':
-            self.model = dc.models.GraphConvModel(
+            # TODO: Need to check that GraphConvModel params are actually being used
+            return dc.models.GraphConvModel(
                 self.params.num_model_tasks,
                 batch_size=self.params.batch_size,
                 learning_rate=self.params.learning_rate,
@@ -566,6 +810,7 @@ class DCNNModelWrapper(ModelWrapper):
                 model_dir=self.model_dir,
                 mode=self.params.prediction_type,
                 tensorboard=False,
+                configproto=self.tf_config,
                 uncertainty=self.params.uncertainty,
                 graph_conv_layers=self.params.layer_sizes[:-1],
                 dense_layer_size=self.params.layer_sizes[-1],
@@ -574,9 +819,12 @@ class DCNNModelWrapper(ModelWrapper):
                 penalty_type=self.params.weight_decay_penalty_type)
 
         else:
+            # Feature count is only needed by the fully connected models
             n_features = self.get_num_features()
             if self.params.prediction_type == 'regression':
-                self.model = fcnet.MultitaskRegressor(
+
+                # TODO: Need to check that MultitaskRegressor params are actually being used
+                return fcnet.MultitaskRegressor(
                     self.params.num_model_tasks,
                     n_features,
                     layer_sizes=self.params.layer_sizes,
@@ -596,9 +844,12 @@ class DCNNModelWrapper(ModelWrapper):
                     beta2=0.999,
                     mode=self.params.prediction_type,
                     tensorboard=False,
+                    configproto=self.tf_config,
                     uncertainty=self.params.uncertainty)
+
             else:
-                self.model = fcnet.MultitaskClassifier(
+                # TODO: Need to check that MultitaskClassifier params are actually being used
+                return fcnet.MultitaskClassifier(
                     self.params.num_model_tasks,
                     n_features,
                     layer_sizes=self.params.layer_sizes,
@@ -618,8 +869,48 @@ class DCNNModelWrapper(ModelWrapper):
                     beta2=.999,
                     mode=self.params.prediction_type,
                     tensorboard=False,
+                    configproto=self.tf_config,
                     n_classes=self.params.class_number)
 
+    # ****************************************************************************************
+    def _create_tf_config(self):
+        """Returns a tf.ConfigProto for the sessions of the DeepChem models, with thread pool sizes taken
+        from params.num_intra_threads and params.num_inter_threads, XLA JIT compilation turned on if
+        params.xla_jit is set, and bfloat16 mixed precision turned on if params.precision is 'bfloat16'.
+        """
+        config = tf.ConfigProto(intra_op_parallelism_threads=self.params.num_intra_threads,
+                                inter_op_parallelism_threads=self.params.num_inter_threads)
+        if self.params.xla_jit:
+            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        if self.params.precision == 'bfloat16':
+            # The rewrite keeps numerically sensitive ops such as softmax and the losses in float32, and
+            # bfloat16 has the same exponent range as float32, so no loss scaling is needed.
+            rewrite_options = config.graph_options.rewrite_options
+            if 'auto_mixed_precision_mkl' in rewrite_options.DESCRIPTOR.fields_by_name:
+                rewrite_options.auto_mixed_precision_mkl = rewriter_config_pb2.RewriterConfig.ON
+            else:
+                self.log.warning("This version of TensorFlow doesn't support bfloat16 mixed precision; using float32.")
+        return config
+
+    # ****************************************************************************************
+    def recreate_model(self):
+        """Replaces the current self.model object with a new DeepChem Model object of the correct type for the
+        requested featurizer and prediction type """
+        self.model = self._build_model()
+
+    # ****************************************************************************************
+    # Per-epoch statistics set by train, in column order of the _epoch_stats array
+    _epoch_stat_names = ['train_epoch_perfs', 'valid_epoch_perfs', 'test_epoch_perfs', 'train_epoch_perf_stds',
+                         'valid_epoch_perf_stds', 'test_epoch_perf_stds', 'model_choice_scores', 'train_epoch_losses']
+
+    def _set_epoch_stats(self, epoch_stats):
+        """Stores the (nepochs, nstats) array of per-epoch statistics, and sets each of the attributes named
+        in _epoch_stat_names to a view of the corresponding column.
+        """
+        self._epoch_stats = epoch_stats
+        for i, name in enumerate(self._epoch_stat_names):
+            setattr(self, name, epoch_stats[:, i])
+
     # ****************************************************************************************
     def train(self, pipeline):
         """Trains a neural net model for multiple epochs, choose the epoch with the best validation
@@ -632,78 +923,167 @@ class DCNNModelWrapper(ModelWrapper):
             Sets the following attributes for DCNNModelWrapper:
                 data (ModelDataset): contains the dataset, set in pipeline
                 best_epoch (int): Initialized as None, keeps track of the epoch with the best validation score
-                train_perf_data (list of PerfData): Initialized as an empty array, 
-                    contains the predictions and performance of the training dataset
-                valid_perf_data (list of PerfData): Initialized as an empty array,
-                    contains the predictions and performance of the validation dataset
-                train_epoch_perfs (np.array): Initialized as an empty array,
-                    contains a list of dictionaries of predicted values and metrics on the training dataset
-                valid_epoch_perfs (np.array of dicts): Initialized as an empty array,
-                    contains a list of dictionaries of predicted values and metrics on the validation dataset
-        """
-        # TODO: Fix docstrings above
+                train_perf_data, valid_perf_data, test_perf_data (list of PerfData): One PerfData object per
+                    epoch, containing the predictions and performance of the training, validation and test datasets
+                train_epoch_perfs, valid_epoch_perfs, test_epoch_perfs (np.array of float): Performance metric
+                    values for each epoch on the training, validation and test datasets
+                train_epoch_perf_stds, valid_epoch_perf_stds, test_epoch_perf_stds (np.array of float): Standard
+                    deviations of the metric values across folds for each epoch
+                train_epoch_losses (np.array of float): Training loss for each epoch, averaged over folds
+                model_choice_scores (np.array of float): Validation set model choice score for each epoch
+
+        Only the validation set is predicted at every epoch. For a single train/validation split, the training
+        and test sets are only predicted at epochs that may be reported later as the best or baseline epoch:
+        those that improve on the model choice score so far, the baseline epoch and the last epoch. With
+        k-fold cross-validation, or when params.eval_train_each_epoch is set, all three sets are predicted
+        at every epoch. If params.eval_interval is greater than 1, the validation set is only predicted every
+        eval_interval epochs (and at the baseline and last epochs), the epochs in between are trained by a
+        single fit() call, and their metrics are set to NaN.
+
+        With a single train/validation split, the weights from the best and baseline epochs are kept in memory
+        and saved at the end of training. With k-fold cross-validation, a new model is trained on the combined
+        training and validation sets for the chosen numbers of epochs.
+        """
+        self._clear_pred_cache()
         self.data = pipeline.data
         self.best_epoch = None
-        self.train_epoch_perfs = np.zeros(self.params.max_epochs)
-        self.valid_epoch_perfs = np.zeros(self.params.max_epochs)
-        self.test_epoch_perfs = np.zeros(self.params.max_epochs)
-        self.train_epoch_perf_stds = np.zeros(self.params.max_epochs)
-        self.valid_epoch_perf_stds = np.zeros(self.params.max_epochs)
-        self.test_epoch_perf_stds = np.zeros(self.params.max_epochs)
-        self.model_choice_scores = np.zeros(self.params.max_epochs)
+        self._set_epoch_stats(np.zeros((self.params.max_epochs, len(self._epoch_stat_names))))
         baseline_epoch = self.params.baseline_epoch
 
-        self.train_perf_data = []
-        self.valid_perf_data = []
-        self.test_perf_data = []
+        # Create one PerfData object per epoch for each subset. The copies share the response data, so the
+        # dataset is only read once per subset.
+        ptype, pdata, tx = self.params.prediction_type, pipeline.data, self.transformers
+        self.train_perf_data = perf.create_perf_data(ptype, pdata, tx, 'train', n_copies=self.params.max_epochs)
+        self.valid_perf_data = perf.create_perf_data(ptype, pdata, tx, 'valid', n_copies=self.params.max_epochs)
+        self.test_perf_data = perf.create_perf_data(ptype, pdata, tx, 'test', n_copies=self.params.max_epochs)
 
-        for ei in range(self.params.max_epochs):
-            self.train_perf_data.append(perf.create_perf_data(self.params.prediction_type, pipeline.data, self.transformers, 'train'))
-            self.valid_perf_data.append(perf.create_perf_data(self.params.prediction_type, pipeline.data, self.transformers, 'valid'))
-            self.test_perf_data.append(perf.create_perf_data(self.params.prediction_type, pipeline.data, self.transformers, 'test'))
-
-        test_dset = pipeline.data.test_dset
+        # The validation and test sets are predicted repeatedly with the same features, so read them into memory
+        # once rather than reloading their shards at every epoch
+        test_dset = _in_memory_dataset(pipeline.data.test_dset)
 
         num_folds = len(pipeline.data.train_valid_dsets)
+        # With k-fold CV the best epoch depends on the scores for all folds, so we can't tell in advance
+        # which epochs' training and test set results will be needed
+        eval_all_epochs = self.params.eval_train_each_epoch or num_folds > 1
+        evaluated = np.zeros(self.params.max_epochs, dtype=bool)
+        validated = np.zeros(self.params.max_epochs, dtype=bool)
+        weight_snapshots = {}
         for k in range(num_folds):
-            restore_hold = False
             if k > 0:
-                # Replace self.model with a completely new one
+                # Replace self.model with a completely new one. Rebuilding the graph, rather than reinitializing
+                # the variables in the existing one, restarts its seeded random streams, so that each fold starts
+                # from the same initial weights and dropout masks as the first.
                 self.log.info("Creating new model")
                 self.recreate_model()
             train_dset, valid_dset = pipeline.data.train_valid_dsets[k]
+            valid_dset = _in_memory_dataset(valid_dset)
+            best_stop_score = None
+            best_choice_score = None
+            epochs_since_improvement = 0
+            pending_epochs = 0
             for ei in range(self.params.max_epochs):
                 # Check if we are on the LC machines and have been running for more than 18 hours.
                 # If so, set over_time to True and break out of epoch iteration loop.
                 if self.params.system == 'LC' and (datetime.now() - pipeline.start_time).total_seconds() > 64800:
                     self.log.warn("This code has run for 18 hours, exiting training loop")
-                    self.params.max_epochs = ei
+                    # Epochs not yet trained because they were waiting for the next validation are dropped
+                    last_epoch = ei - pending_epochs
+                    self.params.max_epochs = last_epoch
+                    # The last completed epoch becomes the baseline epoch, so make sure it has test set results
+                    if last_epoch > 0 and not evaluated[last_epoch-1]:
+                        self._evaluate_train_test(last_epoch-1, train_dset, test_dset)
+                        evaluated[last_epoch-1] = True
                     break
-                self.model.fit(train_dset, nb_epoch=1, restore=restore_hold)
-                train_pred = self.model.predict(train_dset, [])
-                valid_pred = self.model.predict(valid_dset, [])
-                test_pred = self.model.predict(test_dset, [])
-
-                train_perf = self.train_perf_data[ei].accumulate_preds(train_pred, train_dset.ids)
+                # Only validate every eval_interval epochs; the epochs in between are trained by a single fit()
+                # call. The baseline and final epochs are always validated.
+                pending_epochs += 1
+                if ((ei + 1) % self.params.eval_interval != 0 and ei != baseline_epoch - 1
+                        and ei != self.params.max_epochs - 1):
+                    continue
+                train_loss = self._fit_model(train_dset, nb_epoch=pending_epochs, checkpoint=False)
+                self.train_epoch_losses[ei] += train_loss / num_folds
+                valid_pred = self._predict_model(valid_dset)
                 valid_perf = self.valid_perf_data[ei].accumulate_preds(valid_pred, valid_dset.ids)
-                test_perf = self.test_perf_data[ei].accumulate_preds(test_pred, test_dset.ids)
-                self.log.info("Fold %d, epoch %d: training %s = %.3f, validation %s = %.3f, test %s = %.3f" % (
-                              k, ei + 1, pipeline.metric_type, train_perf, pipeline.metric_type, valid_perf,
-                              pipeline.metric_type, test_perf))
-                restore_hold = True
+                validated[ei] = True
+
+                # Stop early if the model choice score, which is also used to pick the best epoch, hasn't improved
+                # for early_stop_patience epochs. With k-fold CV, it is computed over the validation sets of the folds
+                # run so far. Like the time limit check above, this reduces max_epochs for all subsequent folds.
+                choice_score = self.valid_perf_data[ei].model_choice_score(self.params.model_choice_score_type)
+                if best_stop_score is None or choice_score > best_stop_score + self.params.early_stop_tol:
+                    best_stop_score = choice_score
+                    epochs_since_improvement = 0
+                else:
+                    epochs_since_improvement += pending_epochs
+                pending_epochs = 0
+                stop_early = (self.params.early_stop_patience and
+                              epochs_since_improvement >= self.params.early_stop_patience)
+
+                # Decide whether this epoch could end up as the best or baseline epoch, in which case we need its
+                # training and test set results. With a single split, also keep a copy of the model weights at these
+                # epochs, so that the saved models can be written without retraining.
+                is_best = False
+                if num_folds == 1:
+                    is_best = best_choice_score is None or choice_score > best_choice_score
+                    if is_best:
+                        best_choice_score = choice_score
+                        weight_snapshots['best'] = (ei, self._get_model_weights())
+                    if ei == baseline_epoch - 1:
+                        weight_snapshots['baseline'] = (ei, self._get_model_weights())
+                needs_eval = (eval_all_epochs or is_best or stop_early or ei == baseline_epoch - 1
+                              or ei == self.params.max_epochs - 1)
+                if needs_eval:
+                    train_perf, test_perf = self._evaluate_train_test(ei, train_dset, test_dset)
+                    evaluated[ei] = True
+                    self.log.info("Fold %d, epoch %d: training loss = %.3f, training %s = %.3f, validation %s = %.3f, "
+                                  "test %s = %.3f" % (k, ei + 1, train_loss, pipeline.metric_type, train_perf,
+                                  pipeline.metric_type, valid_perf, pipeline.metric_type, test_perf))
+                else:
+                    self.log.info("Fold %d, epoch %d: training loss = %.3f, validation %s = %.3f" % (
+                                  k, ei + 1, train_loss, pipeline.metric_type, valid_perf))
 
-        # Compute performance metrics for each epoch across validation sets for all folds, and find the
-        # epoch that had the best validation set performance. Also compute the training set metrics at
-        # each epoch, for later visualization.
-        for ei in range(self.params.max_epochs):
+                if stop_early:
+                    self.log.info("Fold %d: no improvement in validation set model choice score for %d epochs, "
+                                  "stopping after epoch %d" % (k, epochs_since_improvement, ei + 1))
+                    self.params.max_epochs = ei + 1
+                    break
 
-            self.train_epoch_perfs[ei], self.train_epoch_perf_stds[ei] = self.train_perf_data[ei].compute_perf_metrics()
-            self.valid_epoch_perfs[ei], self.valid_epoch_perf_stds[ei] = self.valid_perf_data[ei].compute_perf_metrics()
-            self.test_epoch_perfs[ei], self.test_epoch_perf_stds[ei] = self.test_perf_data[ei].compute_perf_metrics()
-            self.model_choice_scores[ei] = self.valid_perf_data[ei].model_choice_score(self.params.model_choice_score_type)
-        self.best_epoch = int(np.argmax(self.model_choice_scores))
+        # Drop the per-epoch data for any epochs that were skipped because training stopped early
+        num_epochs = self.params.max_epochs
+        self.train_perf_data = self.train_perf_data[:num_epochs]
+        self.valid_perf_data = self.valid_perf_data[:num_epochs]
+        self.test_perf_data = self.test_perf_data[:num_epochs]
+        self._set_epoch_stats(self._epoch_stats[:num_epochs])
 
-        # Train a new model for max(best_epoch, baseline_epoch) epochs. Save the model weights at both of
+        # Compute performance metrics for each epoch across validation sets for all folds, and find the
+        # epoch that had the best validation set performance. Also compute the training and test set metrics
+        # at each epoch where those sets were evaluated, for later visualization.
+        for ei in range(num_epochs):
+            if evaluated[ei]:
+                self.train_epoch_perfs[ei], self.train_epoch_perf_stds[ei] = self.train_perf_data[ei].compute_perf_metrics()
+                self.test_epoch_perfs[ei], self.test_epoch_perf_stds[ei] = self.test_perf_data[ei].compute_perf_metrics()
+            else:
+                self.train_epoch_perfs[ei] = self.train_epoch_perf_stds[ei] = np.nan
+                self.test_epoch_perfs[ei] = self.test_epoch_perf_stds[ei] = np.nan
+            if validated[ei]:
+                self.valid_epoch_perfs[ei], self.valid_epoch_perf_stds[ei] = self.valid_perf_data[ei].compute_perf_metrics()
+            else:
+                self.valid_epoch_perfs[ei] = self.valid_epoch_perf_stds[ei] = np.nan
+                self.train_epoch_losses[ei] = np.nan
+        validated = validated[:num_epochs]
+        self.model_choice_scores[:] = np.nan
+        self.model_choice_scores[validated] = perf.model_choice_scores(
+                [self.valid_perf_data[ei] for ei in np.flatnonzero(validated)], self.params.model_choice_score_type)
+        self.best_epoch = int(np.nanargmax(self.model_choice_scores))
+
+        # If training stopped before the baseline epoch, the last epoch run serves as the baseline, as in get_perf_data.
+        baseline_epoch = min(baseline_epoch, num_epochs)
+
+        # With a single split, save the weights kept from the best and baseline epochs
+        if num_folds == 1 and self._save_snapshot_models(weight_snapshots, baseline_epoch - 1):
+            return
+
+        # Otherwise, train a new model for max(best_epoch, baseline_epoch) epochs. Save the model weights at both of
         # these epochs.
         min_epoch = min(baseline_epoch, self.best_epoch)
         max_epoch = max(baseline_epoch, self.best_epoch)
@@ -720,15 +1100,136 @@ class DCNNModelWrapper(ModelWrapper):
         else:
             fit_dataset = pipeline.data.train_valid_dsets[0][0]
         self.recreate_model()
-        self.model.fit(fit_dataset, nb_epoch=min_epoch, restore=False)
+        self._fit_model(fit_dataset, nb_epoch=min_epoch)
         self.model.save()
 
         # Only copy the model files we need, not the entire directory
         self._copy_model(min_epoch_dir)
         if max_epoch > min_epoch:
-            self.model.fit(fit_dataset, nb_epoch=max_epoch-min_epoch, restore=True)
+            self._fit_model(fit_dataset, nb_epoch=max_epoch-min_epoch)
+            self.model.save()
+            self._copy_model(max_epoch_dir)
+        else:
+            # The best and baseline models are the same, so the second directory just links to the first one's files
+            _clone_dir(min_epoch_dir, max_epoch_dir)
+
+    # ****************************************************************************************
+    def _get_model_weights(self):
+        """Returns a copy of the current values of the model's trainable variables (the ones saved in its
+        checkpoints), along with its global step count.
+        """
+        return self.model.global_step, self.model.session.run(self.model.get_variables())
+
+    # ****************************************************************************************
+    def _set_model_weights(self, weights):
+        """Loads variable values returned by _get_model_weights into the current model."""
+        global_step, values = weights
+        for var, value in zip(self.model.get_variables(), values):
+            var.load(value, self.model.session)
+        self.model.global_step = global_step
+
+    # ****************************************************************************************
+    def _save_snapshot_models(self, weight_snapshots, baseline_epoch):
+        """Saves the best and baseline models using weights kept in memory during training, rather than
+        training a new model for each of those numbers of epochs.
+
+        Args:
+            weight_snapshots (dict): Maps 'best' and 'baseline' to (epoch, weights) tuples recorded during training
+            baseline_epoch (int): Index of the epoch to save as the baseline model
+
+        Returns:
+            (bool): True if the models were saved; False, without saving anything, if there are no weights
+            for the best or baseline epoch.
+        """
+        weights_by_epoch = dict(weight_snapshots.values())
+        # The current weights are those from the last epoch run
+        weights_by_epoch[self.params.max_epochs - 1] = self._get_model_weights()
+        if self.best_epoch not in weights_by_epoch or baseline_epoch not in weights_by_epoch:
+            return False
+        self._set_model_weights(weights_by_epoch[self.best_epoch])
+        self.model.save_checkpoint()
+        self.model.save()
+        self._copy_model(self.best_model_dir)
+        if baseline_epoch == self.best_epoch:
+            _clone_dir(self.best_model_dir, self.baseline_model_dir)
+        else:
+            self._set_model_weights(weights_by_epoch[baseline_epoch])
+            self.model.save_checkpoint()
             self.model.save()
-        self._copy_model(max_epoch_dir)
+            self._copy_model(self.baseline_model_dir)
+        return True
+
+    # ****************************************************************************************
+    def _evaluate_train_test(self, epoch, train_dset, test_dset):
+        """Predicts values for the training and test sets with the current model, and adds them to the
+        PerfData objects for the given epoch.
+
+        Returns:
+            (train_perf, test_perf): The training and test set performance metric values for the current fold
+        """
+        train_pred = self._predict_model(train_dset)
+        test_pred = self._predict_model(test_dset)
+        train_perf = self.train_perf_data[epoch].accumulate_preds(train_pred, train_dset.ids)
+        test_perf = self.test_perf_data[epoch].accumulate_preds(test_pred, test_dset.ids)
+        return train_perf, test_perf
+
+    # ****************************************************************************************
+    def _fit_model(self, dataset, nb_epoch, checkpoint=True):
+        """Fits the current model to dataset for nb_epoch epochs, continuing from its current weights.
+
+        DeepChem's fully connected models already assemble their minibatches in a separate thread and
+        feed them through a queue. GraphConvModel doesn't support the queue, so its minibatches (which
+        require building a merged ConvMol object for each batch) are prefetched in a background thread
+        here, overlapping batch construction with the TensorFlow training steps.
+
+        The model's TensorFlow session persists between calls, so training always continues from the weights
+        in memory; DeepChem's restore option, which reloads them from the latest checkpoint, is never needed.
+
+        Args:
+            dataset (DiskDataset): The dataset to fit the model to
+            nb_epoch (int): Number of epochs to train for
+            checkpoint (bool): If False, don't write a checkpoint when training finishes
+
+        Returns:
+            (float): The average training loss reported by DeepChem
+        """
+        # DeepChem writes a checkpoint every checkpoint_interval steps and at the end of training, unless it is 0
+        checkpoint_interval = 1000 if checkpoint else 0
+        if self.params.featurizer == 'graphconv':
+            batches = self.model.default_generator(dataset, epochs=nb_epoch, deterministic=False)
+            return self.model.fit_generator(_prefetch(batches), checkpoint_interval=checkpoint_interval)
+        else:
+            return self.model.fit(dataset, nb_epoch=nb_epoch, checkpoint_interval=checkpoint_interval)
+
+    # ****************************************************************************************
+    def _predict_model(self, dataset, transformers=[]):
+        """Generates predictions for dataset with the current model, as DeepChem's predict method does, but
+        with the minibatches prefetched in a background thread. DeepChem feeds the prediction batches
+        to TensorFlow one at a time, so this overlaps reading the dataset shards (and building ConvMol
+        objects for graph convolution models) with the forward passes.
+
+        Args:
+            dataset (Dataset): The dataset to predict values for
+            transformers (list): Transformers to undo on the predictions
+
+        Returns:
+            (np.array): The predicted values, as returned by DeepChem's predict method
+        """
+        batches = self.model.default_generator(dataset, predict=True, pad_batches=False)
+        return self.model.predict_on_generator(_prefetch(batches), transformers)
+
+    # ****************************************************************************************
+    def _list_checkpoint_files(self, chkpt_prefix):
+        """Returns the paths of the index, meta and data files for the TensorFlow checkpoint chkpt_prefix
+        in the model directory, found with a single scan of the directory.
+        """
+        chkpt_prefix = os.path.basename(chkpt_prefix)
+        index_file = '%s.index' % chkpt_prefix
+        meta_file = '%s.meta' % chkpt_prefix
+        data_prefix = '%s.data-' % chkpt_prefix
+        with os.scandir(self.model_dir) as entries:
+            return sorted(entry.path for entry in entries
+                          if entry.name in (index_file, meta_file) or entry.name.startswith(data_prefix))
 
     # ****************************************************************************************
     def _copy_model(self, dest_dir):
@@ -741,16 +1242,18 @@ class DCNNModelWrapper(ModelWrapper):
 
         chkpt_file = os.path.join(self.model_dir, 'checkpoint')
         with open(chkpt_file, 'r') as chkpt_in:
-            chkpt_dict = yaml.load(chkpt_in.read())
+            chkpt_dict = yaml.load(chkpt_in, Loader=YamlSafeLoader)
         chkpt_prefix = chkpt_dict['model_checkpoint_path']
         files = [chkpt_file]
         files.append(os.path.join(self.model_dir, 'model.pickle'))
-        files.append(os.path.join(self.model_dir, '%s.index' % chkpt_prefix))
-        files.append(os.path.join(self.model_dir, '%s.meta' % chkpt_prefix))
-        files = files + glob.glob(os.path.join(self.model_dir, '%s.data-*' % chkpt_prefix))
-        self._clean_up_excess_files(dest_dir)
+        files.extend(self._list_checkpoint_files(chkpt_prefix))
+        # Copy the files to a temporary directory and then swap it into place, so that dest_dir always
+        # holds a complete model
+        tmp_dir = '%s.tmp' % dest_dir
+        self._clean_up_excess_files(tmp_dir)
         for file in files:
-            shutil.copy2(file, dest_dir)
+            _copy_file(file, os.path.join(tmp_dir, os.path.basename(file)))
+        _replace_dir(tmp_dir, dest_dir)
         self.log.info("Saved model files to '%s'" % dest_dir)
 
 
@@ -765,6 +1268,7 @@ class DCNNModelWrapper(ModelWrapper):
         Side effects:
             Resets the value of model, transformers, and transformers_x
         """
+        self._clear_pred_cache()
         if self.params.featurizer == 'graphconv':
             self.model = dc.models.GraphConvModel.load_from_dir(reload_dir)
         elif self.params.prediction_type == 'regression':
@@ -780,9 +1284,36 @@ class DCNNModelWrapper(ModelWrapper):
                     bucket = self.params.transformer_bucket,
                     client = self.ds_client )
             else:
-                self.transformers, self.transformers_x = pickle.load(open( self.params.transformer_key, 'rb' ))
+                self.transformers, self.transformers_x = joblib.load(self.params.transformer_key)
 
 
+    # ****************************************************************************************
+    def _resolve_epoch(self, epoch_label):
+        """Returns the index of the training epoch referred to by epoch_label ('best' or 'baseline').
+
+        Raises:
+            ValueError: if epoch_label not in ['best','baseline']
+        """
+        if epoch_label == 'best':
+            return self.best_epoch
+        elif epoch_label == 'baseline':
+            #TODO: This check should probably go somewhere else
+            return min(self.params.max_epochs, self.params.baseline_epoch) - 1
+        else:
+            raise ValueError("Unknown epoch_label '%s'" % epoch_label)
+
+    # ****************************************************************************************
+    def _epoch_perf_data(self, subset, epoch_label):
+        """Returns the PerfData object for the given training, validation or test subset at the epoch
+        referred to by epoch_label.
+
+        Raises:
+            ValueError: if epoch_label not in ['best','baseline']
+            ValueError: If subset not in ['train','valid','test']
+        """
+        epoch = self._resolve_epoch(epoch_label)
+        return self._subset_perf_data(subset)[epoch]
+
     # ****************************************************************************************
     def get_pred_results(self, subset, epoch_label=None):
         """Returns predicted values and metrics from a training, validation or test subset
@@ -803,26 +1334,7 @@ class DCNNModelWrapper(ModelWrapper):
         """
         if subset == 'full':
             return self.get_full_dataset_pred_results(self.data)
-        if epoch_label == 'best':
-            epoch = self.best_epoch
-            model_dir = self.best_model_dir
-        elif epoch_label == 'baseline':
-            #TODO: This check should probably go somewhere else
-            if self.params.max_epochs < self.params.baseline_epoch:
-                epoch = self.params.max_epochs - 1
-            else:
-                epoch = self.params.baseline_epoch - 1
-            model_dir = self.baseline_model_dir
-        else:
-            raise ValueError("Unknown epoch_label '%s'" % epoch_label)
-        if subset == 'train':
-            return self.get_train_valid_pred_results(self.train_perf_data[epoch])
-        elif subset == 'valid':
-            return self.get_train_valid_pred_results(self.valid_perf_data[epoch])
-        elif subset == 'test':
-            return self.get_train_valid_pred_results(self.test_perf_data[epoch])
-        else:
-            raise ValueError("Unknown dataset subset '%s'" % subset)
+        return self.get_train_valid_pred_results(self._epoch_perf_data(subset, epoch_label))
 
     # ****************************************************************************************
     def get_perf_data(self, subset, epoch_label=None):
@@ -846,28 +1358,7 @@ class DCNNModelWrapper(ModelWrapper):
 
         if subset == 'full':
             return self.get_full_dataset_perf_data(self.data)
-        if epoch_label == 'best':
-            epoch = self.best_epoch
-            model_dir = self.best_model_dir
-        elif epoch_label == 'baseline':
-            #TODO: This check should probably go somewhere else
-            if self.params.max_epochs < self.params.baseline_epoch:
-                epoch = self.params.max_epochs - 1
-            else:
-                epoch = self.params.baseline_epoch - 1
-            model_dir = self.baseline_model_dir
-        else:
-            raise ValueError("Unknown epoch_label '%s'" % epoch_label)
-
-        if subset == 'train':
-            return self.train_perf_data[epoch]
-        elif subset == 'valid':
-            return self.valid_perf_data[epoch]
-        elif subset == 'test':
-            #return self.get_test_perf_data(model_dir, self.data)
-            return self.test_perf_data[epoch]
-        else:
-            raise ValueError("Unknown dataset subset '%s'" % subset)
+        return self._epoch_perf_data(subset, epoch_label)
 
 
 
@@ -915,8 +1406,12 @@ class DCNNModelWrapper(ModelWrapper):
                 pred0, std0 = pred_std[0]
                 ncmpds = pred0.shape[0]
                 nclasses = pred0.shape[1]
-                pred = np.concatenate([p.reshape((ncmpds, 1, nclasses)) for p, s in pred_std], axis=1)
-                std = np.concatenate([s.reshape((ncmpds, 1, nclasses)) for p, s in pred_std], axis=1)
+                # Fill preallocated arrays one task at a time, rather than concatenating per-task copies
+                pred = np.empty((ncmpds, ntasks, nclasses), dtype=pred0.dtype)
+                std = np.empty((ncmpds, ntasks, nclasses), dtype=std0.dtype)
+                for i, (p, s) in enumerate(pred_std):
+                    pred[:, i, :] = p.reshape((ncmpds, nclasses))
+                    std[:, i, :] = s.reshape((ncmpds, nclasses))
 
             if self.params.transformers and self.transformers is not None:
                   # Transform the standard deviations, if we can. This is a bit of a hack, but it works for
@@ -924,12 +1419,12 @@ class DCNNModelWrapper(ModelWrapper):
                 # stored in the transformer object.
                 if len(self.transformers) == 1 and (isinstance(self.transformers[0], dc.trans.NormalizationTransformer) or isinstance(self.transformers[0],trans.NormalizationTransformerMissingData)):
                     y_stds = self.transformers[0].y_stds.reshape((1,ntasks,1))
-                    std = std / y_stds
+                    std /= y_stds
                 pred = dc.trans.undo_transforms(pred, self.transformers)
         elif self.params.transformers and self.transformers is not None:
-            pred = self.model.predict(dataset, self.transformers)
+            pred = self._predict_model(dataset, self.transformers)
         else:
-            pred = self.model.predict(dataset, [])
+            pred = self._predict_model(dataset)
         return pred, std
 
     # ****************************************************************************************
@@ -997,6 +1492,9 @@ class DCRFModelWrapper(ModelWrapper):
 
     """
 
+    # Parameters reported by get_model_specific_metadata
+    _metadata_params = ('rf_estimators', 'rf_max_features', 'rf_max_depth')
+
     def __init__(self, params, featurizer, ds_client):
         """Initializes DCRFModelWrapper object.
 
@@ -1009,20 +1507,54 @@ class DCRFModelWrapper(ModelWrapper):
         self.best_model_dir = os.path.join(self.output_dir, 'best_model')
         self.model_dir = self.best_model_dir
         self.baseline_model_dir = self.best_model_dir
-        os.makedirs(self.best_model_dir, exist_ok=True)
+        _ensure_dirs_once(self.best_model_dir)
+
+        rf_class = self._get_rf_class()
+        rf_model = rf_class(n_estimators=self.params.rf_estimators,
+                            max_features=self.params.rf_max_features,
+                            max_depth=self.params.rf_max_depth,
+                            n_jobs=self.params.rf_n_jobs)
 
+        self.model = dc.models.sklearn_models.SklearnModel(rf_model, model_dir=self.best_model_dir)
+
+    # ****************************************************************************************
+    def _get_rf_class(self):
+        """Returns the random forest class to use for the current prediction type. If params.use_intelex
+        is set and scikit-learn-intelex is installed, returns the Intel-accelerated version of the class.
+        """
+        use_intelex = self.params.use_intelex
+        if use_intelex and not sklearnex_supported:
+            self.log.warning("scikit-learn-intelex is not installed; using standard scikit-learn random forests.")
+            use_intelex = False
         if self.params.prediction_type == 'regression':
-            rf_model = RandomForestRegressor(n_estimators=self.params.rf_estimators,
-                                             max_features=self.params.rf_max_features,
-                                             max_depth=self.params.rf_max_depth,
-                                             n_jobs=-1)
+            return IntelRandomForestRegressor if use_intelex else RandomForestRegressor
         else:
-            rf_model = RandomForestClassifier(n_estimators=self.params.rf_estimators,
-                                              max_features=self.params.rf_max_features,
-                                              max_depth=self.params.rf_max_depth,
-                                              n_jobs=-1)
+            return IntelRandomForestClassifier if use_intelex else RandomForestClassifier
 
-        self.model = dc.models.sklearn_models.SklearnModel(rf_model, model_dir=self.best_model_dir)
+    # ****************************************************************************************
+    def _fit_fold_models(self, train_valid_dsets):
+        """Fits a separate random forest to the training set of each k-fold CV fold. The folds are fit
+        concurrently in threads (the tree building code releases the GIL), with the cores allowed by
+        params.rf_n_jobs divided among them.
+
+        Args:
+            train_valid_dsets (list): (train, valid) dataset pairs for each fold
+
+        Returns:
+            (list of SklearnModel): The fitted model for each fold
+        """
+        num_folds = len(train_valid_dsets)
+        total_jobs = self.params.rf_n_jobs
+        if total_jobs is None or total_jobs < 0:
+            total_jobs = joblib.cpu_count()
+        fold_jobs = max(1, total_jobs // num_folds)
+        fold_models = []
+        for k in range(num_folds):
+            rf_model = clone(self.model.model_instance).set_params(n_jobs=fold_jobs)
+            fold_models.append(dc.models.sklearn_models.SklearnModel(rf_model, model_dir=self.best_model_dir))
+        joblib.Parallel(n_jobs=num_folds, backend='threading')(
+            joblib.delayed(model.fit)(train_dset) for model, (train_dset, _) in zip(fold_models, train_valid_dsets))
+        return fold_models
 
     # ****************************************************************************************
     def train(self, pipeline):
@@ -1042,6 +1574,7 @@ class DCRFModelWrapper(ModelWrapper):
             train_perfs (dict): A dictionary of predicted values and metrics on the training dataset
             valid_perfs (dict): A dictionary of predicted values and metrics on the training dataset
         """
+        self._clear_pred_cache()
 
         self.data = pipeline.data
         self.best_epoch = None
@@ -1054,17 +1587,25 @@ class DCRFModelWrapper(ModelWrapper):
         test_dset = pipeline.data.test_dset
 
         num_folds = len(pipeline.data.train_valid_dsets)
+        fold_models = None
+        if num_folds > 1 and self.params.rf_parallel_folds:
+            # The fold models are only used for the CV performance metrics; the final model is refit below
+            fold_models = self._fit_fold_models(pipeline.data.train_valid_dsets)
         for k in range(num_folds):
             train_dset, valid_dset = pipeline.data.train_valid_dsets[k]
-            self.model.fit(train_dset)
+            if fold_models is None:
+                self.model.fit(train_dset)
+                fold_model = self.model
+            else:
+                fold_model = fold_models[k]
 
-            train_pred = self.model.predict(train_dset, [])
+            train_pred = fold_model.predict(train_dset, [])
             train_perf = self.train_perf_data.accumulate_preds(train_pred, train_dset.ids)
 
-            valid_pred = self.model.predict(valid_dset, [])
+            valid_pred = fold_model.predict(valid_dset, [])
             valid_perf = self.valid_perf_data.accumulate_preds(valid_pred, valid_dset.ids)
 
-            test_pred = self.model.predict(test_dset, [])
+            test_pred = fold_model.predict(test_dset, [])
             test_perf = self.test_perf_data.accumulate_preds(test_pred, test_dset.ids)
             self.log.info("Fold %d: training %s = %.3f, validation %s = %.3f, test %s = %.3f" % (
                           k, pipeline.metric_type, train_perf, pipeline.metric_type, valid_perf,
@@ -1100,26 +1641,22 @@ class DCRFModelWrapper(ModelWrapper):
             Resets the value of model, transformers, and transformers_x
 
         """
-        if self.params.prediction_type == 'regression':
-            rf_model = RandomForestRegressor(n_estimators=self.params.rf_estimators,
-                                             max_features=self.params.rf_max_features,
-                                             max_depth=self.params.rf_max_depth,
-                                             n_jobs=-1)
-            if self.params.transformers:
-                self.log.info("Reloading transformers from file %s" % self.params.transformer_key)
-                if self.params.datastore:
-                    self.transformers, self.transformers_x = dsf.retrieve_dataset_by_datasetkey(dataset_key = self.params.transformer_key,
-                                   bucket = self.params.transformer_bucket,
-                                   client= self.ds_client )
-                else:
-                    self.transformers, self.transformers_x = pickle.load(open( self.params.transformer_key, 'rb' ))
-                # TODO: We shouldn't be reloading the transformers here - that should only happen when we load
-                # TODO: a previously trained model to run predictions on a new dataset.
-        else:
-            rf_model = RandomForestClassifier(n_estimators=self.params.rf_estimators,
-                                              max_features=self.params.rf_max_features,
-                                              max_depth=self.params.rf_max_depth,
-                                              n_jobs=-1)
+        self._clear_pred_cache()
+        rf_class = self._get_rf_class()
+        rf_model = rf_class(n_estimators=self.params.rf_estimators,
+                            max_features=self.params.rf_max_features,
+                            max_depth=self.params.rf_max_depth,
+                            n_jobs=self.params.rf_n_jobs)
+        if self.params.prediction_type == 'regression' and self.params.transformers:
+            self.log.info("Reloading transformers from file %s" % self.params.transformer_key)
+            if self.params.datastore:
+                self.transformers, self.transformers_x = dsf.retrieve_dataset_by_datasetkey(dataset_key = self.params.transformer_key,
+                               bucket = self.params.transformer_bucket,
+                               client= self.ds_client )
+            else:
+                self.transformers, self.transformers_x = joblib.load(self.params.transformer_key)
+            # TODO: We shouldn't be reloading the transformers here - that should only happen when we load
+            # TODO: a previously trained model to run predictions on a new dataset.
 
         self.model = dc.models.sklearn_models.SklearnModel(rf_model, model_dir=reload_dir)
         self.model.reload()
@@ -1141,16 +1678,9 @@ class DCRFModelWrapper(ModelWrapper):
             ValueError: if subset not in ['train','valid','test','full']
             
         """
-        if subset == 'train':
-            return self.get_train_valid_pred_results(self.train_perf_data)
-        elif subset == 'valid':
-            return self.get_train_valid_pred_results(self.valid_perf_data)
-        elif subset == 'test':
-            return self.get_train_valid_pred_results(self.test_perf_data)
-        elif subset == 'full':
+        if subset == 'full':
             return self.get_full_dataset_pred_results(self.data)
-        else:
-            raise ValueError("Unknown dataset subset '%s'" % subset)
+        return self.get_train_valid_pred_results(self._subset_perf_data(subset))
 
 
     # ****************************************************************************************
@@ -1168,17 +1698,9 @@ class DCRFModelWrapper(ModelWrapper):
         Raises:
             ValueError: if subset not in ['train','valid','test','full']
         """
-        if subset == 'train':
-            return self.train_perf_data
-        elif subset == 'valid':
-            return self.valid_perf_data
-        elif subset == 'test':
-            #return self.get_test_perf_data(self.best_model_dir, self.data)
-            return self.test_perf_data
-        elif subset == 'full':
+        if subset == 'full':
             return self.get_full_dataset_perf_data(self.data)
-        else:
-            raise ValueError("Unknown dataset subset '%s'" % subset)
+        return self._subset_perf_data(subset)
 
 
     # ****************************************************************************************
@@ -1195,23 +1717,28 @@ class DCRFModelWrapper(ModelWrapper):
         pred, std = None, None
         self.log.info("Evaluating current model")
 
-        pred = self.model.predict(dataset, self.transformers)
+        # Load the feature matrix once and predict on all compounds in a single call, rather than
+        # shard by shard; the per-tree predictions below reuse the same matrix. The trees work on float32
+        # features, so convert them once here rather than in every predict call.
+        X = _load_feature_matrix(dataset, np.float32)
+        pred = dc.trans.undo_transforms(self.model.predict_on_batch(X), self.transformers)
         ncmpds = pred.shape[0]
+        assert ncmpds == X.shape[0]
         pred = pred.reshape((ncmpds,1,-1))
 
         if self.params.uncertainty:
             if self.params.prediction_type == 'regression':
-                rf_model = joblib.load(os.path.join(self.best_model_dir, 'model.joblib'))
+                # The fitted forest is already held by the model (and is what was saved in its model_dir), so
+                # there's no need to reload it from disk
+                rf_model = self.model.model_instance
                 ## s.d. from forest
                 if self.params.transformers and self.transformers is not None:
-                    RF_per_tree_pred = [dc.trans.undo_transforms(
-                        tree.predict(dataset.X), self.transformers) for tree in rf_model.estimators_]
+                    transformers = self.transformers
                 else:
-                    RF_per_tree_pred = [tree.predict(dataset.X) for tree in rf_model.estimators_]
-
+                    transformers = []
                 # Don't need to "untransform" standard deviations here, since they're calculated from
                 # the untransformed per-tree predictions.
-                std = np.array([np.std(col) for col in zip(*RF_per_tree_pred)]).reshape((ncmpds,1,-1))
+                std = _per_tree_std(rf_model.estimators_, X, transformers, self.params.rf_n_jobs).reshape((ncmpds,1,-1))
             else:
                 # We can estimate uncertainty for binary classifiers, but not multiclass (yet)
                 nclasses = pred.shape[2]
@@ -1219,7 +1746,7 @@ class DCRFModelWrapper(ModelWrapper):
                     ntrees = self.params.rf_estimators
                     # Use normal approximation to binomial sampling error. Later we can do Jeffrey's interval if we
                     # want to get fancy.
-                    std = np.sqrt(pred * (1-pred) / ntrees)
+                    std = _binomial_std(pred, ntrees)
                 else:
                     self.log.warning("Warning: Random forest only supports uncertainties for binary classifiers.")
 
@@ -1234,11 +1761,7 @@ class DCRFModelWrapper(ModelWrapper):
             model_spec_metadata (dict): Returns random forest specific metadata as a subdict under the key 'RFSpecific'
 
         """
-        rf_metadata = {
-            'rf_estimators': self.params.rf_estimators,
-            'rf_max_features': self.params.rf_max_features,
-            'rf_max_depth': self.params.rf_max_depth
-        }
+        rf_metadata = {key: getattr(self.params, key) for key in self._metadata_params}
         model_spec_metadata = dict(RFSpecific = rf_metadata)
         return model_spec_metadata
     
@@ -1279,6 +1802,10 @@ class DCxgboostModelWrapper(ModelWrapper):
 
     """
 
+    # Parameters reported by get_model_specific_metadata
+    _metadata_params = ('xgb_max_depth', 'xgb_learning_rate', 'xgb_n_estimators', 'xgb_gamma', 'xgb_min_child_weight',
+                        'xgb_subsample', 'xgb_colsample_bytree')
+
     def __init__(self, params, featurizer, ds_client):
         """Initializes RunModel object.
 
@@ -1286,67 +1813,92 @@ class DCxgboostModelWrapper(ModelWrapper):
             params (Namespace object): contains all parameter information.
             featurizer (Featurization): Object managing the featurization of compounds
             ds_client: datastore client.
+
+        Raises:
+            Exception: If xgboost is not installed, or is older than version 0.9.
         """
+        if not xgboost_supported:
+            raise Exception("Unable to import xgboost. \
+                             xgboost package needs to be installed to use xgboost model. \
+                             Installatin: \
+                             from pip: pip3 install xgboost.\
+                             livermore compute (lc): /usr/mic/bio/anaconda3/bin/pip install xgboost --user \
+                             twintron-blue (TTB): /opt/conda/bin/pip install xgboost --user/ \ "
+                            )
+        elif parse_version(xgb.__version__) < parse_version('0.90'):
+            raise Exception(f"xgboost required to be >= 0.9 for GPU support. \
+                             current version = {xgb.__version__} \
+                             installatin: \
+                             from pip: pip3 install --upgrade xgboost \
+                             livermore compute (lc): /usr/mic/bio/anaconda3/bin/pip install --upgrade xgboost --user \
+                             twintron-blue (TTB): /opt/conda/bin/pip install --upgrade xgboost --user/ "
+                            )
+
         super().__init__(params, featurizer, ds_client)
         self.best_model_dir = os.path.join(self.output_dir, 'best_model')
         self.model_dir = self.best_model_dir
         self.baseline_model_dir = self.best_model_dir
-        os.makedirs(self.best_model_dir, exist_ok=True)
+        _ensure_dirs_once(self.best_model_dir)
+
+        self.model = self._create_xgb_model()
 
+    # ****************************************************************************************
+    def _create_xgb_model(self):
+        """Returns a DeepChem XGBoostModel wrapping a new xgboost estimator configured from params. The model
+        keeps the estimator's configuration when fit() replaces the estimator after its parameter search, so
+        that the final fits and the saved model use it too.
+        """
+        xgb_model = self._build_xgb_model()
+        model = dc.models.xgboost_models.XGBoostModel(xgb_model, model_dir=self.best_model_dir)
+        model.model_class = _XGBModelFactory(xgb_model)
+        return model
+
+    # ****************************************************************************************
+    def _build_xgb_model(self):
+        """Returns an unfitted xgboost regressor or classifier, according to params.prediction_type, configured
+        with the xgboost parameters in params.
+        """
         if self.params.prediction_type == 'regression':
-            xgb_model = xgb.XGBRegressor(max_depth=self.params.xgb_max_depth,
-                                         learning_rate=self.params.xgb_learning_rate,
-                                         n_estimators=self.params.xgb_n_estimators,
-                                         silent=True,
-                                         objective='reg:squarederror',
-                                         booster='gbtree',
-                                         gamma=self.params.xgb_gamma,
-                                         min_child_weight=self.params.xgb_min_child_weight,
-                                         max_delta_step=0,
-                                         subsample=self.params.xgb_subsample,
-                                         colsample_bytree=self.params.xgb_colsample_bytree,
-                                         colsample_bylevel=1,
-                                         reg_alpha=0,
-                                         reg_lambda=1,
-                                         scale_pos_weight=1,
-                                         base_score=0.5,
-                                         random_state=0,
-                                         missing=None,
-                                         importance_type='gain',
-                                         n_jobs=-1,
-                                         gpu_id = 0,
-                                         n_gpus = -1,
-                                         max_bin = 16,
-#                                          tree_method = 'gpu_hist'
-                                         )
+            xgb_class = xgb.XGBRegressor
+            objective = 'reg:squarederror'
+        else:
+            xgb_class = xgb.XGBClassifier
+            objective = 'binary:logistic'
+        return xgb_class(max_depth=self.params.xgb_max_depth,
+                         learning_rate=self.params.xgb_learning_rate,
+                         n_estimators=self.params.xgb_n_estimators,
+                         verbosity=0,
+                         objective=objective,
+                         booster='gbtree',
+                         gamma=self.params.xgb_gamma,
+                         min_child_weight=self.params.xgb_min_child_weight,
+                         max_delta_step=0,
+                         subsample=self.params.xgb_subsample,
+                         colsample_bytree=self.params.xgb_colsample_bytree,
+                         colsample_bylevel=1,
+                         reg_alpha=0,
+                         reg_lambda=1,
+                         scale_pos_weight=1,
+                         base_score=0.5,
+                         random_state=0,
+                         missing=None,
+                         importance_type='gain',
+                         n_jobs=self.params.xgb_n_jobs,
+                         **self._get_tree_method_args())
+
+    # ****************************************************************************************
+    def _get_tree_method_args(self):
+        """Returns the tree construction arguments for the xgboost model, based on params.xgb_tree_method
+        ('hist' by default). With 'gpu_hist', both histogram construction and prediction run on the GPU, with
+        features quantized into 256 bins; the CPU histogram methods use 16 bins.
+        """
+        tree_method = self.params.xgb_tree_method
+        if tree_method == 'gpu_hist':
+            return dict(tree_method='gpu_hist', predictor='gpu_predictor', gpu_id=0, max_bin=256)
+        elif tree_method is not None:
+            return dict(tree_method=tree_method, max_bin=16)
         else:
-            xgb_model = xgb.XGBClassifier(max_depth=self.params.xgb_max_depth,
-                                         learning_rate=self.params.xgb_learning_rate,
-                                         n_estimators=self.params.xgb_n_estimators,
-                                          silent=True,
-                                          objective='binary:logistic',
-                                          booster='gbtree',
-                                          gamma=self.params.xgb_gamma,
-                                          min_child_weight=self.params.xgb_min_child_weight,
-                                          max_delta_step=0,
-                                          subsample=self.params.xgb_subsample,
-                                          colsample_bytree=self.params.xgb_colsample_bytree,
-                                          colsample_bylevel=1,
-                                          reg_alpha=0,
-                                          reg_lambda=1,
-                                          scale_pos_weight=1,
-                                          base_score=0.5,
-                                          random_state=0,
-                                          importance_type='gain',
-                                          missing=None,
-                                          gpu_id = 0,
-                                          n_jobs=-1,                                          
-                                          n_gpus = -1,
-                                          max_bin = 16,
-#                                           tree_method = 'gpu_hist'
-                                         )
-
-        self.model = dc.models.xgboost_models.XGBoostModel(xgb_model, model_dir=self.best_model_dir)
+            return dict(max_bin=16)
 
     # ****************************************************************************************
     def train(self, pipeline):
@@ -1366,6 +1918,7 @@ class DCxgboostModelWrapper(ModelWrapper):
             train_perfs (dict): A dictionary of predicted values and metrics on the training dataset
             valid_perfs (dict): A dictionary of predicted values and metrics on the training dataset
         """
+        self._clear_pred_cache()
 
         self.data = pipeline.data
         self.best_epoch = None
@@ -1376,20 +1929,31 @@ class DCxgboostModelWrapper(ModelWrapper):
         self.log.info("Fitting xgboost model")
 
         test_dset = pipeline.data.test_dset
+        # The test set is the same for every fold, so only load its features and IDs once. xgboost works on
+        # float32 features, so convert all the feature matrices to float32 as they are loaded, rather than
+        # having xgboost make a converted copy each time it uses them.
+        test_X = _load_feature_matrix(test_dset, np.float32)
+        test_ids = test_dset.ids
 
         num_folds = len(pipeline.data.train_valid_dsets)
         for k in range(num_folds):
             train_dset, valid_dset = pipeline.data.train_valid_dsets[k]
+            # Fitting reads the whole training set, and predicting reads it again; hold it in memory so that
+            # its shards are only loaded once. Likewise the validation set's features and IDs.
+            train_dset = _in_memory_dataset(train_dset, np.float32)
+            valid_dset = _in_memory_dataset(valid_dset, np.float32)
             self.model.fit(train_dset)
 
-            train_pred = self.model.predict(train_dset, [])
+            # Predict on each subset's full feature matrix in a single call, so that xgboost converts it to a
+            # DMatrix once, instead of once per shard as DeepChem's predict() does
+            train_pred = self.model.predict_on_batch(train_dset.X)
             train_perf = self.train_perf_data.accumulate_preds(train_pred, train_dset.ids)
 
-            valid_pred = self.model.predict(valid_dset, [])
+            valid_pred = self.model.predict_on_batch(valid_dset.X)
             valid_perf = self.valid_perf_data.accumulate_preds(valid_pred, valid_dset.ids)
 
-            test_pred = self.model.predict(test_dset, [])
-            test_perf = self.test_perf_data.accumulate_preds(test_pred, test_dset.ids)
+            test_pred = self.model.predict_on_batch(test_X)
+            test_perf = self.test_perf_data.accumulate_preds(test_pred, test_ids)
             self.log.info("Fold %d: training %s = %.3f, validation %s = %.3f, test %s = %.3f" % (
                           k, pipeline.metric_type, train_perf, pipeline.metric_type, valid_perf,
                              pipeline.metric_type, test_perf))
@@ -1403,9 +1967,11 @@ class DCxgboostModelWrapper(ModelWrapper):
         self.model_choice_score = self.valid_perf_data.model_choice_score(self.params.model_choice_score_type)
 
         if num_folds > 1:
-            # For k-fold CV, retrain on the combined training and validation sets
+            # For k-fold CV, retrain on the combined training and validation sets. This has to be a fresh fit:
+            # continuing from the last fold's booster would add trees fit to that fold's training set on top
+            # of the existing ones, and DeepChem's fit() also redoes its parameter search for the new data.
             fit_dataset = self.data.combined_training_data()
-            self.model.fit(fit_dataset, restore=False)
+            self.model.fit(fit_dataset)
         self.model.save()
         # The best model is just the single xgb training run.
         self.best_epoch = 0
@@ -1424,33 +1990,9 @@ class DCxgboostModelWrapper(ModelWrapper):
             Resets the value of model, transformers, and transformers_x
 
         """
+        self._clear_pred_cache()
 
         if self.params.prediction_type == 'regression':
-            xgb_model = xgb.XGBRegressor(max_depth=self.params.xgb_max_depth,
-                                         learning_rate=self.params.xgb_learning_rate,
-                                         n_estimators=self.params.xgb_n_estimators,
-                                         silent=True,
-                                         objective='reg:squarederror',
-                                         booster='gbtree',
-                                         gamma=self.params.xgb_gamma,
-                                         min_child_weight=self.params.xgb_min_child_weight,
-                                         max_delta_step=0,
-                                         subsample=self.params.xgb_subsample,
-                                         colsample_bytree=self.params.xgb_colsample_bytree,
-                                         colsample_bylevel=1,
-                                         reg_alpha=0,
-                                         reg_lambda=1,
-                                         scale_pos_weight=1,
-                                         base_score=0.5,
-                                         random_state=0,
-                                         missing=None,
-                                         importance_type='gain',
-                                         n_jobs=-1,
-                                         gpu_id = 0,
-                                         n_gpus = -1,
-                                         max_bin = 16,
-#                                          tree_method = 'gpu_hist'
-                                         )
             if self.params.transformers:
                 self.log.warning("Reloading transformers from file %s" % self.params.transformer_key)
                 if self.params.datastore:
@@ -1459,37 +2001,11 @@ class DCxgboostModelWrapper(ModelWrapper):
                         bucket=self.params.transformer_bucket,
                         client=self.ds_client)
                 else:
-                    self.transformers, self.transformers_x = pickle.load(open(self.params.transformer_key, 'rb'))
+                    self.transformers, self.transformers_x = joblib.load(self.params.transformer_key)
                 # TODO: We shouldn't be reloading the transformers here - that should only happen when we load
                 # TODO: a previously trained model to run predictions on a new dataset.
-        else:
-            xgb_model = xgb.XGBClassifier(max_depth=self.params.xgb_max_depth,
-                                         learning_rate=self.params.xgb_learning_rate,
-                                         n_estimators=self.params.xgb_n_estimators,
-                                          silent=True,
-                                          objective='binary:logistic',
-                                          booster='gbtree',
-                                          gamma=self.params.xgb_gamma,
-                                          min_child_weight=self.params.xgb_min_child_weight,
-                                          max_delta_step=0,
-                                          subsample=self.params.xgb_subsample,
-                                          colsample_bytree=self.params.xgb_colsample_bytree,
-                                          colsample_bylevel=1,
-                                          reg_alpha=0,
-                                          reg_lambda=1,
-                                          scale_pos_weight=1,
-                                          base_score=0.5,
-                                          random_state=0,
-                                          importance_type='gain',
-                                          missing=None,
-                                          gpu_id = 0,
-                                          n_jobs=-1,                                          
-                                          n_gpus = -1,
-                                          max_bin = 16,
-#                                           tree_method = 'gpu_hist',
-                                         )
-
-        self.model = dc.models.xgboost_models.XGBoostModel(xgb_model, model_dir=self.best_model_dir)
+
+        self.model = self._create_xgb_model()
         self.model.reload()
 
     # ****************************************************************************************
@@ -1509,16 +2025,9 @@ class DCxgboostModelWrapper(ModelWrapper):
             ValueError: if subset not in ['train','valid','test','full']
 
         """
-        if subset == 'train':
-            return self.get_train_valid_pred_results(self.train_perf_data)
-        elif subset == 'valid':
-            return self.get_train_valid_pred_results(self.valid_perf_data)
-        elif subset == 'test':
-            return self.get_train_valid_pred_results(self.test_perf_data)
-        elif subset == 'full':
+        if subset == 'full':
             return self.get_full_dataset_pred_results(self.data)
-        else:
-            raise ValueError("Unknown dataset subset '%s'" % subset)
+        return self.get_train_valid_pred_results(self._subset_perf_data(subset))
 
     # ****************************************************************************************
     def get_perf_data(self, subset, epoch_label=None):
@@ -1536,17 +2045,9 @@ class DCxgboostModelWrapper(ModelWrapper):
             ValueError: if subset not in ['train','valid','test','full']
         """
 
-        if subset == 'train':
-            return self.train_perf_data
-        elif subset == 'valid':
-            return self.valid_perf_data
-        elif subset == 'test':
-            #return self.get_test_perf_data(self.best_model_dir, self.data)
-            return self.test_perf_data
-        elif subset == 'full':
+        if subset == 'full':
             return self.get_full_dataset_perf_data(self.data)
-        else:
-            raise ValueError("Unknown dataset subset '%s'" % subset)
+        return self._subset_perf_data(subset)
 
     # ****************************************************************************************
     def generate_predictions(self, dataset):
@@ -1562,8 +2063,11 @@ class DCxgboostModelWrapper(ModelWrapper):
         pred, std = None, None
         self.log.warning("Evaluating current model")
 
-        pred = self.model.predict(dataset, self.transformers)
+        # Predict on the full feature matrix in a single call, rather than shard by shard
+        X = _load_feature_matrix(dataset, np.float32)
+        pred = dc.trans.undo_transforms(self.model.predict_on_batch(X), self.transformers)
         ncmpds = pred.shape[0]
+        assert ncmpds == X.shape[0]
         pred = pred.reshape((ncmpds, 1, -1))
 
         if self.params.uncertainty:
@@ -1580,14 +2084,7 @@ class DCxgboostModelWrapper(ModelWrapper):
             model_spec_metadata (dict): Returns xgboost specific metadata as a subdict under the key 'xgbSpecific'
 
         """
-        xgb_metadata = {"xgb_max_depth" : self.params.xgb_max_depth,
-                       "xgb_learning_rate" : self.params.xgb_learning_rate,
-                       "xgb_n_estimators" : self.params.xgb_n_estimators,
-                       "xgb_gamma" : self.params.xgb_gamma,
-                       "xgb_min_child_weight" : self.params.xgb_min_child_weight,
-                       "xgb_subsample" : self.params.xgb_subsample,
-                       "xgb_colsample_bytree"  :self.params.xgb_colsample_bytree
-                        }
+        xgb_metadata = {key: getattr(self.params, key) for key in self._metadata_params}
         model_spec_metadata = dict(xgbSpecific=xgb_metadata)
         return model_spec_metadata
 
@@ -1598,3 +2095,11 @@ class DCxgboostModelWrapper(ModelWrapper):
         Does not apply to xgboost
         """
         return
+
+# ****************************************************************************************
+# Model wrapper class for each supported value of params.model_type, used by create_model_wrapper
+_model_wrapper_classes = {
+    'NN': DCNNModelWrapper,
+    'RF': DCRFModelWrapper,
+    'xgboost': DCxgboostModelWrapper,
+}
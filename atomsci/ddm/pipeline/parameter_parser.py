@@ -1,42 +1,75 @@
 import argparse
+import ast
+import copy
+import functools
+from collections import Counter
 import json
 import sys
-import re
 import logging
-import datetime
+import os
+import re
+try:
+    import orjson
+    orjson_supported = True
+except ImportError:
+    orjson_supported = False
 
 log = logging.getLogger('ATOM')
+
 # TODO: mjt, do we need to deal with parameters with options?
 # e.g. ["dk","d","r","s","f","n","dd","sl","y"]
 
 # Parameters that may take lists of values, usually but not always in the context of a hyperparam search
 
-convert_to_float_list = {'dropouts','weight_init_stddevs','bias_init_consts','learning_rate',
+convert_to_float_list = frozenset({'dropouts','weight_init_stddevs','bias_init_consts','learning_rate',
                          'umap_targ_wt', 'umap_min_dist', 'dropout_list','weight_decay_penalty',
                          'xgb_learning_rate',
                          'xgb_gamma',
                          "xgb_min_child_weight",
                          "xgb_subsample",
                          "xgb_colsample_bytree"
-                         }
-convert_to_int_list = {'layer_sizes','rf_max_features','rf_estimators', 'rf_max_depth',
+                         })
+convert_to_int_list = frozenset({'layer_sizes','rf_max_features','rf_estimators', 'rf_max_depth',
                        'umap_dim', 'umap_neighbors', 'layer_nums', 'node_nums',
-                       "xgb_max_depth",  "xgb_n_estimators"}
+                       "xgb_max_depth",  "xgb_n_estimators"})
 convert_to_numeric_list = convert_to_float_list | convert_to_int_list
-keep_as_list = {'dropouts','weight_init_stddevs','bias_init_consts',
-                'layer_sizes','dropout_list','layer_nums'}
-not_a_list_outside_of_hyperparams = {'learning_rate','weight_decay_penalty',
+keep_as_list = frozenset({'dropouts','weight_init_stddevs','bias_init_consts',
+                'layer_sizes','dropout_list','layer_nums'})
+not_a_list_outside_of_hyperparams = frozenset({'learning_rate','weight_decay_penalty',
                                      'xgb_learning_rate',
                                      'xgb_gamma',
                                      "xgb_min_child_weight",
                                      "xgb_subsample",
                                      "xgb_colsample_bytree",
                                      "xgb_max_depth",  "xgb_n_estimators"
-                                     }
+                                     })
 convert_to_str_list = \
-    {'response_cols','model_type','featurizer','splitter','umap_metric','weight_decay_penalty_type','descriptor_type'}
+    frozenset({'response_cols','model_type','featurizer','splitter','umap_metric','weight_decay_penalty_type','descriptor_type'})
 not_a_str_list_outside_of_hyperparams = \
-    {'model_type','featurizer','splitter','umap_metric','weight_decay_penalty_type','descriptor_type'}
+    frozenset({'model_type','featurizer','splitter','umap_metric','weight_decay_penalty_type','descriptor_type'})
+
+# Optional names for some parameters in config files and dicts, mapped to the expected parameter names
+optional_param_names = {'dataset_bucket':'bucket','feat_type':'featurizer','y':'response_cols','optimizer':'optimizer_type'}
+
+# Flag parameters that are False or True by default, and the values of them that set the flag in dict_to_list.
+# Values are compared case insensitively, allowing for common typos.
+default_false_params = frozenset(['previously_split','use_shortlist','datastore', 'save_results','verbose', 'hyperparam',
+                                  'split_only', 'rerun'])
+default_true_params = frozenset(['transformers','previously_featurized','uncertainty'])
+true_options = frozenset(['true','ture'])
+false_options = frozenset(['false','flase'])
+
+# Pattern for splitting hyperparameter values into space separated groups of comma separated numbers
+_whitespace_re = re.compile(r'\s+')
+
+# Placeholder for absent dictionary entries, for when None is a valid value
+_missing = object()
+
+# Values that dict_to_list passes as None
+null_options = frozenset(['null','Null','none','None','N/A','n/a','NaN','nan','NAN','NONE','NULL'])
+
+# Parsed argument values that postprocess_args replaces with None
+parsed_null_options = null_options | {'NA'}
 
 #**********************************************************************************************************
 def to_str(params_obj):
@@ -55,16 +88,38 @@ def to_str(params_obj):
     """
     # This command converts the namespace_obj to a dict, with the spaces replaced with
     # a temporary string.
-    if type(params_obj) == dict:
-        strobj = dict_to_list(params_obj,replace_spaces=True)
+    if isinstance(params_obj, dict):
+        strobj = _iter_cli_tokens(params_obj,replace_spaces=True)
     else:
-        strobj = dict_to_list(vars(params_obj),replace_spaces=True)
+        strobj = _iter_cli_tokens(vars(params_obj),replace_spaces=True)
     separator = " "
     str_params = separator.join(strobj)
     return str_params
 
 
 
+#**********************************************************************************************************
+def _literal_arg(arg_str):
+    """Converts the string representation of a dict, list or argparse.Namespace, as passed to wrapper() in a
+    single element list, back into the object. Uses ast.literal_eval rather than eval, so only literal values
+    are accepted.
+
+        Args:
+            arg_str (str): e.g. "{'arg1': val1}" or "Namespace(arg1=val1, arg2=val2)"
+
+        Returns:
+            the dict, list or argparse.Namespace object
+
+        Raises:
+            ValueError: arg_str contains something other than literals
+
+    """
+    node = ast.parse(arg_str.strip(), mode='eval').body
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'Namespace'
+            and not node.args and all(kw.arg is not None for kw in node.keywords)):
+        return argparse.Namespace(**{kw.arg: ast.literal_eval(kw.value) for kw in node.keywords})
+    return ast.literal_eval(node)
+
 #**********************************************************************************************************
 def wrapper(*any_arg):
     """"Wrapper to handle the ParseParams class. Calls the correct method depending on the input argument type
@@ -96,22 +151,24 @@ def wrapper(*any_arg):
                 # the following if statement properly appends the remaining arguments
                 #
                 if len(inp_arg) > 2:
-                    just_args = [x for x in inp_arg[2:] if "--" in x]
-                    for item in just_args:
-                        if item in list_inp:
-                            idx = list_inp.index(item)
-                            if "--" in list_inp[idx+1]:
-                                list_inp[idx:idx+1] = []
-                            else:
-                                list_inp[idx:idx+2] = []
-                    list_inp += inp_arg[2:]
+                    # Drop the config file settings of any options that are given again, with their values
+                    override_flags = {x for x in inp_arg[2:] if x.startswith("--")}
+                    merged = []
+                    idx = 0
+                    while idx < len(list_inp):
+                        item = list_inp[idx]
+                        idx += 1
+                        if item in override_flags:
+                            if idx < len(list_inp) and not list_inp[idx].startswith("--"):
+                                idx += 1
+                        else:
+                            merged.append(item)
+                    list_inp = merged + inp_arg[2:]
                 return parse_command_line(list_inp)
             elif len(inp_arg) == 1:
-                if inp_arg[0][0:9] == 'Namespace':
-                    eval_arg = eval('argparse.' + inp_arg[0])
+                eval_arg = _literal_arg(inp_arg[0])
+                if isinstance(eval_arg, argparse.Namespace):
                     print(eval_arg)
-                else:
-                    eval_arg = eval(inp_arg[0])
                 if isinstance(eval_arg, (dict,argparse.Namespace)):
                     list_inp = parse_namespace(eval_arg)
                     return parse_command_line(list_inp)
@@ -141,39 +198,72 @@ def parse_config_file(config_file_path):
         argparse.Namespace: a Namespace.argparse object containing default parameters + user specified parameters
 
     """
-    # Loads the .json config file
-    with open(config_file_path) as f:
-        config = json.loads(f.read())
+    # Return a copy of the cached result, since callers modify the list
+    stat = os.stat(config_file_path)
+    return list(_parse_config_list(config_file_path, os.path.abspath(config_file_path), stat.st_mtime_ns, stat.st_size))
+
+#***********************************************************************************************************
 
-    # If the config file is a hierarchical dict, it flattens the dictionary, otherwise, the dict is unchanged
-    flat_dict = flatten_dict(config, {})
+@functools.lru_cache(maxsize=32)
+def _parse_config_list(config_file_path, abs_path, mtime_ns, size):
+    """Does the work of parse_config_file(). Results are cached by file path, modification time and size, so that
+    an unchanged config file isn't reparsed. Returns a tuple so that the cached value can't be modified.
+    """
+    # Loads the .json config file
+    config = _load_json_file(config_file_path)
 
-    # there are several optional naming conventions for parameters, the following lines of code replace the optional
-    # names with the expected parameter names
-    replace_json_names_dict = \
-        {'dataset_bucket':'bucket','feat_type':'featurizer','y':'response_cols','optimizer':'optimizer_type'}
-    orig_keys = list(flat_dict.keys())
-    for key, vals in replace_json_names_dict.items():
-        if key in orig_keys:
-            flat_dict[vals] = flat_dict.pop(key)
+    # If the config file is a hierarchical dict, it flattens the dictionary, otherwise, the dict is unchanged.
+    # There are several optional naming conventions for parameters; these are replaced with the expected parameter
+    # names while flattening.
+    flat_dict = flatten_dict(config, rename_map=optional_param_names)
 
     #dictionary comprehension that retains only the keys that are in the accepted list of parameters
-    if 'hyperparam' in orig_keys and flat_dict['hyperparam'] == True:
-        default = list_defaults(hyperparam=True)
-    else:
-        default = list_defaults()
-    keep = list(vars(default).keys())
-    newdict = {k: flat_dict[k] for k in keep if k in flat_dict}
+    keep = _default_keys(hyperparam=(flat_dict.get('hyperparam') == True))
+    newdict = {k: v for k, v in flat_dict.items() if k in keep}
 
     # Writes a warning for any arguments that are not in the default list of parameters
-    extra_keys = [x for x in list(flat_dict.keys()) if x not in newdict.keys()]
-    if len(extra_keys)>0:
-        log.warning(str(extra_keys) + " are not part of the accepted list of parameters and will be ignored")
+    extra_keys = flat_dict.keys() - keep
+    if extra_keys and log.isEnabledFor(logging.WARNING):
+        log.warning(str(sorted(extra_keys)) + " are not part of the accepted list of parameters and will be ignored")
     newdict['config_file'] = config_file_path
-    return dict_to_list(newdict)
+    return tuple(dict_to_list(newdict))
+
+#***********************************************************************************************************
+
+def _load_json_file(json_path):
+    """Loads a JSON file, using orjson when it is installed. Files that orjson rejects but the standard json module
+    accepts (e.g., containing NaN) are loaded with json.
+
+    Args:
+        json_path(str): PATH to .json file
+
+    Returns:
+        The decoded JSON object, usually a dict
+
+    """
+    if orjson_supported:
+        with open(json_path, 'rb') as f:
+            data = f.read()
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+    with open(json_path) as f:
+        return json.load(f)
 
 #***********************************************************************************************************
-def flatten_dict(inp_dict,newdict = {}):
+
+@functools.lru_cache(maxsize=32)
+def _load_model_filter(model_filter_path, mtime_ns, size):
+    """Loads and flattens a model_filter JSON file. Results are cached by file path, modification time and size, so
+    that the same unchanged file isn't reloaded by every call to postprocess_args. Callers must not modify the
+    returned dict.
+    """
+    return flatten_dict(_load_json_file(model_filter_path))
+
+#***********************************************************************************************************
+
+def flatten_dict(inp_dict,newdict=None,rename_map=None):
 
     """Method to flatten a hierarchical dictionary. Used in parse_config_file(). Throws error if there are duplicated
     keys in the dictionary. WARNING: immediately throws error upon first detection of duplications.
@@ -181,22 +271,31 @@ def flatten_dict(inp_dict,newdict = {}):
     Args:
         inp_dict(dict): hierarchical dictionary
 
-        newdict(empty dict): empty dictionary, name of output flattened dictionary
+        newdict(dict): dictionary to add the flattened items to. A new dictionary is created if None.
+
+        rename_map(dict): optional mapping from alternate key names to the names to store them under
 
     Returns:
         newdict(dict): Flattened dictionary.
 
     """
-
-    for key, val in inp_dict.items():
-        if isinstance(val,dict):
-            flatten_dict(val,newdict)
-        else:
+    if newdict is None:
+        newdict = {}
+    # Walk the nested dicts depth first with a stack of item iterators, visiting keys in the same order as a
+    # recursive traversal, so that later duplicates still overwrite earlier ones
+    stack = [iter(inp_dict.items())]
+    while stack:
+        for key, val in stack[-1]:
+            if isinstance(val,dict):
+                stack.append(iter(val.items()))
+                break
+            if rename_map is not None:
+                key = rename_map.get(key, key)
             if key in newdict and newdict[key] != val:
                 log.warning(str(key) + " appears several times. Overwriting with value: " + str(val))
-                newdict[key] = val
-            else:
-                newdict[key] = val
+            newdict[key] = val
+        else:
+            stack.pop()
     return newdict
 
 #***********************************************************************************************************
@@ -217,28 +316,23 @@ def parse_namespace(namespace_params=None):
     if isinstance(namespace_params,argparse.Namespace):
         namespace_params = vars(namespace_params)
     # If the namespace object or dictionary is a hierarchical dict, it flattens the dictionary, otherwise, the dict
-    # is unchanged
+    # is unchanged. Optional parameter names are replaced with the expected parameter names while flattening.
+    # Dicts from Namespace objects are nearly always flat and use the expected names, so they are used as is.
 
-    flat_dict = flatten_dict(namespace_params, {})
-
-    # there are several optional naming conventions for parameters, the following lines of code replace the optional
-    # names with the expected parameter names
-    replace_json_names_dict = \
-        {'dataset_bucket':'bucket','feat_type':'featurizer','y':'response_cols','optimizer':'optimizer_type'}
-    orig_keys = list(flat_dict.keys())
-    for key, vals in replace_json_names_dict.items():
-        if key in orig_keys:
-            flat_dict[vals] = flat_dict.pop(key)
+    if (any(isinstance(val, dict) for val in namespace_params.values())
+            or not optional_param_names.keys().isdisjoint(namespace_params)):
+        flat_dict = flatten_dict(namespace_params, rename_map=optional_param_names)
+    else:
+        flat_dict = namespace_params
 
     #dictionary comprehension that retains only the keys that are in the accepted list of parameters
-    default = list_defaults()
-    keep = list(vars(default).keys())
-    newdict = {k: flat_dict[k] for k in keep if k in flat_dict}
+    keep = _default_keys()
+    newdict = {k: v for k, v in flat_dict.items() if k in keep}
 
     # Writes a warning for any arguments that are not in the default list of parameters
-    extra_keys = [x for x in list(flat_dict.keys()) if x not in newdict.keys()]
-    if len(extra_keys)>0:
-        log.warning(str(extra_keys) + " are not part of the accepted list of parameters and will be ignored")
+    extra_keys = flat_dict.keys() - keep
+    if extra_keys and log.isEnabledFor(logging.WARNING):
+        log.warning(str(sorted(extra_keys)) + " are not part of the accepted list of parameters and will be ignored")
 
     return dict_to_list(newdict)
 
@@ -259,53 +353,46 @@ def dict_to_list(inp_dictionary,replace_spaces=False):
         None if inp_dictionary is None
 
     """
+    return list(_iter_cli_tokens(inp_dictionary, replace_spaces))
 
+#***********************************************************************************************************
+
+def _iter_cli_tokens(inp_dictionary, replace_spaces=False):
+    """Generator that yields the command line tokens for dict_to_list one at a time, so that callers that join
+    them into a string (e.g. to_str) don't need to build the list first. Arguments are as for dict_to_list.
+    """
     #if replace_spaces is true, replaces spaces with replace_spaces_str for os command line calls
     replace_spaces_str = "@"
     if not isinstance(inp_dictionary,dict):
         raise ValueError("input to dict_to_list should be a dictionary!")
 
     # Handles optional names for the dictionary.
-    optional_names_dict = \
-        {'dataset_bucket':'bucket','feat_type':'featurizer','y':'response_cols','optimizer':'optimizer_type'}
-    orig_keys = list(inp_dictionary.keys())
-    for key, vals in optional_names_dict.items():
-        if key in orig_keys:
-            inp_dictionary[vals] = inp_dictionary.pop(key)
-    temp_list_to_command_line = []
+    for key, vals in optional_param_names.items():
+        value = inp_dictionary.pop(key, _missing)
+        if value is not _missing:
+            inp_dictionary[vals] = value
 
     # Special case handling for arguments that are False or True by default
-    default_false = ['previously_split','use_shortlist','datastore', 'save_results','verbose', 'hyperparam', 'split_only', 'rerun']
-    default_true = ['transformers','previously_featurized','uncertainty']
     for key, value in inp_dictionary.items():
-        if key in default_false:
-            true_options = ['True','true','ture','TRUE','Ture']
-            if str(value) in true_options:
-                temp_list_to_command_line.append('--' + str(key))
-        elif key in default_true:
-            false_options = ['False','false','flase','FALSE','Flase']
-            if str(value) in false_options:
-                temp_list_to_command_line.append('--' + str(key))
+        if key in default_false_params:
+            if str(value).casefold() in true_options:
+                yield '--' + str(key)
+        elif key in default_true_params:
+            if str(value).casefold() in false_options:
+                yield '--' + str(key)
         else:
-            temp_list_to_command_line.append('--' + str(key))
+            yield '--' + str(key)
             # Special case handling for null values
-            null_options = ['null','Null','none','None','N/A','n/a','NaN','nan','NAN','NONE','NULL']
             if str(value) in null_options:
-                temp_list_to_command_line.append('None')
-            elif isinstance(value, list):
-                sep = ","
-                newval = sep.join([str(item) for item in value])
-                if replace_spaces == True:
-                    temp_list_to_command_line.append(newval.replace(" ",replace_spaces_str))
-                else:
-                    temp_list_to_command_line.append(newval)
+                yield 'None'
             else:
-                newval = str(value)
-                if replace_spaces == True:
-                    temp_list_to_command_line.append(newval.replace(" ",replace_spaces_str))
+                if isinstance(value, list):
+                    newval = ",".join(map(str, value))
                 else:
-                    temp_list_to_command_line.append(newval)
-    return temp_list_to_command_line
+                    newval = str(value)
+                if replace_spaces == True and " " in newval:
+                    newval = newval.replace(" ",replace_spaces_str)
+                yield newval
 
 #***********************************************************************************************************
 
@@ -316,6 +403,21 @@ def list_defaults(hyperparam=False):
         argparse.Namespace: a Namespace.argparse object containing default parameters + user specified parameters
 
     """
+    # The defaults are only parsed once; each caller gets its own copy, which it is free to modify
+    return copy.deepcopy(_parse_defaults(hyperparam))
+
+#***********************************************************************************************************
+
+@functools.lru_cache(maxsize=2)
+def _default_keys(hyperparam=False):
+    """Returns the set of accepted parameter names, i.e. the keys of list_defaults(hyperparam)."""
+    return frozenset(vars(_parse_defaults(hyperparam)).keys())
+
+#***********************************************************************************************************
+
+@functools.lru_cache(maxsize=2)
+def _parse_defaults(hyperparam):
+    """Parses the default parameters for list_defaults. The result is cached, so it must not be modified."""
     #TODO: These required_vars are no longer required, but are very convenient for testing.
     # Replace these vars after refactoring testing.
     if hyperparam:
@@ -345,19 +447,80 @@ def parse_command_line(args=None):
     # The following conditional checks for duplicates in the input list
     if args is not None:
         if isinstance(args, str):
-            newlist = re.split(" ",args)
+            newlist = args.split(" ")
         else:
             newlist = args
-        just_args = [x for x in newlist if "--" in x]
-        duplicates = set([x for x in just_args if just_args.count(x) > 1])
+        duplicates = _duplicate_args(newlist)
         if len(duplicates) > 0:
             raise ValueError(str(duplicates) + " appears several times. ")
 
-    parser = get_parser()
+    parser = _shared_parser()
     parsed_args = parser.parse_args(args)
 
     return postprocess_args(parsed_args)
 
+#***********************************************************************************************************
+
+def _duplicate_args(args):
+    """Returns the set of options that appear more than once in the argument list args. Short and long forms of
+    the same option (e.g., -y and --response_cols) count as the same option, reported by its long form.
+    """
+    # Options repeated verbatim can be found without building the parser, so that malformed input fails fast
+    counts = Counter(x for x in args if x.startswith('--'))
+    duplicates = {x for x, count in counts.items() if count > 1}
+    if duplicates:
+        return duplicates
+    option_names = _option_names()
+    counts = Counter(option_names.get(x, x) for x in args if x in option_names or x.startswith('--'))
+    return {x for x, count in counts.items() if count > 1}
+
+#***********************************************************************************************************
+
+@functools.lru_cache(maxsize=1)
+def _option_names():
+    """Returns a dict mapping every option string accepted by the parser to the long form of the option."""
+    option_names = {}
+    for action in _shared_parser()._actions:
+        long_opts = [opt for opt in action.option_strings if opt.startswith('--')]
+        for opt in action.option_strings:
+            option_names[opt] = long_opts[0] if long_opts else opt
+    return option_names
+
+#***********************************************************************************************************
+
+@functools.lru_cache(maxsize=1)
+def _shared_parser():
+    """Returns a parser created by get_parser, which is built once and reused by parse_command_line and
+    prune_defaults. Parsing doesn't modify the parser, and none of the parameters has a mutable default value,
+    so the parsed Namespaces don't share any state. Callers must not modify the parser itself.
+    """
+    return get_parser()
+
+#***********************************************************************************************************
+
+def _options_help(options):
+    """Formats a dict of conditional default values for a help string, e.g. 'graphconv:[64,64,128], ecfp:[1000,500]'"""
+    return ' '.join(key + ':' + value + ',' for key, value in options.items()).rstrip(',')
+
+def _fraction(value):
+    """Argument type for dataset split fractions: a float that is at least 0 and less than 1"""
+    frac = float(value)
+    if not 0.0 <= frac < 1.0:
+        raise argparse.ArgumentTypeError("%s is not a fraction between 0 and 1" % value)
+    return frac
+
+# Conditional help strings for layer sizes and dropouts. Modify these dictionaries to change the help string
+layer_size_options = {'graphconv': '[64,64,128]', 'ecfp': '[1000,500]', 'descriptors': '[200,100]'}
+dropout_options = {'graphconv': '[0,0,0]','non-graphconv':'[0.40,0.40]'}
+weight_init_stddevs_options = {'all': '[0.02,0.02]'}
+bias_init_consts_options = {'all':'[1.0,1.0]'}
+layer_size_help = _options_help(layer_size_options)
+dropout_help = _options_help(dropout_options)
+weight_init_stddevs_help = _options_help(weight_init_stddevs_options)
+bias_init_consts_help = _options_help(bias_init_consts_options)
+
+#***********************************************************************************************************
+
 def get_parser():
     """Method that performs the actual parsing of pre-processed parameters. Modify this method to add/change/remove
     parameters
@@ -368,11 +531,6 @@ def get_parser():
         parser (argparse.Namespace): an object containing default parameters + user specific parameters
 
     """
-    # Conditional help strings for layer sizes and dropouts. Modify these dictionaries to change the help string
-    layer_size_options = {'graphconv': '[64,64,128]', 'ecfp': '[1000,500]', 'descriptors': '[200,100]'}
-    dropout_options = {'graphconv': '[0,0,0]','non-graphconv':'[0.40,0.40]'}
-    weight_init_stddevs_options = {'all': '[0.02,0.02]'}
-    bias_init_consts_options = {'all':'[1.0,1.0]'}
     parser = argparse.ArgumentParser(
         description=
         'Parses a command line argument or a specifically formatted list of strings into a Namespace.argparse object.',
@@ -537,39 +695,56 @@ def get_parser():
     parser.add_argument(
         '--batch_size', dest='batch_size', type=int, required=False, default=50,
         help='Sets the model batch size within model_wrapper')
+    parser.add_argument(
+        '--eval_train_each_epoch', dest='eval_train_each_epoch', action='store_true',
+        help='Boolean flag for predicting the training and test sets at every epoch when training NN models, to '
+             'record their performance metrics for every epoch. By default, with a single train/validation split, '
+             'they are only predicted at epochs that could be chosen as the best or baseline epoch.')
+    parser.set_defaults(eval_train_each_epoch=False)
+    parser.add_argument(
+        '--eval_interval', dest='eval_interval', type=int, required=False, default=1,
+        help='Number of epochs to train NN models between predictions on the validation set. The epochs in '
+             'between are trained by one call to DeepChem\'s fit method, and can\'t be chosen as the best epoch. '
+             'The baseline epoch and the last epoch are always evaluated.')
+    parser.add_argument(
+        '--inference_batch_size', dest='inference_batch_size', type=int, required=False, default=10000,
+        help='Number of compounds to generate predictions for at a time when computing test set and full dataset '
+             'performance metrics. Set to 0 to predict on the whole dataset at once.')
 
-    temp_bias_init_consts_string = [key + ':' + value + ',' for key, value in bias_init_consts_options.items()]
-    separator = " "
     bias_init_consts_help_string = \
         ('Comma-separated list of initial bias parameters per layer for dense NN models with conditional values. ' 
          'Defaults to [1.0]*len(layer_sizes). Must be same length as layer_sizes. Can be input as a space-separated ' 
          'list of comma-separated lists for hyperparameters (e.g. \'1.0,1.0 0.9,0.9 0.8,0.9\'). Default behavior is' 
          ' set within __init__ method of DCNNModelWrapper.  '
-         + separator.join(temp_bias_init_consts_string)).rstrip(',')
+         + bias_init_consts_help)
     parser.add_argument(
         '--bias_init_consts', dest='bias_init_consts', required=False, default=None,
         help=bias_init_consts_help_string)
 
-    temp_dropout_string = [key + ':' + value + ',' for key, value in dropout_options.items()]
-    separator = " "
     dropout_help_string = \
         ('Comma-separated list of dropout rates per layer for NN models with default values conditional on featurizer.' 
          ' Default behavior is controlled in model_wrapper.py. Must be same length as layer_sizes. Can be input as ' 
          'a space-separated list of comma-separated lists for hyperparameters (e.g. \'0.4,0.4 0.2,0.2 0.3,0.3\'). ' 
          'Default behavior is set within __init__ method of DCNNModelWrapper. Defaults: '
-         + separator.join(temp_dropout_string)).rstrip(',')
+         + dropout_help)
     parser.add_argument(
         '--dropouts', dest='dropouts', required=False, default=None,
         help=dropout_help_string)
+    parser.add_argument(
+        '--early_stop_patience', dest='early_stop_patience', type=int, default=10,
+        help='Stop training a NN model when the validation set model choice score (see model_choice_score_type) '
+             'has not improved for this many epochs. Set to 0 to always train for max_epochs epochs.')
+    parser.add_argument(
+        '--early_stop_tol', dest='early_stop_tol', type=float, default=0.0,
+        help='Minimum increase in the validation set model choice score that counts as an improvement for '
+             'early stopping of NN model training.')
 
-    temp_layer_size_string = [key + ':' + value + ',' for key,value in layer_size_options.items()]
-    separator = " "
     layer_size_help_string = \
         ('Comma-separated list of layer sizes for NN models with default values conditional on featurizer. Must be' 
          ' same length as layer_sizes. Can be input as a space-separated list of comma-separated lists for ' 
          'hyperparameters (e.g. \'64,16 200,100 1000,500\'). Default behavior is set within __init__ method of ' 
          'DCNNModelWrapper. Defaults: '
-         + separator.join(temp_layer_size_string)).rstrip(',')
+         + layer_size_help)
     parser.add_argument(
         '--layer_sizes', dest='layer_sizes', required=False, default=None,
         help=layer_size_help_string)
@@ -581,6 +756,20 @@ def get_parser():
     parser.add_argument(
         '--max_epochs', dest='max_epochs', type=int, default=30,
         help='Maximum number of training epochs to run for DNN models')
+    parser.add_argument(
+        '--num_inter_threads', dest='num_inter_threads', type=int, default=0,
+        help='Number of threads TensorFlow uses to run independent operations of NN models in parallel. ' 
+             '0 means let TensorFlow choose.')
+    parser.add_argument(
+        '--num_intra_threads', dest='num_intra_threads', type=int, default=0,
+        help='Number of threads TensorFlow uses within a single operation (e.g. a matrix multiply) of NN models. ' 
+             '0 means let TensorFlow choose, which usually means one thread per CPU core.')
+    parser.add_argument(
+        '--precision', dest='precision', default='float32', choices=['float32', 'bfloat16'],
+        help='Numerical precision for NN model computations. \'bfloat16\' turns on TensorFlow\'s automatic ' 
+             'mixed precision graph rewrite for CPUs, which runs eligible operations such as the dense layer ' 
+             'matrix multiplies in bfloat16 while keeping variables and losses in float32. Requires a TensorFlow ' 
+             'version that supports the rewrite; otherwise float32 is used.')
     parser.add_argument(
         '--weight_decay_penalty', dest='weight_decay_penalty', required=False, default='0.0001',
         help='weight_decay_penalty: float. The magnitude of the weight decay penalty to use. ' 
@@ -591,17 +780,20 @@ def get_parser():
         help='weight_decay_penalty_type: str. The type of penalty to use for weight decay, either "l1" or "l2". ' 
              'Can be input as a comma separated list for hyperparameter search (e.g. \'l1,l2\')')
 
-    temp_weight_init_stddevs_string = [key + ':' + value + ',' for key, value in weight_init_stddevs_options.items()]
-    separator = " "
     weight_init_stddevs_help_string = \
         ('Comma-separated list of standard deviations per layer for initializing weights in dense NN models with ' 
          'conditional values. Must be same length as layer_sizes. Can be input as a space-separated list of ' 
          'comma-separated lists for hyperparameters (e.g. \'0.001,0.001 0.002,0.002 0.03,003\'). Default behavior is ' 
          'set within __init__ method of DCNNModelWrapper. Defaults: '
-         + separator.join(temp_weight_init_stddevs_string)).rstrip(',')
+         + weight_init_stddevs_help)
     parser.add_argument(
         '--weight_init_stddevs', dest='weight_init_stddevs', required=False, default=None,
         help=weight_init_stddevs_help_string)
+    parser.add_argument(
+        '--xla_jit', dest='xla_jit', action='store_true',
+        help='Boolean flag for turning on XLA just-in-time compilation of the TensorFlow graphs for NN models, '
+             'which fuses operations into larger kernels. Requires a TensorFlow build with XLA support.')
+    parser.set_defaults(xla_jit=False)
 
     # **********************************************************************************************************
     # model_building_parameters: random_forest
@@ -616,12 +808,27 @@ def get_parser():
         help='The maximum depth of a decision tree in the random forest.  Hyperparameter searching requires 3 '
              'inputs: start, end, step when used with search_type geometric or grid (example: \'4,7,1\') or can be '
              'input as a list of possible values for search_type user_specified (example: \'4,5,6,7\')')
+    parser.add_argument(
+        '--rf_n_jobs', dest='rf_n_jobs', type=int, default=-1,
+        help='Number of parallel jobs used to fit random forest models and make predictions with them. '
+             '-1 means use all available CPU cores.')
     parser.add_argument(
         '--rf_max_features', dest='rf_max_features', default='32',
         help='Max number of features to split random forest nodes. Hyperparameter searching requires 3 '
              'inputs: start, end, step when used with search_type geometric or grid (example: \'16,32,4\') '
              'or can be input as a list of possible values for search_type user_specified '
              '(example: \'16,20,24,28,32\')')
+    parser.add_argument(
+        '--use_intelex', dest='use_intelex', action='store_true',
+        help='Boolean flag for using the Intel-accelerated random forest classes from scikit-learn-intelex, if '
+             'installed, in place of the standard scikit-learn ones. Predictions agree with scikit-learn to within '
+             'default floating point tolerances.')
+    parser.set_defaults(use_intelex=False)
+    parser.add_argument(
+        '--rf_parallel_folds', dest='rf_parallel_folds', action='store_true',
+        help='Boolean flag for fitting the random forests for all k-fold CV folds concurrently, dividing the '
+             'rf_n_jobs cores among them. Needs enough memory to hold every fold\'s training set and forest at once.')
+    parser.set_defaults(rf_parallel_folds=False)
 
     # **********************************************************************************************************
     # model_building_parameters: splitting
@@ -653,14 +860,14 @@ def get_parser():
              'normal train/valid/test split. If split_test_frac or split_valid_frac are not set, "train_valid_test" '
              'sets are split according to the splitting type default.')
     parser.add_argument(
-        '--split_test_frac', dest='split_test_frac', type=float, default=0.1,
+        '--split_test_frac', dest='split_test_frac', type=_fraction, default=0.1,
         help='Fraction of data to put in held-out test set for train_valid_test split strategy.' 
              ' TODO: Behavior of split_test_frac is dependent on split_valid_frac and DeepChem')
     parser.add_argument(
         '--split_uuid', dest='split_uuid', default=None,
         help='UUID for csv file containing train, validation, and test split information. Specific to LLNL datastore')
     parser.add_argument(
-        '--split_valid_frac', dest='split_valid_frac', type=float, default=0.1,
+        '--split_valid_frac', dest='split_valid_frac', type=_fraction, default=0.1,
         help='Fraction of data to put in the validation set for train_valid_test split strategy.' 
              ' TODO: Behavior of split_valid_frac is dependent on split_test_frac and DeepChem')
     parser.add_argument(
@@ -742,10 +949,22 @@ def get_parser():
         '--xgb_n_estimators', dest='xgb_n_estimators', default='100',
         help='Number of estimators to use in xgboost models. Can be input as a comma separated list for ' 
              'hyperparameter search (e.g. \'100,200,300\')')
+    parser.add_argument(
+        '--xgb_n_jobs', dest='xgb_n_jobs', type=int, default=-1,
+        help='Number of threads used to fit xgboost models and make predictions with them. -1 means use all '
+             'available CPU cores. When several models are trained at once on the same machine, give each of them '
+             'a share of the cores, since xgboost gains little from extra threads.')
     parser.add_argument(
         '--xgb_subsample', dest='xgb_subsample', default='1.0',
         help='Subsample ratio of the training instance. Can be input as a comma separated list for '
              'hyperparameter search (e.g. \'0.8,0.9,1.0\')')
+    parser.add_argument(
+        '--xgb_tree_method', dest='xgb_tree_method', default='hist',
+        choices=['auto', 'exact', 'approx', 'hist', 'gpu_hist'],
+        help='Tree construction algorithm used by xgboost models. The default, \'hist\', bins each feature into '
+             'a histogram (with the 16 bins set by the model wrapper) and is much faster than \'exact\'. ' 
+             '\'gpu_hist\' builds the histograms and makes predictions on the GPU, and requires xgboost to be ' 
+             'built with CUDA support.')
 
     # **********************************************************************************************************
     # model_saving_parameters
@@ -882,7 +1101,7 @@ def get_parser():
 #***********************************************************************************************************
 def postprocess_args(parsed_args):
     """ Postprocessing for the parsed arguments.
-    Replaces any string in null_options with a NoneType
+    Replaces any string in parsed_null_options with a NoneType
 
     Replaces any string that matches replace_with_space with whitespace.
 
@@ -918,28 +1137,28 @@ def postprocess_args(parsed_args):
         is False
     """
     replace_with_space = "@"
-    null_options = ['null','Null','none','None','N/A','n/a','NaN','nan','NAN','NONE','NULL','NA']
+    params_dict = vars(parsed_args)
+
+    # Check that split_valid_frac+split_test_frac leaves room for a training set. Each fraction is checked to be
+    # less than 1 by the parser, so only their sum needs checking, before any other processing is done.
+    if parsed_args.split_strategy == 'train_valid_test':
+        if parsed_args.split_valid_frac + parsed_args.split_test_frac >= 1.0:
+            raise Exception("Split fractions for validation and test sets leave no room for training set.")
 
-    for keys,vals in parsed_args.__dict__.items():
-        if vals in null_options:
-            parsed_args.__dict__[keys] = None
-        if "@" in str(vals):
-            parsed_args.__dict__[keys] = vals.replace(replace_with_space," ")
+    # Only string values can be null options or contain replaced spaces
+    for keys,vals in params_dict.items():
+        if isinstance(vals, str):
+            if vals in parsed_null_options:
+                params_dict[keys] = None
+            elif replace_with_space in vals:
+                params_dict[keys] = vals.replace(replace_with_space," ")
 
     #postprocessing to add in the model_filter dictionary for the model zoo.
     if parsed_args.model_filter is not None:
         #TODO: Use model_wrapper to allow for other formats?
-        with open(parsed_args.model_filter) as f:
-            config = json.loads(f.read())
-        parsed_args.model_filter = flatten_dict(config, {})
-
-    # Check that split_valid_frac+split_test_frac leaves room for a training set
-    if parsed_args.split_strategy == 'train_valid_test':
-        if parsed_args.split_valid_frac + parsed_args.split_test_frac >= 1.0:
-            raise Exception("Split fractions for validation and test sets leave no room for training set.")
-    elif parsed_args.split_strategy == 'k_fold_cv':
-        if parsed_args.split_test_frac >= 1.0:
-            raise Exception("Split fraction for test set leaves no room for training and validation data.")
+        stat = os.stat(parsed_args.model_filter)
+        model_filter = _load_model_filter(os.path.abspath(parsed_args.model_filter), stat.st_mtime_ns, stat.st_size)
+        parsed_args.model_filter = copy.deepcopy(model_filter)
 
     # Set conditional defaults for model_choice_score_type based on prediction_type
     if parsed_args.model_choice_score_type is None:
@@ -951,55 +1170,55 @@ def postprocess_args(parsed_args):
     # Convert arguments passed as comma-separated values into lists
     if parsed_args.hyperparam:
         for item in convert_to_str_list:
-            if parsed_args.__dict__[item] is not None:
-                parsed_args.__dict__[item] = [x.strip() for x in parsed_args.__dict__[item].split(',')]
-                if len(parsed_args.__dict__[item]) == 1 and item !='response_cols':
-                    parsed_args.__dict__[item] = parsed_args.__dict__[item][0]
+            if params_dict[item] is not None:
+                params_dict[item] = [x.strip() for x in params_dict[item].split(',')]
+                if len(params_dict[item]) == 1 and item !='response_cols':
+                    params_dict[item] = params_dict[item][0]
 
         for item in convert_to_numeric_list:
-            if parsed_args.__dict__[item] is not None:
+            if params_dict[item] is not None:
 
                 # splits a list of space separated strings e.g. [--dropouts 0.001,0.001 0.002,0.002]
                 # e.g. [--dropouts 0.001,0.001 0.002,0.002] -> [[0.001,0.001],[0.002,0.002]]
-                current_value = parsed_args.__dict__[item].split(' ')
-                newlist = []
-                for vals in current_value:
-                    temp_split = vals.split(',')
-                    if item in convert_to_int_list:
-                        newlist.append([int(x.strip()) for x in temp_split])
-                    else:
-                        newlist.append([float(x.strip()) for x in temp_split])
-                    # Once a new list of lists is generated, pass to parsed_args
-                    if len(newlist) == 1:
-                        parsed_args.__dict__[item] = newlist[0]
-                        #newlist is a list of lists, need to extract down to the lowest layer, as necessary
-                        if len(newlist[0]) == 1 and item not in keep_as_list:
-                            parsed_args.__dict__[item] = parsed_args.__dict__[item][0]
+                current_value = _whitespace_re.split(params_dict[item].strip())
+                cast = int if item in convert_to_int_list else float
+                # Empty items, e.g. from '100,,50', are rejected by cast rather than skipped
+                newlist = [list(map(cast, vals.split(','))) for vals in current_value]
+                # Once a new list of lists is generated, pass to parsed_args
+                if len(newlist) == 1:
+                    #newlist is a list of lists, need to extract down to the lowest layer, as necessary
+                    if len(newlist[0]) == 1 and item not in keep_as_list:
+                        params_dict[item] = newlist[0][0]
                     else:
-                        parsed_args.__dict__[item] = newlist
+                        params_dict[item] = newlist[0]
+                else:
+                    params_dict[item] = newlist
     else:
         for item in convert_to_numeric_list:
-            if parsed_args.__dict__[item] is not None:
-                current_value = parsed_args.__dict__[item].split(',')
-                if item in convert_to_int_list:
-                    newlist = [int(x.strip()) for x in current_value]
+            current_value = params_dict[item]
+            if current_value is not None:
+                # int() and float() ignore surrounding whitespace, so values don't need to be stripped, and single
+                # values don't need to be split
+                cast = int if item in convert_to_int_list else float
+                if ',' in current_value:
+                    newlist = [cast(x) for x in current_value.split(',')]
                 else:
-                    newlist = [float(x.strip()) for x in current_value]
+                    newlist = [cast(current_value)]
                 # Once a new list of lists is generated, pass to parsed_args
                 if len(newlist) == 1 and item not in keep_as_list:
-                    parsed_args.__dict__[item] = newlist[0]
+                    params_dict[item] = newlist[0]
                 else:
-                    parsed_args.__dict__[item] = newlist
-                if item in not_a_list_outside_of_hyperparams and isinstance(parsed_args.__dict__[item], list):
+                    params_dict[item] = newlist
+                if item in not_a_list_outside_of_hyperparams and isinstance(params_dict[item], list):
                     raise Exception("%s is not accepted as a list if hyperparams is False" %item)
 
         for item in not_a_str_list_outside_of_hyperparams:
-            if parsed_args.__dict__[item] is not None:
-                if ',' in parsed_args.__dict__[item] or ' ' in parsed_args.__dict__[item]:
+            if params_dict[item] is not None:
+                if ',' in params_dict[item] or ' ' in params_dict[item]:
                     raise Exception("%s cannot contain a comma or whitespace when hyperparams is False" %item)
-        if parsed_args.__dict__['response_cols'] is not None:
-            current_value = parsed_args.__dict__['response_cols'].split(',')
-            parsed_args.__dict__['response_cols'] = current_value
+        if params_dict['response_cols'] is not None:
+            current_value = params_dict['response_cols'].split(',')
+            params_dict['response_cols'] = current_value
         # Checks that the layer sizes, dropouts, weight_init_stddevs, and bias_init_consts are the same length
         # if they are non-default
         if parsed_args.layer_sizes is not None:
@@ -1022,21 +1241,37 @@ def prune_defaults(params, keep_params={}):
     Returns:
         new_dict (dict): Pruned argument dictionary
     """
-    parser = get_parser()
+    defaults = _parser_defaults()
     new_dict = dict()
     if isinstance(params, argparse.Namespace):
         inner_dict = params.__dict__
     else:
         inner_dict = params
     for key, value in inner_dict.items():
-        if key in keep_params or parser.get_default(key) not in [value, str(value)]:
+        if key in keep_params or defaults.get(key) not in [value, str(value)]:
             new_dict[key] = value
     return new_dict
 
 #***********************************************************************************************************
 
+@functools.lru_cache(maxsize=1)
+def _parser_defaults():
+    """Returns a dict mapping each parameter name to its default value, as given by get_default() for the shared
+    parser. Callers must not modify it.
+    """
+    parser = _shared_parser()
+    defaults = dict(parser._defaults)
+    for action in reversed(parser._actions):
+        defaults[action.dest] = action.default
+    return defaults
+
+#***********************************************************************************************************
+
 def main(argument):
-    """Entry point when script is run from a shell"""
+    """Entry point when script is run from a shell. Raises an error if there are duplicate arguments"""
+    duplicates = _duplicate_args(argument)
+    if len(duplicates) > 0:
+        raise ValueError(str(duplicates) + " appears several times. ")
     if argument[0] in ['--help', '-h']:
         params = parse_command_line(argument)
     else:
@@ -1047,10 +1282,6 @@ def main(argument):
 #***********************************************************************************************************
 
 if __name__ == '__main__' and len(sys.argv) > 1:
-    """Entry point when script is run from a shell. Raises an error if there are duplicate arguments"""
-    just_args = [x for x in sys.argv if "--" in x]
-    duplicates = set([x for x in just_args if just_args.count(x) > 1])
-    if len(duplicates) > 0:
-        raise ValueError(str(duplicates) + " appears several times. ")
+    """Entry point when script is run from a shell"""
     main(sys.argv[1:])
     sys.exit(0)
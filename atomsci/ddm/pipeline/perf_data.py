@@ -5,14 +5,22 @@ Contains class PerfData and its subclasses, which are objects for collecting and
 and predictions
 """
 
+import copy
+
 import sklearn.metrics
 
 import deepchem as dc
 import numpy as np
+import pandas as pd
 import tensorflow as tf
 from sklearn.metrics import roc_auc_score, confusion_matrix, average_precision_score, precision_score, recall_score
 from sklearn.metrics import accuracy_score, matthews_corrcoef, cohen_kappa_score, log_loss
 from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error
+try:
+    import numba
+    numba_supported = True
+except ImportError:
+    numba_supported = False
 
 from atomsci.ddm.pipeline import transformations as trans
 
@@ -51,6 +59,163 @@ def negative_predictive_value(y_real, y_pred):
     else:
         return float(TN)/float(TN+FN)
 
+# ******************************************************************************************************************************
+def _regression_metrics_numpy(real_vals, pred_vals, mask):
+    """Computes the per-task regression metrics returned by regression_task_metrics, as a (5, ntasks) array,
+    using masked NumPy reductions.
+    """
+    n = mask.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(mask, real_vals, 0.).sum(axis=0) / n
+        ss_tot = (np.where(mask, real_vals - means, 0.) ** 2).sum(axis=0)
+        errs = np.where(mask, real_vals - pred_vals, 0.)
+        ss_res = (errs ** 2).sum(axis=0)
+        r2 = np.where(ss_tot > 0, 1. - ss_res / ss_tot, np.where(ss_res == 0, 1., 0.))
+        mae = np.abs(errs).sum(axis=0) / n
+        rmse = np.sqrt(ss_res / n)
+        stds = np.sqrt(ss_tot / n)
+    result = np.stack([r2, mae, rmse, means, stds])
+    result[:, n == 0] = np.nan
+    return result
+
+if numba_supported:
+    @numba.njit(parallel=True, cache=True)
+    def _regression_metrics_numba(real_vals, pred_vals, mask):
+        """Computes the per-task regression metrics returned by regression_task_metrics, as a (5, ntasks)
+        array, with the tasks processed in parallel.
+        """
+        nrows, ntasks = real_vals.shape
+        result = np.empty((5, ntasks))
+        for t in numba.prange(ntasks):
+            n = 0
+            sum_real = 0.
+            for i in range(nrows):
+                if mask[i, t]:
+                    n += 1
+                    sum_real += real_vals[i, t]
+            if n == 0:
+                for k in range(5):
+                    result[k, t] = np.nan
+                continue
+            mean = sum_real / n
+            ss_tot = 0.
+            ss_res = 0.
+            sum_abs = 0.
+            for i in range(nrows):
+                if mask[i, t]:
+                    dev = real_vals[i, t] - mean
+                    ss_tot += dev * dev
+                    err = real_vals[i, t] - pred_vals[i, t]
+                    ss_res += err * err
+                    sum_abs += abs(err)
+            if ss_tot > 0:
+                result[0, t] = 1. - ss_res / ss_tot
+            elif ss_res == 0:
+                result[0, t] = 1.
+            else:
+                result[0, t] = 0.
+            result[1, t] = sum_abs / n
+            result[2, t] = np.sqrt(ss_res / n)
+            result[3, t] = mean
+            result[4, t] = np.sqrt(ss_tot / n)
+        return result
+
+# ---------------------------------------------
+def regression_task_metrics(real_vals, pred_vals, weights):
+    """
+    Computes regression performance metrics and response statistics for each task in a single pass over the
+    data, using only the compounds with nonzero weights and non-missing response values for each task. The
+    metrics match those computed by the sklearn functions in regr_score_func.
+
+    Args:
+        real_vals (np.array): (ncmpds, ntasks) array of ground truth values
+
+        pred_vals (np.array): (ncmpds, ntasks) array of predicted values
+
+        weights (np.array): (ncmpds, ntasks) array of response weights
+
+    Returns:
+        (dict): Arrays of per-task values, under the keys 'r2', 'mae', 'rmse' (matching the keys of
+        regr_score_func), 'mean' and 'std' (the mean and standard deviation of the real values). Values for
+        tasks with no usable compounds are NaN.
+
+    """
+    real_vals = np.ascontiguousarray(real_vals, dtype=np.float64)
+    real_vals = real_vals.reshape((real_vals.shape[0], -1))
+    pred_vals = np.ascontiguousarray(pred_vals, dtype=np.float64).reshape(real_vals.shape)
+    mask = (np.asarray(weights).reshape(real_vals.shape) != 0) & ~np.isnan(real_vals)
+    if numba_supported:
+        result = _regression_metrics_numba(real_vals, pred_vals, mask)
+    else:
+        result = _regression_metrics_numpy(real_vals, pred_vals, mask)
+    return dict(zip(['r2', 'mae', 'rmse', 'mean', 'std'], result))
+
+# ---------------------------------------------
+def _id_rows(id_index, ids):
+    """Returns the row numbers of the given compound IDs in id_index, a pandas Index of unique IDs.
+
+    Raises:
+        KeyError: If any of the IDs are not in id_index
+    """
+    rows = id_index.get_indexer(ids)
+    if np.any(rows < 0):
+        raise KeyError("Unknown compound IDs: %s" % list(np.asarray(ids)[rows < 0][:5]))
+    return rows
+
+# ---------------------------------------------
+def _accumulate_rows_numpy(rows, preds, sums, sq_sums, counts):
+    """Adds each row of preds, and its elementwise square, to the row of sums and sq_sums given by rows, and
+    counts each addition in counts. np.add.at handles repeated row numbers correctly."""
+    np.add.at(sums, rows, preds)
+    np.add.at(sq_sums, rows, preds * preds)
+    np.add.at(counts, rows, 1)
+
+if numba_supported:
+    @numba.njit(cache=True)
+    def _accumulate_rows_numba(rows, preds, sums, sq_sums, counts):
+        """Numba version of _accumulate_rows_numpy, for 2D preds, sums and sq_sums."""
+        for i in range(rows.shape[0]):
+            r = rows[i]
+            counts[r] += 1
+            for j in range(preds.shape[1]):
+                sums[r, j] += preds[i, j]
+                sq_sums[r, j] += preds[i, j] * preds[i, j]
+
+# ---------------------------------------------
+def _accumulate_fold_preds(perf_data, preds, ids):
+    """Adds the predictions for one fold, an array with one row per compound in ids, to the running sums kept
+    by a k-fold PerfData object. Only the sums, sums of squares and counts are needed to compute the means and
+    standard deviations over folds for each compound."""
+    rows = _id_rows(perf_data.id_index, ids)
+    nvals = perf_data.pred_sums[0].size
+    preds = np.ascontiguousarray(preds, dtype=np.float64).reshape((len(rows), nvals))
+    sums = perf_data.pred_sums.reshape((-1, nvals))
+    sq_sums = perf_data.pred_sq_sums.reshape((-1, nvals))
+    if numba_supported:
+        _accumulate_rows_numba(rows, preds, sums, sq_sums, perf_data.pred_counts)
+    else:
+        _accumulate_rows_numpy(rows, preds, sums, sq_sums, perf_data.pred_counts)
+
+# ---------------------------------------------
+def _fold_pred_means_and_stds(perf_data):
+    """Returns the means and (population) standard deviations over folds of the predictions accumulated by a
+    k-fold PerfData object, in the order of its id_index. Compounds with no predictions get NaNs."""
+    counts = perf_data.pred_counts.reshape((-1,) + (1,) * (perf_data.pred_sums.ndim - 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = perf_data.pred_sums / counts
+        stds = np.sqrt(np.maximum(perf_data.pred_sq_sums / counts - means * means, 0.))
+    return means, stds
+
+# ---------------------------------------------
+def _predicted_weights(perf_data, weights):
+    """Returns the response weights of a PerfData object, in the order of its get_pred_values() output, with the
+    weights of compounds that have no predictions yet set to zero. Only k-fold PerfData objects, while
+    cross-validation is still running, have such compounds; other objects' weights are returned unchanged."""
+    if not hasattr(perf_data, 'pred_counts'):
+        return weights
+    predicted = (perf_data.pred_counts > 0).reshape((-1,) + (1,) * (weights.ndim - 1))
+    return np.where(predicted, weights, 0)
+
 # ******************************************************************************************************************************
 
 # params.model_choice_score_type must be a key in one of the dictionaries below:
@@ -76,9 +241,11 @@ binary_average_param = {'precision', 'recall'}
 binary_class_only = {'npv'}
 
 # ******************************************************************************************************************************
-def create_perf_data(prediction_type, model_dataset, transformers, subset, **kwargs):
+def create_perf_data(prediction_type, model_dataset, transformers, subset, n_copies=None, **kwargs):
     """Factory function that creates the right kind of PerfData object for the given subset,
     prediction_type (classification or regression) and split strategy (k-fold or train/valid/test).
+    If n_copies is specified, returns a list of n_copies independent PerfData objects for the subset (e.g.,
+    one per training epoch), which share the response values and weights read from the dataset.
 
     Args:
         prediction_type (str): classification or regression.
@@ -89,15 +256,20 @@ def create_perf_data(prediction_type, model_dataset, transformers, subset, **kwa
         
         subset (str): Label in ['train', 'valid', 'test', 'full'], indicating the type of subset of dataset for tracking predictions
         
+        n_copies (int): If not None, the number of PerfData objects to return
+
         **kwargs: Additional PerfData subclass arguments
         
     Returns:
-        PerfData object
+        PerfData object, or list of n_copies PerfData objects
         
     Raises:
         ValueError: if split_strategy not in ['train_valid_test','k_fold_cv']
         ValueError: prediction_type not in ['regression','classification']
     """
+    if n_copies is not None:
+        perf_data = create_perf_data(prediction_type, model_dataset, transformers, subset, **kwargs)
+        return [perf_data] + [perf_data.copy_empty() for _ in range(n_copies - 1)]
     if subset == 'full':
         split_strategy = 'train_valid_test'
     else:
@@ -122,6 +294,47 @@ def create_perf_data(prediction_type, model_dataset, transformers, subset, **kwa
     else:
         raise ValueError('Unknown prediction type %s' % prediction_type)
 
+# ****************************************************************************************
+def model_choice_scores(perf_data_list, score_type):
+    """Computes the model choice score of the given type for each PerfData object in a list, such as the
+    per-epoch validation set objects from NN model training, and sets their model_score attributes.
+
+    For regression models trained on a single train/validation split, all the objects hold predictions for
+    the same compounds, so the predictions are stacked into one array, untransformed together and scored with
+    one call to regression_task_metrics. Otherwise each object's model_choice_score method is called in turn.
+
+    Args:
+        perf_data_list (list of PerfData): Objects with accumulated predictions
+
+        score_type (str): The name of the scoring metric, as for PerfData.model_choice_score
+
+    Returns:
+        (np.array): Model choice score for each object
+    """
+    if not (perf_data_list and score_type in regr_score_func
+            and all(type(pdata) is SimpleRegressionPerfData and pdata.pred_vals is not None
+                    for pdata in perf_data_list)):
+        return np.array([pdata.model_choice_score(score_type) for pdata in perf_data_list])
+
+    first = perf_data_list[0]
+    real_vals = first.get_real_values()
+    weights = first.get_weights()
+    pred_vals = np.stack([pdata.pred_vals for pdata in perf_data_list])
+    pred_vals = dc.trans.undo_transforms(pred_vals.reshape((-1, first.num_tasks)),
+                                         first.transformers).reshape(pred_vals.shape)
+    # Lay the objects out side by side as extra task columns, so that they're scored by the same per-task
+    # metrics code as model_choice_score
+    nobjs, ncmpds, ntasks = pred_vals.shape
+    pred_vals = pred_vals.transpose((1, 0, 2)).reshape((ncmpds, nobjs * ntasks))
+    task_scores = regression_task_metrics(np.tile(real_vals, (1, nobjs)), pred_vals,
+                                          np.tile(weights, (1, nobjs)))[score_type].reshape((nobjs, ntasks))
+    scores = task_scores.mean(axis=1)
+    if score_type in loss_funcs:
+        scores = -scores
+    for pdata, score in zip(perf_data_list, scores):
+        pdata.model_score = float(score)
+    return scores
+
 # ****************************************************************************************
 class PerfData(object):
     """Class with methods for accumulating prediction data over multiple cross-validation folds
@@ -133,6 +346,27 @@ class PerfData(object):
         """Initialize any attributes that are common to all PerfData subclasses
         """
 
+    # ****************************************************************************************
+    def copy_empty(self):
+        """Returns a new PerfData object of the same class for the same dataset subset, with no accumulated
+        predictions or metrics. The new object shares the response values, weights and other attributes
+        that don't change as predictions are accumulated, so it is much cheaper to create than a new object
+        constructed from the dataset.
+        """
+        new_perf_data = copy.copy(self)
+        new_perf_data.perf_metrics = []
+        new_perf_data.model_score = None
+        if hasattr(self, 'pred_sums'):
+            # K-fold classes keep running sums of the predictions from each fold for each compound ID
+            new_perf_data.pred_sums = np.zeros_like(self.pred_sums)
+            new_perf_data.pred_sq_sums = np.zeros_like(self.pred_sq_sums)
+            new_perf_data.pred_counts = np.zeros_like(self.pred_counts)
+            new_perf_data.folds = 0
+        else:
+            new_perf_data.pred_vals = None
+            new_perf_data.pred_stds = None
+        return new_perf_data
+
     # ****************************************************************************************
     def accumulate_preds(self, predicted_vals, ids, pred_stds=None):
         """
@@ -269,13 +503,11 @@ class RegressionPerfData(PerfData):
         """
         ids, pred_vals, stds = self.get_pred_values()
         real_vals = self.get_real_values(ids)
-        weights = self.get_weights(ids)
-        scores = []
-        for i in range(self.num_tasks):
-            nzrows = np.where(weights[:,i] != 0)[0]
-            task_real_vals = np.squeeze(real_vals[nzrows,i])
-            task_pred_vals = np.squeeze(pred_vals[nzrows,i])
-            scores.append(regr_score_func[score_type](task_real_vals, task_pred_vals))
+        weights = _predicted_weights(self, self.get_weights(ids))
+        if score_type in regr_score_func:
+            scores = regression_task_metrics(real_vals, pred_vals, weights)[score_type]
+        else:
+            raise ValueError("Unknown model_choice_score_type %s for regression model" % score_type)
 
         self.model_score = float(np.mean(scores))
         if score_type in loss_funcs:
@@ -317,19 +549,12 @@ class RegressionPerfData(PerfData):
         (ids, pred_vals, pred_stds) = self.get_pred_values()
         real_vals = self.get_real_values(ids)
         weights = self.get_weights(ids)
-        mae_scores = []
-        rms_scores = []
-        response_means = []
-        response_stds = []
-        # Iterate over tasks, call score funcs directly on weight masked values
-        for i in range(self.num_tasks):
-            nzrows = np.where(weights[:,i] != 0)[0]
-            task_real_vals = np.squeeze(real_vals[nzrows,i])
-            task_pred_vals = np.squeeze(pred_vals[nzrows,i])
-            mae_scores.append(regr_score_func['mae'](task_real_vals, task_pred_vals))
-            rms_scores.append(regr_score_func['rmse'](task_real_vals, task_pred_vals))
-            response_means.append(task_real_vals.mean().tolist())
-            response_stds.append(task_real_vals.std().tolist())
+        # Compute all the per-task metrics in one pass over the weight masked values
+        task_metrics = regression_task_metrics(real_vals, pred_vals, weights)
+        mae_scores = task_metrics['mae'].tolist()
+        rms_scores = task_metrics['rmse'].tolist()
+        response_means = task_metrics['mean'].tolist()
+        response_stds = task_metrics['std'].tolist()
         pred_results['mae_score'] = float(np.mean(mae_scores))
         if self.num_tasks > 1:
             pred_results['task_mae_scores'] = mae_scores
@@ -465,7 +690,7 @@ class ClassificationPerfData(PerfData):
         """
         ids, pred_classes, class_probs, prob_stds = self.get_pred_values()
         real_vals = self.get_real_values()
-        weights = self.get_weights()
+        weights = _predicted_weights(self, self.get_weights())
         scores = []
             
         for i in range(self.num_tasks):
@@ -677,7 +902,12 @@ class KFoldRegressionPerfData(RegressionPerfData):
 
             num_tasks (int): The number of tasks in the dataset
 
-            pred-vals (dict): The dictionary of prediction results
+            id_index (pd.Index): The sorted compound IDs, giving the row order of the arrays below
+
+            pred_sums, pred_sq_sums (np.array): (ncmpds, ntasks) arrays of the sums and sums of squares over
+            folds of the predictions for each compound
+
+            pred_counts (np.array): The number of predictions accumulated for each compound
 
             folds (int): Initialized at zero, flag for determining which k-fold is being assessed
 
@@ -710,7 +940,11 @@ class KFoldRegressionPerfData(RegressionPerfData):
 
                 num_tasks (int): The number of tasks in the dataset
 
-                pred_vals (dict): The dictionary of prediction results
+                id_index (pd.Index): The sorted compound IDs, giving the row order of the arrays below
+
+                pred_sums, pred_sq_sums (np.array): Sums and sums of squares over folds of the predictions
+
+                pred_counts (np.array): The number of predictions accumulated for each compound
 
                 folds (int): Initialized at zero, flag for determining which k-fold is being assessed
 
@@ -728,7 +962,11 @@ class KFoldRegressionPerfData(RegressionPerfData):
             raise ValueError('Unknown dataset subset type "%s"' % self.subset)
         self.num_cmpds = dataset.y.shape[0]
         self.num_tasks = dataset.y.shape[1]
-        self.pred_vals = dict([(id, np.empty((0, self.num_tasks), dtype=np.float32)) for id in dataset.ids])
+        # Predictions from each fold are accumulated as running sums, with one row per compound in sorted ID order
+        self.id_index = pd.Index(sorted(set(dataset.ids)))
+        self.pred_sums = np.zeros((len(self.id_index), self.num_tasks))
+        self.pred_sq_sums = np.zeros_like(self.pred_sums)
+        self.pred_counts = np.zeros(len(self.id_index), dtype=np.int64)
         self.folds = 0
         self.perf_metrics = []
         self.model_score = None
@@ -741,6 +979,9 @@ class KFoldRegressionPerfData(RegressionPerfData):
             # If these were never transformed, transformers will be [], which is fine with undo_transforms
             self.real_vals, self.weights = model_dataset.get_subset_responses_and_weights(self.subset, transformers)
             self.transformers = []
+        # Arrays of the response values and weights in id_index order, so that they can be looked up by row number
+        self.real_array = np.stack([np.asarray(self.real_vals[id]).reshape(-1) for id in self.id_index])
+        self.weight_array = np.stack([np.asarray(self.weights[id]).reshape(-1) for id in self.id_index])
 
 
     # ****************************************************************************************
@@ -763,7 +1004,7 @@ class KFoldRegressionPerfData(RegressionPerfData):
             ValueError: If Predicted value dimensions don't match num_tasks for RegressionPerfData
             
         Side effects:
-            Overwrites the attribute pred_vals
+            Adds the predictions to pred_sums, pred_sq_sums and pred_counts
 
             Increments folds by 1
 
@@ -785,21 +1026,15 @@ class KFoldRegressionPerfData(RegressionPerfData):
             # classes, which is always 1 for regression models.
             predicted_vals = predicted_vals.reshape((ncmpds,ntasks))
 
-        for i, id in enumerate(ids):
-            self.pred_vals[id] = np.concatenate([self.pred_vals[id], predicted_vals[i,:].reshape((1,-1))], axis=0)
+        _accumulate_fold_preds(self, predicted_vals, ids)
         self.folds += 1
 
         pred_vals = dc.trans.undo_transforms(predicted_vals, self.transformers)
 
         real_vals = self.get_real_values(ids)
         weights = self.get_weights(ids)
-        scores = []
-        for i in range(self.num_tasks):
-            nzrows = np.where(weights[:,i] != 0)[0]
-            task_real_vals = np.squeeze(real_vals[nzrows,i])
-            task_pred_vals = np.squeeze(pred_vals[nzrows,i])
-            scores.append(regr_score_func['r2'](task_real_vals, task_pred_vals))
-        self.perf_metrics.append(np.array(scores))
+        scores = regression_task_metrics(real_vals, pred_vals, weights)['r2']
+        self.perf_metrics.append(scores)
         return float(np.mean(scores))
 
 
@@ -820,18 +1055,13 @@ class KFoldRegressionPerfData(RegressionPerfData):
             otherwise.
 
         """
-        ids = sorted(self.pred_vals.keys())
-        if self.subset in ['train', 'test']:
-            rawvals = np.concatenate([self.pred_vals[id].mean(axis=0, keepdims=True).reshape((1,-1)) for id in ids])
-            vals = dc.trans.undo_transforms(rawvals, self.transformers)
-            if self.folds > 1:
-                stds = dc.trans.undo_transforms(np.concatenate([self.pred_vals[id].std(axis=0, keepdims=True).reshape((1,-1))
-                                       for id in ids]), self.transformers)
-            else:
-                stds = None
+        ids = self.id_index.tolist()
+        # Each validation set compound is predicted by only one fold, so its mean is its single prediction
+        rawvals, rawstds = _fold_pred_means_and_stds(self)
+        vals = dc.trans.undo_transforms(rawvals, self.transformers)
+        if self.subset in ['train', 'test'] and self.folds > 1:
+            stds = dc.trans.undo_transforms(rawstds, self.transformers)
         else:
-            rawvals = np.concatenate([self.pred_vals[id].reshape((1,-1)) for id in ids], axis=0)
-            vals = dc.trans.undo_transforms(rawvals, self.transformers)
             stds = None
         return (ids, vals, stds)
 
@@ -851,8 +1081,9 @@ class KFoldRegressionPerfData(RegressionPerfData):
 
         """
         if ids is None:
-            ids = sorted(self.pred_vals.keys())
-        real_vals = np.concatenate([self.real_vals[id].reshape((1,-1)) for id in ids], axis=0)
+            real_vals = self.real_array
+        else:
+            real_vals = self.real_array[_id_rows(self.id_index, ids)]
         return dc.trans.undo_transforms(real_vals, self.transformers)
 
 
@@ -871,8 +1102,8 @@ class KFoldRegressionPerfData(RegressionPerfData):
 
         """
         if ids is None:
-            ids = sorted(self.pred_vals.keys())
-        return np.concatenate([self.weights[id].reshape((1,-1)) for id in ids], axis=0)
+            return self.weight_array
+        return self.weight_array[_id_rows(self.id_index, ids)]
 
 
 
@@ -915,7 +1146,10 @@ class KFoldClassificationPerfData(ClassificationPerfData):
             subset (str): Label of the type of subset of dataset for tracking predictions
             num_cmps (int): The number of compounds in the dataset
             num_tasks (int): The number of tasks in the dataset
-            pred-vals (dict): The dictionary of prediction results
+            id_index (pd.Index): The sorted compound IDs, giving the row order of the arrays below
+            pred_sums, pred_sq_sums (np.array): (ncmpds, ntasks, nclasses) arrays of the sums and sums of squares
+                over folds of the predicted class probabilities for each compound
+            pred_counts (np.array): The number of predictions accumulated for each compound
             folds (int): Initialized at zero, flag for determining which k-fold is being assessed 
             transformers (list of Transformer objects): from input arguments
             real_vals (dict): The dictionary containing the origin response column values
@@ -953,7 +1187,12 @@ class KFoldClassificationPerfData(ClassificationPerfData):
 
                 num_tasks (int): The number of tasks in the dataset
 
-                pred_vals (dict): The dictionary of prediction results
+                id_index (pd.Index): The sorted compound IDs, giving the row order of the arrays below
+
+                pred_sums, pred_sq_sums (np.array): Sums and sums of squares over folds of the predicted class
+                probabilities
+
+                pred_counts (np.array): The number of predictions accumulated for each compound
 
                 folds (int): Initialized at zero, flag for determining which k-fold is being assessed
 
@@ -985,7 +1224,11 @@ class KFoldClassificationPerfData(ClassificationPerfData):
         self.num_cmpds = dataset.y.shape[0]
         self.num_tasks = dataset.y.shape[1]
         self.num_classes = len(set(model_dataset.dataset.y.flatten()))
-        self.pred_vals = dict([(id, np.empty((0, self.num_tasks, self.num_classes), dtype=np.float32)) for id in dataset.ids])
+        # Predictions from each fold are accumulated as running sums, with one row per compound in sorted ID order
+        self.id_index = pd.Index(sorted(set(dataset.ids)))
+        self.pred_sums = np.zeros((len(self.id_index), self.num_tasks, self.num_classes))
+        self.pred_sq_sums = np.zeros_like(self.pred_sums)
+        self.pred_counts = np.zeros(len(self.id_index), dtype=np.int64)
 
         real_vals, self.weights = model_dataset.get_subset_responses_and_weights(self.subset, [])
         self.real_classes = real_vals
@@ -997,6 +1240,12 @@ class KFoldClassificationPerfData(ClassificationPerfData):
                                    for id, class_labels in real_vals.items()])
         else:
             self.real_vals = real_vals
+        # Arrays of the response values and weights in id_index order, so that they can be looked up by row number
+        if self.num_classes > 2:
+            self.real_array = np.stack([self.real_vals[id].reshape((-1, self.num_classes)) for id in self.id_index])
+        else:
+            self.real_array = np.stack([np.asarray(self.real_vals[id]).reshape(-1) for id in self.id_index])
+        self.weight_array = np.stack([np.asarray(self.weights[id]).reshape(-1) for id in self.id_index])
 
         self.folds = 0
         self.perf_metrics = []
@@ -1026,14 +1275,13 @@ class KFoldClassificationPerfData(ClassificationPerfData):
             None
                   
         Side effects:
-            Overwrites the attribute pred_vals
+            Adds the predictions to pred_sums, pred_sq_sums and pred_counts
 
             Increments folds by 1
 
         """
         class_probs = self._reshape_preds(predicted_vals)
-        for i, id in enumerate(ids):
-            self.pred_vals[id] = np.concatenate([self.pred_vals[id], class_probs[i,:,:].reshape((1,self.num_tasks,-1))], axis=0)
+        _accumulate_fold_preds(self, class_probs, ids)
         self.folds += 1
         real_vals = self.get_real_values(ids)
         weights = self.get_weights(ids)
@@ -1078,18 +1326,13 @@ class KFoldClassificationPerfData(ClassificationPerfData):
             probability estimates (only available for the 'train' and 'test' subsets; None otherwise).
 
         """
-        ids = sorted(self.pred_vals.keys())
+        ids = self.id_index.tolist()
+        # Each validation set compound is predicted by only one fold, so its mean is its single prediction
+        mean_probs, std_probs = _fold_pred_means_and_stds(self)
+        class_probs = dc.trans.undo_transforms(mean_probs, self.transformers)
         if self.subset in ['train', 'test']:
-            #class_probs = np.concatenate([dc.trans.undo_transforms(self.pred_vals[id], self.transformers).mean(axis=0, keepdims=True)
-            #                       for id in ids], axis=0)
-            #prob_stds = np.concatenate([dc.trans.undo_transforms(self.pred_vals[id], self.transformers).std(axis=0, keepdims=True)
-            #                       for id in ids], axis=0)
-            class_probs = dc.trans.undo_transforms(np.concatenate([self.pred_vals[id].mean(axis=0, keepdims=True)
-                                   for id in ids], axis=0), self.transformers)
-            prob_stds = dc.trans.undo_transforms(np.concatenate([self.pred_vals[id].std(axis=0, keepdims=True)
-                                   for id in ids], axis=0), self.transformers)
+            prob_stds = dc.trans.undo_transforms(std_probs, self.transformers)
         else:
-            class_probs = np.concatenate([dc.trans.undo_transforms(self.pred_vals[id], self.transformers) for id in ids], axis=0)
             prob_stds = None
         pred_classes = np.argmax(class_probs, axis=2)
         return (ids, pred_classes, class_probs, prob_stds)
@@ -1110,11 +1353,8 @@ class KFoldClassificationPerfData(ClassificationPerfData):
 
         """
         if ids is None:
-            ids = sorted(self.pred_vals.keys())
-        if self.num_classes > 2:
-            return np.concatenate([self.real_vals[id].reshape((1,-1,self.num_classes)) for id in ids], axis=0)
-        else:
-            return np.concatenate([self.real_vals[id].reshape((1,-1)) for id in ids], axis=0)
+            return self.real_array
+        return self.real_array[_id_rows(self.id_index, ids)]
 
     # ****************************************************************************************
     # class KFoldClassificationPerfData
@@ -1131,8 +1371,8 @@ class KFoldClassificationPerfData(ClassificationPerfData):
 
         """
         if ids is None:
-            ids = sorted(self.pred_vals.keys())
-        return np.concatenate([self.weights[id].reshape((1,-1)) for id in ids], axis=0)
+            return self.weight_array
+        return self.weight_array[_id_rows(self.id_index, ids)]
 
 
     # ****************************************************************************************
@@ -1273,13 +1513,8 @@ class SimpleRegressionPerfData(RegressionPerfData):
         pred_vals = dc.trans.undo_transforms(self.pred_vals, self.transformers)
         real_vals = self.get_real_values(ids)
         weights = self.get_weights(ids)
-        scores = []
-        for i in range(self.num_tasks):
-            nzrows = np.where(weights[:,i] != 0)[0]
-            task_real_vals = np.squeeze(real_vals[nzrows,i])
-            task_pred_vals = np.squeeze(pred_vals[nzrows,i])
-            scores.append(r2_score(task_real_vals, task_pred_vals))
-        self.perf_metrics.append(np.array(scores))
+        scores = regression_task_metrics(real_vals, pred_vals, weights)['r2']
+        self.perf_metrics.append(scores)
         return float(np.mean(scores))
 
 
@@ -133,7 +133,10 @@ def plot_perf_vs_epoch(MP, pdf_dir=None):
             MP.params.dataset_name, perf_label, MP.params.model_type,  MP.params.prediction_type,
             MP.params.featurizer,  MP.params.splitter,  best_epoch)
     for subset in ['training', 'validation', 'test']:
-        ax.plot(epoch, subset_perf[subset], color=subset_colors[subset], label=subset)
+        # Each set may only have been evaluated at some epochs; connect the ones that were
+        evaluated = np.isfinite(subset_perf[subset])
+        ax.plot(np.array(epoch)[evaluated], subset_perf[subset][evaluated], color=subset_colors[subset], marker='.',
+                label=subset)
         # Add shading to show variance across folds
         if num_folds > 1:
             ax.fill_between(epoch, subset_perf[subset] + subset_std[subset], subset_perf[subset] - subset_std[subset],
@@ -24,29 +24,28 @@ def get_statistics_missing_ydata(dataset):
        This updated version gives the option to check for and ignore missing
        values for the y variable only. The x variable still assumes no
        missing values.
+
+       The per-task means and standard deviations are computed with masked NumPy
+       reductions over the full response and weight arrays, ignoring values that
+       are missing or have zero weight.
     """
-    y_means = np.zeros(len(dataset.get_task_names()))
-    y_m2 = np.zeros(len(dataset.get_task_names()))
-    dy = np.zeros(len(dataset.get_task_names()))
-    n = np.zeros(len(dataset.get_task_names()))
-    for _, y, w, _ in dataset.itersamples():
-       for it in range(len(y)) :
-            ## set weights to 0 for missing data
-            if np.isnan(y[it]) :
-                assert(w[i]==0)
-            if w[it]!=0 and not np.isnan(y[it]) :
-               #print("huh",w[it],y[it]) 
-               n[it]+=1
-               dy[it] = y[it] - y_means[it]
-               y_means[it] += dy[it] / n[it]
-               y_m2[it] += dy[it] * (y[it] - y_means[it])
-      
+    ntasks = len(dataset.get_task_names())
+    y = np.asarray(dataset.y, dtype=np.float64).reshape((-1, ntasks))
+    w = np.asarray(dataset.w).reshape((-1, ntasks))
+    missing = np.isnan(y)
+    ## weights must be 0 for missing data
+    assert np.all(w[missing] == 0)
+    mask = (w != 0) & ~missing
+
+    n = mask.sum(axis=0).astype(np.float64)
+    y_masked = np.where(mask, y, 0.)
+    y_means = np.divide(y_masked.sum(axis=0), n, out=np.zeros(ntasks), where=(n > 0))
+    y_m2 = np.where(mask, (y_masked - y_means)**2, 0.).sum(axis=0)
+
     print("n_cnt",n)
     print("y_means",y_means)
-    y_stds=np.zeros(len(n))
-    for it in range(len(n)) :
-       if n[it] >= 2:
-         y_stds[it] = np.sqrt(y_m2[it] / n[it])
+    y_stds = np.zeros(ntasks)
+    np.sqrt(y_m2 / np.maximum(n, 1.), out=y_stds, where=(n >= 2))
     print("y_stds",y_stds)
     return y_means, y_stds
     
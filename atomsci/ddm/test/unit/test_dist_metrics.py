@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import deepchem as dc
+from rdkit import Chem, DataStructs
+from rdkit.Chem import rdFingerprintGenerator
+from scipy.spatial.distance import squareform
+
+import atomsci.ddm.pipeline.dist_metrics as dm
+import atomsci.ddm.pipeline.chem_diversity as cd
+import atomsci.ddm.pipeline.diversity_plots as dp
+
+test_smiles = ['CCO', 'CCN', 'CCCC', 'c1ccccc1', 'c1ccccc1O', 'c1ccccc1N', 'CC(=O)O', 'CC(=O)Nc1ccc(O)cc1',
+               'CN1C=NC2=C1C(=O)N(C(=O)N2C)C', 'CC(C)Cc1ccc(cc1)C(C)C(=O)O', 'O=C(O)c1ccccc1OC(C)=O', 'C1CCCCC1',
+               'CCOC(=O)C', 'c1ccc2ccccc2c1', 'Clc1ccccc1', 'OCC(O)CO', 'NCCc1ccc(O)c(O)c1']
+
+def ecfp_fingerprints(nbits):
+    gen = rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=nbits)
+    fps = [gen.GetFingerprint(Chem.MolFromSmiles(smiles)) for smiles in test_smiles]
+    # Include an empty fingerprint, for which the union of bits with another empty fingerprint is empty
+    fps.append(DataStructs.ExplicitBitVect(nbits))
+    fps.append(DataStructs.ExplicitBitVect(nbits))
+    return fps
+
+def reference_dists(fps):
+    """Condensed Tanimoto distances computed one row at a time by RDKit"""
+    return np.concatenate([1. - np.array(DataStructs.BulkTanimotoSimilarity(fps[i], fps[i+1:]))
+                           for i in range(len(fps) - 1)])
+
+backends = [
+    pytest.param(dm._tanimoto_packed_numpy, id='numpy'),
+    pytest.param(getattr(dm, '_tanimoto_packed_numba', None), id='numba',
+                 marks=pytest.mark.skipif(not dm.numba_supported, reason='numba is not installed')),
+    pytest.param(dm._tanimoto_packed_cuda, id='cuda',
+                 marks=pytest.mark.skipif(not dm.cuda_supported, reason='no CUDA device available')),
+]
+
+#***********************************************************************************
+
+@pytest.mark.parametrize('nbits', [1024, 1000, 40])
+@pytest.mark.parametrize('backend', backends)
+def test_tanimoto_backends_match_rdkit(backend, nbits):
+    """Checks each packed Tanimoto implementation against RDKit, including fingerprint sizes that aren't a
+    multiple of 64 bits and pairs of empty fingerprints."""
+    fps = ecfp_fingerprints(nbits)
+    arr = dm.pack_fingerprints(fps)
+    dists = backend(arr, dm.bit_counts(arr))
+    np.testing.assert_allclose(dists, reference_dists(fps))
+
+#***********************************************************************************
+
+@pytest.mark.parametrize('nbits', [1024, 1000])
+def test_tanimoto_square_matrix(nbits):
+    fps = ecfp_fingerprints(nbits)
+    np.testing.assert_allclose(dm.tanimoto(fps), squareform(reference_dists(fps)))
+    np.testing.assert_allclose(dm.tanimoto(fps, condensed=True), reference_dists(fps))
+
+#***********************************************************************************
+
+def test_tanimoto_bit_array():
+    """Checks that 0/1 feature arrays, as stored in ECFP datasets, give the same distances as bit vectors."""
+    fps = ecfp_fingerprints(1000)
+    fp_array = np.array([list(fp) for fp in fps], dtype=np.uint8)
+    np.testing.assert_allclose(dm.tanimoto(fp_array, condensed=True), reference_dists(fps))
+
+#***********************************************************************************
+
+def test_block_mean():
+    mat = np.arange(7 * 5, dtype=float).reshape((7, 5))
+    means = dp.block_mean(mat, 3)
+    expected = np.array([[mat[i:i+3, j:j+3].mean() for j in range(0, 5, 3)] for i in range(0, 7, 3)])
+    assert means.shape == (3, 2)
+    np.testing.assert_allclose(means, expected)
+    np.testing.assert_allclose(dp.block_mean(mat, 1), mat)
+
+#***********************************************************************************
+
+def test_calc_dist_diskdataset_sample_size():
+    """Checks that sample_size limits the number of compounds whose distances are computed within a dataset, and
+    that the sampled distances are a subset of the full set. Tanimoto distances for calc_type 'all' are returned
+    as a square matrix."""
+    fps = ecfp_fingerprints(1024)
+    dataset = dc.data.NumpyDataset(np.array([list(fp) for fp in fps], dtype=np.uint8))
+    ncmpds = len(fps)
+    npairs = ncmpds * (ncmpds - 1) // 2
+    full_dists = cd.calc_dist_diskdataset('ecfp', 'tanimoto', dataset, calc_type='all')
+    assert full_dists.shape == (ncmpds, ncmpds)
+    np.testing.assert_allclose(squareform(full_dists, checks=False), reference_dists(fps))
+
+    # A sample size that covers all the pairs returns the full distance matrix
+    dists = cd.calc_dist_diskdataset('ecfp', 'tanimoto', dataset, calc_type='all', sample_size=npairs)
+    np.testing.assert_allclose(dists, full_dists)
+
+    np.random.seed(17)
+    sample_size = 50
+    dists = cd.calc_dist_diskdataset('ecfp', 'tanimoto', dataset, calc_type='all', sample_size=sample_size)
+    nsample = int(np.ceil((1 + np.sqrt(1 + 8 * sample_size)) / 2))
+    assert dists.shape == (nsample, nsample)
+    assert sample_size <= nsample * (nsample - 1) // 2 < npairs
+    assert np.all(np.isin(np.round(dists, 10), np.round(full_dists, 10)))
@@ -280,6 +280,78 @@ def test_super_transform_dataset():
 #    test4.append(isinstance(mp.model_wrapper.valid_perf_data[-1].pred_vals[0][0], np.float32))
 #    assert all(test4)
 
+#***********************************************************************************
+def test_xgboost_fit_keeps_tree_method():
+    """Checks that the xgboost parameters set by the model wrapper are kept by the estimator that DeepChem's
+    XGBoostModel.fit() creates after its parameter search, since that is the one that is saved.
+    """
+    xgb_params = copy.deepcopy(general_params)
+    xgb_params['model_type'] = 'xgboost'
+    xgb_params['featurizer'] = 'ecfp'
+    xgb_params['xgb_n_jobs'] = '2'
+    inp_params = parse.wrapper(xgb_params)
+    featurization = feat.create_featurization(inp_params)
+    mdl = model_wrapper.create_model_wrapper(inp_params, featurization)
+
+    rng = np.random.RandomState(0)
+    X = rng.rand(100, 16).astype(np.float32)
+    y = X[:, :1] * 2.0 + rng.rand(100, 1) * 0.1
+    mdl.model.fit(dc.data.NumpyDataset(X, y))
+    xgb_params = mdl.model.model_instance.get_params()
+    assert xgb_params['tree_method'] == 'hist'
+    assert xgb_params['n_jobs'] == 2
+    assert xgb_params['verbosity'] == 0
+
+#***********************************************************************************
+
+def test_model_choice_scores_match_model_choice_score():
+    """Checks that the scores computed together by perf_data.model_choice_scores are the same as those computed
+    separately by each object's model_choice_score method.
+    """
+    valid_dset = mdl_dataset_delaney.train_valid_dsets[0][1]
+    rng = np.random.RandomState(0)
+    perf_data_list = []
+    for i in range(5):
+        pdata = perf_data.SimpleRegressionPerfData(mdl_dataset_delaney, [], 'valid', transformed=False)
+        pdata.accumulate_preds(valid_dset.y + rng.randn(*valid_dset.y.shape), valid_dset.ids)
+        perf_data_list.append(pdata)
+    for score_type in ['r2', 'mae', 'rmse']:
+        scores = perf_data.model_choice_scores(perf_data_list, score_type)
+        expected = [pdata.model_choice_score(score_type) for pdata in perf_data_list]
+        np.testing.assert_allclose(scores, expected)
+
+#***********************************************************************************
+
+def test_train_NN_early_stopping():
+    """Checks that NN training stops once the model choice score hasn't improved for early_stop_patience epochs,
+    and that the per-epoch results are truncated to the epochs that were run. The tolerance is set so high that
+    no epoch after the first counts as an improvement, so training must stop after epoch 3.
+    """
+    nn_params = copy.deepcopy(general_params)
+    nn_params['splitter'] = 'random'
+    nn_params['max_epochs'] = '20'
+    nn_params['baseline_epoch'] = '2'
+    nn_params['early_stop_patience'] = '2'
+    nn_params['early_stop_tol'] = '100'
+    nn_params['model_choice_score_type'] = 'mae'
+    inp_params = parse.wrapper(nn_params)
+    mp = MP.ModelPipeline(inp_params)
+    mp.featurization = feat.create_featurization(inp_params)
+    mp.model_wrapper = model_wrapper.create_model_wrapper(inp_params, mp.featurization, mp.ds_client)
+    mp.model_wrapper.setup_model_dirs()
+    mp.load_featurize_data()
+    mp.model_wrapper.train(mp)
+
+    mdl = mp.model_wrapper
+    stop_epoch = 3
+    assert mdl.params.max_epochs == stop_epoch
+    assert len(mdl.train_perf_data) == stop_epoch
+    assert len(mdl.valid_perf_data) == stop_epoch
+    assert len(mdl.test_perf_data) == stop_epoch
+    assert len(mdl.valid_epoch_perfs) == stop_epoch
+    assert len(mdl.model_choice_scores) == stop_epoch
+    assert mdl.best_epoch < stop_epoch
+
 #***********************************************************************************
 def test_train_NN_graphconv_scaffold_inputs():
     """
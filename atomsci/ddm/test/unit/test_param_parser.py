@@ -41,6 +41,17 @@ list_inputs = ['--dataset_key','/ds/data/public/delaney/delaney-processed.csv',
 dupe_inputs = ['--dataset_key','/ds/data/public/delaney/delaney-processed.csv',
                '--bucket','gsk_ml',
                '--dataset_key','nope']
+bad_frac_inputs = ['--dataset_key','/ds/data/public/delaney/delaney-processed.csv',
+                   '--bucket','gsk_ml',
+                   '--split_test_frac','1.5']
+malformed_hyperparam_inputs = ['--dataset_key','/ds/data/public/delaney/delaney-processed.csv',
+                               '--bucket','gsk_ml',
+                               '--hyperparam',
+                               '--layer_sizes','100,,50']
+alias_dupe_inputs = ['--dataset_key','/ds/data/public/delaney/delaney-processed.csv',
+                     '--bucket','gsk_ml',
+                     '--response_cols','one1',
+                     '-y','two2']
 config_inputs = ['--config_file', config_path, '--response_cols','one1,two2,three3','--previously_split','--baseline_epoch','78','--transformers','--splitter','random']
 
 required_inputs_namespace = argparse.Namespace(dataset_key = '/ds/data/public/delaney/delaney-processed.csv', 
@@ -211,10 +222,25 @@ def test_undefined_param_command():
     with pytest.raises(SystemExit):
         params = parse.wrapper(undefined_inputs)
         
+def test_bad_split_frac_command():
+    with pytest.raises(SystemExit):
+        params = parse.wrapper(bad_frac_inputs)
+
+def test_malformed_hyperparam_list_command():
+    with pytest.raises(ValueError):
+        params = parse.wrapper(malformed_hyperparam_inputs)
+    for bad_value in [',0.1', '0.1,']:
+        with pytest.raises(ValueError):
+            params = parse.wrapper(malformed_hyperparam_inputs[:-2] + ['--dropouts', bad_value])
+
 def test_dupe_param_command():
     with pytest.raises(ValueError):
         params = parse.wrapper(dupe_inputs)
 
+def test_alias_dupe_param_command():
+    with pytest.raises(ValueError):
+        params = parse.wrapper(alias_dupe_inputs)
+
 
         
 def test_correct_input_type_command():
@@ -736,6 +736,8 @@ class HyperparameterSearch(object):
         Returns:
             None
         """
+        # Number of jobs that can be submitted before the queue is full, as of the last time it was checked
+        free_slots = 0
         for assay, bucket, splitter, split_uuid in self.assays:
             # Writes the series of command line arguments for scripts without a hyperparameter combo
             assay_params = copy.deepcopy(self.new_params)
@@ -780,15 +782,27 @@ class HyperparameterSearch(object):
                                 continue
                     if not self.params.rerun and self.already_run(assay_params):
                         continue
-                    i = int(run_cmd('squeue | grep $(whoami) | wc -l').decode("utf-8"))
-                    while i >= self.params.max_jobs:
-                        print("%d jobs in queue, sleeping" % i)
-                        time.sleep(60)
-                        i = int(run_cmd('squeue | grep $(whoami) | wc -l').decode("utf-8"))
+                    if free_slots <= 0:
+                        free_slots = self.wait_for_free_slots()
                     assay_params['result_dir'] = os.path.join(base_result_dir, str(uuid.uuid4()))
                     self.log.info(assay_params)
                     self.out_file.write(str(assay_params))
                     run_command(self.shell_script, self.params.python_path, self.params.script_dir, assay_params)
+                    free_slots -= 1
+
+    def wait_for_free_slots(self):
+        """
+        Waits until the user has fewer than max_jobs jobs in the slurm queue
+
+        Returns:
+            Number of jobs that can be submitted before the queue is full
+        """
+        i = int(run_cmd('squeue | grep $(whoami) | wc -l').decode("utf-8"))
+        while i >= self.params.max_jobs:
+            print("%d jobs in queue, sleeping" % i)
+            time.sleep(60)
+            i = int(run_cmd('squeue | grep $(whoami) | wc -l').decode("utf-8"))
+        return self.params.max_jobs - i
 
     def already_run(self, assay_params):
         """